@@ -1,26 +1,190 @@
+import logging
 import os
 import sys
+import threading
+import time
 
 sys.path.insert(0, os.path.abspath("../"))
 print(os.getcwd())
-import modules.text_embedding as te
-import modules.text_segmentation as ts
-import modules.database_interactor as db
 import modules.s3_interactor as s3
 import modules.transcribe as transcribe
-import time
+import modules.transcription_jobs as jobs
+from modules.ingest_scheduler import IngestionScheduler, notification_source_from_env
+
+logger = logging.getLogger(__name__)
 
 AUDIO_BUCKET_NAME = os.getenv("AUDIO_BUCKET")
 
-while True:
-    if s3.bucket_empty():
-        print("no files, waiting")
-        time.sleep(5)
-    
-    for filename in s3.get_bucket_filenames(file_extension='.wav', bucket_name=AUDIO_BUCKET_NAME):
-        archive_filename = f"archive/{filename}"
-        s3.move_s3_file(filename, archive_filename, AUDIO_BUCKET_NAME)
-        transcribe.instruct_transcribe_audio(filename = archive_filename, output_filename = filename)
+# aws transcribe allows a limited number of concurrent jobs per account and region
+MAX_CONCURRENT_TRANSCRIPTIONS = int(os.getenv("MAX_CONCURRENT_TRANSCRIPTIONS", "20"))
+TRANSCRIPTION_MAX_ATTEMPTS = int(os.getenv("TRANSCRIPTION_MAX_ATTEMPTS", "3"))
+TRANSCRIPTION_STALE_AFTER = float(os.getenv("TRANSCRIPTION_STALE_AFTER", "7200"))
+REAPER_INTERVAL = float(os.getenv("TRANSCRIPTION_REAPER_INTERVAL", "30"))
+# consecutive failed status checks after which a job is given up on instead of checked again
+TRANSCRIPTION_MAX_CHECK_FAILURES = int(os.getenv("TRANSCRIPTION_MAX_CHECK_FAILURES", "5"))
+
+
+class TranscriptionPipeline:
+    """archives each new .wav and starts a transcribe job for it, tracking every file in the job table.
+    handle() runs on the scheduler's worker pool, the reaper thread polls in-flight jobs,
+    retries failed ones and frees capacity for workers waiting on the concurrency cap"""
+
+    def __init__(self, table: jobs.TranscriptionJobTable, max_concurrent = MAX_CONCURRENT_TRANSCRIPTIONS):
+        self.table = table
+        self.max_concurrent = max_concurrent
+        self._capacity = threading.Condition()
+        self._starting = 0
+        self._stop = threading.Event()
+        self._check_failures = {}   # job name -> consecutive failed status checks
+
+    def _reserve(self, block = True) -> bool:
+        with self._capacity:
+            while self.table.count(jobs.IN_PROGRESS) + self._starting >= self.max_concurrent:
+                if not block or self._stop.is_set():
+                    return False
+                self._capacity.wait(REAPER_INTERVAL)
+            self._starting += 1
+            return True
+
+    def _release(self) -> None:
+        with self._capacity:
+            self._starting -= 1
+            self._capacity.notify_all()
+
+    def _start_job(self, audio_key: str, archive_key: str, attempts: int, block = True) -> bool:
+        if not self._reserve(block):
+            return False
+
+        try:
+            job_name = transcribe.instruct_transcribe_audio(filename=archive_key, output_filename=audio_key)
+        except Exception as e:
+            self.table.update(audio_key, jobs.FAILED, attempts=attempts + 1, error=str(e))
+            raise
+        else:
+            self.table.update(audio_key, jobs.IN_PROGRESS, job_name=job_name, attempts=attempts + 1, error=None)
+            return True
+        finally:
+            self._release()
+
+    def handle(self, audio_key: str) -> None:
+        if not self.table.claim(audio_key):
+            return
+
+        archive_key = f"archive/{audio_key}"
+        if not s3.move_s3_file(audio_key, archive_key, AUDIO_BUCKET_NAME):
+            self.table.forget(audio_key)
+            raise RuntimeError(f"could not archive {audio_key}")
+
+        self.table.update(audio_key, jobs.ARCHIVED, archive_key=archive_key)
+        self._start_job(audio_key, archive_key, attempts=0)
+
+    def reap(self) -> None:
+        now = time.time()
+
+        for row in self.table.with_status(jobs.IN_PROGRESS):
+            try:
+                status, reason = self._job_status(row["job_name"])
+            except Exception as e:
+                if self._check_failures.get(row["job_name"], 0) < TRANSCRIPTION_MAX_CHECK_FAILURES:
+                    logger.warning(f"could not check {row['job_name']}: {e}")
+                    continue
+                self._check_failures.pop(row["job_name"], None)
+                status, reason = None, f"gave up after {TRANSCRIPTION_MAX_CHECK_FAILURES} failed checks: {e}"
+
+            if status == jobs.COMPLETED:
+                self.table.update(row["audio_key"], jobs.COMPLETED)
+            elif status in (jobs.FAILED, None):
+                self.table.update(row["audio_key"], jobs.FAILED, error=reason)
+            elif row["updated_at"] < now - TRANSCRIPTION_STALE_AFTER:
+                # the original could still finish and write a second transcript, withdraw it before it is retried
+                try:
+                    transcribe.stop_transcription_job(row["job_name"])
+                except Exception as e:
+                    logger.warning(f"{row['job_name']} is stale in {status} but could not be stopped, checking again later: {e}")
+                    continue
+                self.table.update(row["audio_key"], jobs.FAILED, error=f"stale after {TRANSCRIPTION_STALE_AFTER:.0f}s in {status}")
+
+        # a worker died between claiming a file and archiving it, let listing pick the file up again
+        for row in self.table.with_status(jobs.QUEUED, updated_before=now - TRANSCRIPTION_STALE_AFTER):
+            self.table.forget(row["audio_key"])
+
+        retry = self.table.with_status(jobs.ARCHIVED, updated_before=now - TRANSCRIPTION_STALE_AFTER)
+        retry += [row for row in self.table.with_status(jobs.FAILED) if row["attempts"] < TRANSCRIPTION_MAX_ATTEMPTS]
+        for row in retry:
+            if not self._previous_job_failed(row):
+                continue
+            try:
+                if not self._start_job(row["audio_key"], row["archive_key"], row["attempts"], block=False):
+                    break
+                logger.info(f"retrying transcription of {row['audio_key']} (attempt {row['attempts'] + 1})")
+            except Exception as e:
+                logger.error(f"retry of {row['audio_key']} failed: {e}")
+
+        with self._capacity:
+            self._capacity.notify_all()
+
+    def _job_status(self, job_name: str) -> tuple[str, str]:
+        """transcribe.get_transcription_job_status, counting consecutive failures per job"""
+        try:
+            result = transcribe.get_transcription_job_status(job_name)
+        except Exception:
+            self._check_failures[job_name] = self._check_failures.get(job_name, 0) + 1
+            raise
+        self._check_failures.pop(job_name, None)
+        return result
+
+    def _previous_job_failed(self, row) -> bool:
+        """checks the job last started for row before it is retried: True when it failed or no longer exists,
+        or when checking it failed TRANSCRIPTION_MAX_CHECK_FAILURES times in a row.
+        False (recording a completion) when it finished after all, or while its state is unknown"""
+        if not row["job_name"]:
+            return True
+
+        try:
+            status, _ = self._job_status(row["job_name"])
+        except Exception as e:
+            if self._check_failures.get(row["job_name"], 0) < TRANSCRIPTION_MAX_CHECK_FAILURES:
+                logger.warning(f"could not check {row['job_name']} before retrying {row['audio_key']}: {e}")
+                return False
+            logger.warning(f"retrying {row['audio_key']} after {TRANSCRIPTION_MAX_CHECK_FAILURES} failed checks of {row['job_name']}: {e}")
+            self._check_failures.pop(row["job_name"], None)
+            return True
+
+        if status == jobs.COMPLETED:
+            self.table.update(row["audio_key"], jobs.COMPLETED)
+            return False
+        return status in (jobs.FAILED, None)
+
+    def run_reaper(self) -> None:
+        while not self._stop.wait(REAPER_INTERVAL):
+            try:
+                self.reap()
+                logger.info(f"transcription jobs: {self.table.summary()}")
+            except Exception as e:
+                logger.error(f"reaper failed: {e}")
+
+    def stop(self) -> None:
+        self._stop.set()
+        with self._capacity:
+            self._capacity.notify_all()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    pipeline = TranscriptionPipeline(jobs.TranscriptionJobTable())
+    reaper = threading.Thread(target=pipeline.run_reaper, name="transcription-reaper", daemon=True)
+    reaper.start()
 
+    scheduler = IngestionScheduler(
+        pipeline.handle,
+        bucket_name=AUDIO_BUCKET_NAME,
+        file_extension=".wav",
+        source=notification_source_from_env("AUDIO_INGEST_QUEUE_URL")
+    )
 
-        
\ No newline at end of file
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pipeline.stop()
+        scheduler.stop()
@@ -1,5 +1,5 @@
 import datetime
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, request, jsonify
 from flask_cors import CORS
 import base64
 import logging
@@ -7,6 +7,8 @@ import tempfile
 import os
 from dotenv import load_dotenv
 import json
+import sys
+from werkzeug.sansio.multipart import MultipartDecoder, Data, Epilogue, Field, File, NeedData
 
 # Load environment variables
 load_dotenv()
@@ -18,15 +20,63 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-CORS(app)
+# modules/ lives next to backend/
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from modules import startup, tracing
 
 from s3_handler import S3Handler
-from transcribe_audio import transcribe_audio
+from transcribe_audio import TranscriptionTimeout, get_waiter, transcribe_audio
 
-s3_handler = S3Handler()
+routes = Blueprint('audio', __name__)
 
-@app.route('/ingest-microphone-prompt-audio', methods=['POST'])
+_s3_handler = None
+
+
+def get_s3_handler():
+    """created on first use rather than at import, warm_up() does it before the first request"""
+    global _s3_handler
+    if _s3_handler is None:
+        _s3_handler = S3Handler()
+    return _s3_handler
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _raw_body_chunks(stream):
+    """yields the request body as it arrives"""
+    while True:
+        chunk = stream.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _multipart_file_chunks(stream, boundary, field_name='audio'):
+    """yields the bytes of one file field from a multipart body without spooling it to disk"""
+    decoder = MultipartDecoder(boundary.encode())
+    in_field = False
+
+    while True:
+        data = stream.read(STREAM_CHUNK_SIZE)
+        decoder.receive_data(data or None)
+
+        event = decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, File):
+                in_field = event.name == field_name
+            elif isinstance(event, Field):
+                in_field = False
+            elif isinstance(event, Data) and in_field:
+                if event.data:
+                    yield event.data
+                if not event.more_data:
+                    return
+            event = decoder.next_event()
+
+        if isinstance(event, Epilogue) or not data:
+            return
+
+@routes.route('/ingest-microphone-prompt-audio', methods=['POST'])
 def ingest_audio():
     try:
         logger.info('📥 Received audio ingestion request')
@@ -42,7 +92,8 @@ def ingest_audio():
 
         # Decode base64 audio data
         try:
-            audio_bytes = base64.b64decode(audio_data)
+            with tracing.span('audio.decode'):
+                audio_bytes = base64.b64decode(audio_data)
             logger.info('✅ Successfully decoded base64 audio data')
         except Exception as e:
             logger.error(f'❌ Error decoding base64 audio data: {str(e)}')
@@ -60,8 +111,8 @@ def ingest_audio():
             filename = f"audio/microphone_prompt_audio_{file_name_timestamp}.wav"
             
             # Open the file in binary read mode
-            with open(temp_file_path, 'rb') as file_obj:
-                s3_result = s3_handler.upload_audio_to_s3(file_obj, filename)
+            with open(temp_file_path, 'rb') as file_obj, tracing.span('s3.upload_audio'):
+                s3_result = get_s3_handler().upload_audio_to_s3(file_obj, filename)
                 if not s3_result:
                     raise Exception("Failed to upload to S3")
                 logger.info(f'✅ Successfully uploaded audio to S3: {s3_result["https_url"]}')
@@ -72,7 +123,8 @@ def ingest_audio():
 
             # Transcribe the audio
             logger.info('🎙️ Starting transcription...')
-            transcription = transcribe_audio(s3_result['s3_uri'])
+            with tracing.span('transcribe'):
+                transcription = transcribe_audio(s3_result['s3_uri'])
             logger.info(f'✅ Transcription completed: {transcription}')
 
             return jsonify({
@@ -81,6 +133,10 @@ def ingest_audio():
                 's3_url': s3_result['https_url'],
                 'transcription': transcription
             })
+
+        except TranscriptionTimeout as e:
+            logger.error(f'❌ Transcription timed out: {str(e)}')
+            return jsonify({'error': str(e), 's3_url': s3_result['https_url']}), 504
             
         except Exception as e:
             logger.error(f'❌ Error processing audio: {str(e)}')
@@ -93,7 +149,7 @@ def ingest_audio():
         logger.error(f'❌ Error processing request: {str(e)}')
         return jsonify({'error': str(e)}), 500
 
-@app.route('/send-audio-to-s3', methods=['POST'])
+@routes.route('/send-audio-to-s3', methods=['POST'])
 def send_audio_to_s3():
 
     try:
@@ -110,7 +166,8 @@ def send_audio_to_s3():
 
         # Decode base64 audio data
         try:
-            audio_bytes = base64.b64decode(audio_data)
+            with tracing.span('audio.decode'):
+                audio_bytes = base64.b64decode(audio_data)
             logger.info('✅ Successfully decoded base64 audio data')
         except Exception as e:
             logger.error(f'❌ Error decoding base64 audio data: {str(e)}')
@@ -128,8 +185,8 @@ def send_audio_to_s3():
             filename = f"microphone_prompt_audio_{file_name_timestamp}.wav"
             
             # Open the file in binary read mode
-            with open(temp_file_path, 'rb') as file_obj:
-                s3_result = s3_handler.upload_audio_to_s3(file_obj, filename)
+            with open(temp_file_path, 'rb') as file_obj, tracing.span('s3.upload_audio'):
+                s3_result = get_s3_handler().upload_audio_to_s3(file_obj, filename)
                 if not s3_result:
                     raise Exception("Failed to upload to S3")
                 logger.info(f'✅ Successfully uploaded audio to S3: {s3_result["https_url"]}')
@@ -158,6 +215,90 @@ def send_audio_to_s3():
 
         
 
+@routes.route('/stream-audio-to-s3', methods=['POST'])
+def stream_audio_to_s3():
+    """
+    Accepts audio as a raw request body (e.g. Content-Type: audio/wav) or as the "audio" field of a
+    multipart/form-data body and streams it straight into an S3 multipart upload.
+    Pass ?transcribe=true to also transcribe it, like /ingest-microphone-prompt-audio.
+    """
+    try:
+        logger.info('📥 Received streaming audio upload')
+
+        if request.mimetype == 'multipart/form-data':
+            boundary = request.mimetype_params.get('boundary')
+            if not boundary:
+                return jsonify({'error': 'Missing multipart boundary'}), 400
+            chunks = _multipart_file_chunks(request.stream, boundary)
+        else:
+            chunks = _raw_body_chunks(request.stream)
+
+        first_chunk = next(chunks, b'')
+        if not first_chunk:
+            logger.error('❌ No audio data provided in request')
+            return jsonify({'error': 'No audio data provided'}), 400
+
+        def body():
+            yield first_chunk
+            yield from chunks
+
+        should_transcribe = request.args.get('transcribe', '').lower() in ('1', 'true', 'yes')
+        file_name_timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        filename = f"{'audio/' if should_transcribe else ''}microphone_prompt_audio_{file_name_timestamp}.wav"
+
+        with tracing.span('s3.stream_audio'):
+            s3_result = get_s3_handler().stream_audio_to_s3(body(), filename)
+        if not s3_result:
+            return jsonify({'error': 'Failed to upload audio'}), 500
+        logger.info(f'✅ Successfully streamed audio to S3: {s3_result["https_url"]}')
+
+        response = {
+            'status': 'success',
+            'message': 'Audio processed successfully',
+            's3_url': s3_result['https_url'],
+            'size': s3_result['size']
+        }
+
+        if should_transcribe:
+            logger.info('🎙️ Starting transcription...')
+            with tracing.span('transcribe'):
+                response['transcription'] = transcribe_audio(s3_result['s3_uri'])
+            logger.info(f'✅ Transcription completed: {response["transcription"]}')
+
+        return jsonify(response)
+
+    except TranscriptionTimeout as e:
+        logger.error(f'❌ Transcription timed out: {str(e)}')
+        return jsonify({'error': str(e), 's3_url': s3_result['https_url']}), 504
+
+    except Exception as e:
+        logger.error(f'❌ Error processing request: {str(e)}')
+        return jsonify({'error': str(e)}), 500
+
+
+def warm_up():
+    """builds the S3 and Transcribe clients and starts the transcription waiter, once per (forked) process"""
+    return startup.warm_up({
+        's3_handler': get_s3_handler,
+        'transcription_waiter': get_waiter
+    })
+
+
+def create_app():
+    """the app factory, no AWS clients are made until warm_up() or a request.
+    gunicorn (gunicorn.conf.py) imports it once before forking and runs warm_up() in every worker"""
+    app = Flask(__name__)
+    CORS(app)
+    # per-stage timings for every request, /metrics and /metrics/memory
+    tracing.instrument_flask(app)
+    startup.report_first_request(app)
+    app.register_blueprint(routes)
+    return app
+
+
+app = create_app()
+
 if __name__ == '__main__':
     logger.info('🚀 Starting Flask server...')
+    warm_up()
     app.run(host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file
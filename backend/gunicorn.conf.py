@@ -0,0 +1,37 @@
+import multiprocessing
+import os
+import time
+
+# start of the deploy as the workers will report it, set before the app is imported
+os.environ.setdefault("PROCESS_STARTED_AT", str(time.time()))
+
+"""
+gunicorn settings for the ingest (audio) server, run from backend/:
+
+    gunicorn -c gunicorn.conf.py
+
+The app is imported once in the master (preload_app) so every worker shares the imported modules
+copy-on-write and starts serving without importing anything. Sockets can't cross fork, so each worker
+opens its own AWS clients and transcription waiter in post_fork, before it accepts a request.
+"""
+
+wsgi_app = "app:app"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", str(multiprocessing.cpu_count() * 2 + 1)))
+# requests mostly wait on S3 and Transcribe, threads keep a worker busy meanwhile
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# ?transcribe=true holds a request open until the transcription job finishes
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+keepalive = 5
+preload_app = True
+
+
+def post_fork(server, worker):
+    import app
+
+    app.warm_up()
+
+
+def when_ready(server):
+    server.log.info(f"master ready in {time.time() - float(os.environ['PROCESS_STARTED_AT']):.2f}s")
@@ -1,10 +1,15 @@
-import boto3
+import os
+import sys
 import time
 import logging
 from botocore.exceptions import ClientError
 from typing import Callable, Optional
 from s3_handler import S3Handler
 
+# modules/ lives next to backend/
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from modules import aws_clients
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -12,8 +17,8 @@ logger = logging.getLogger(__name__)
 class KVSHandler:
     def __init__(self, stream_name="parrot-audio-stream", on_new_record: Optional[Callable] = None):
         self.stream_name = stream_name
-        self.kvs_client = boto3.client('kinesisvideo')
-        self.kinesis_client = boto3.client('kinesis')  # Add regular Kinesis client
+        self.kvs_client = aws_clients.get_client('kinesisvideo')
+        self.kinesis_client = aws_clients.get_client('kinesis')  # Add regular Kinesis client
         self.kvs_media_client = None
         self.stream_arn = None
         self.data_endpoint = None
@@ -48,7 +53,7 @@ class KVSHandler:
                 APIName='PUT_MEDIA'
             )
             self.data_endpoint = response['DataEndpoint']
-            self.kvs_media_client = boto3.client(
+            self.kvs_media_client = aws_clients.get_client(
                 'kinesis-video-media',
                 endpoint_url=self.data_endpoint
             )
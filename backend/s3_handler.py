@@ -1,28 +1,32 @@
-import boto3
 import logging
 import os
+import sys
+import threading
 from botocore.exceptions import ClientError
-from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+# modules/ lives next to backend/
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from modules import aws_clients
+
+# S3 requires every multipart part except the last to be at least 5 MiB
+MULTIPART_PART_SIZE = int(os.getenv('S3_MULTIPART_PART_SIZE', str(8 * 1024 * 1024)))
+MULTIPART_CONCURRENCY = int(os.getenv('S3_MULTIPART_CONCURRENCY', '4'))
 
 logger = logging.getLogger(__name__)
 
 class S3Handler:
 
     def __init__(self):
-        # Get AWS credentials
-        aws_access_key = os.getenv('AWS_ACCESS_KEY_ID')
-        aws_secret_key = os.getenv('AWS_SECRET_ACCESS_KEY')
         aws_region = os.getenv('AWS_REGION', 'us-west-2')  # Default to us-west-2 if not specified
-            
-        # Configure S3 client with explicit credentials
-        self.s3_client = boto3.client(
+
+        # shared clients, credentials come from AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY like before
+        self.s3_client = aws_clients.get_client(
             's3',
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key,
             region_name=aws_region,
-            config=Config(signature_version='s3v4')  # Use latest signature version
+            signature_version='s3v4'  # Use latest signature version
         )
-        self.transcribe_client = boto3.client('transcribe')
+        self.transcribe_client = aws_clients.get_client('transcribe')
         self.bucket_name = os.getenv('S3_BUCKET_NAME')
         logger.info(f'🌍 Using AWS Region: {aws_region}')
         logger.info(f'📦 Target S3 Bucket: {self.bucket_name}')
@@ -55,6 +59,87 @@ class S3Handler:
             logger.error(f"Error uploading audio to S3: {e}")
             return None
        
+    def stream_audio_to_s3(self, chunks, filename, content_type='audio/wav',
+                           part_size=MULTIPART_PART_SIZE, max_concurrency=MULTIPART_CONCURRENCY):
+        """
+        Upload an iterable of byte chunks as an S3 multipart upload without buffering the whole file.
+        At most max_concurrency parts are uploading at once, so memory stays around
+        part_size * (max_concurrency + 1) however long the recording is.
+        """
+        s3_key = f'{filename}'
+        logger.info(f'📤 Streaming file {filename} to S3 bucket {self.bucket_name}')
+
+        upload_id = self.s3_client.create_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=s3_key,
+            ContentType=content_type
+        )['UploadId']
+
+        slots = threading.BoundedSemaphore(max_concurrency)
+        executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='s3-part')
+        futures = []
+
+        def upload_part(data, part_number):
+            try:
+                response = self.s3_client.upload_part(
+                    Bucket=self.bucket_name,
+                    Key=s3_key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=data
+                )
+                return {'PartNumber': part_number, 'ETag': response['ETag']}
+            finally:
+                slots.release()
+
+        def submit(data):
+            slots.acquire()
+            for future in futures:
+                if future.done() and future.exception():
+                    slots.release()
+                    raise future.exception()
+            futures.append(executor.submit(upload_part, data, len(futures) + 1))
+
+        try:
+            buffer = bytearray()
+            size = 0
+            for chunk in chunks:
+                buffer += chunk
+                size += len(chunk)
+                while len(buffer) >= part_size:
+                    submit(bytes(buffer[:part_size]))
+                    del buffer[:part_size]
+
+            if buffer or not futures:
+                submit(bytes(buffer))
+
+            parts = [future.result() for future in futures]
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=s3_key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+
+            s3_uri = f"s3://{self.bucket_name}/{s3_key}"
+            https_url = f"https://{self.bucket_name}.s3.amazonaws.com/{s3_key}"
+
+            logger.info(f'✅ File streamed successfully ({size} bytes in {len(parts)} parts). S3 URI: {s3_uri}')
+            return {
+                's3_uri': s3_uri,
+                'https_url': https_url,
+                'size': size
+            }
+        except Exception as e:
+            logger.error(f"Error streaming audio to S3: {e}")
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=s3_key, UploadId=upload_id)
+            except ClientError as abort_error:
+                logger.error(f"Error aborting multipart upload {upload_id}: {abort_error}")
+            return None
+        finally:
+            executor.shutdown(wait=True)
+
     def transcribe_audio(self, s3_url):
         try:
             logger.info(f'📤 Transcribing audio from {s3_url}')
@@ -1,62 +1,233 @@
-import boto3
 import logging
 import time
 import os
-import json
+import sys
+import threading
+import uuid
 import requests
 from botocore.exceptions import ClientError
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from requests.adapters import HTTPAdapter
+
+# modules/ lives next to backend/
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from modules import aws_clients
 
 logger = logging.getLogger(__name__)
 
-def transcribe_audio(s3_url):
+JOB_NAME_PREFIX = "transcription_"
+# seconds a request waits for its transcript, a job still unfinished by then is given up on
+TRANSCRIPTION_TIMEOUT = float(os.getenv("TRANSCRIPTION_TIMEOUT", "300"))
+# listings a job may be missing from before it is looked up by name
+MISSING_LISTINGS_BEFORE_LOOKUP = 3
+
+
+def _transcribe_client():
+    return aws_clients.get_client('transcribe', region_name=os.getenv('AWS_REGION', 'us-west-2'))
+
+
+def _http_session(pool_size=20):
+    """keep-alive session reused for every transcript download"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class TranscriptionTimeout(TimeoutError):
+    """the transcription job didn't finish in time, it may still be running"""
+
+
+class _PendingJob:
+
+    def __init__(self, job_name, interval, max_wait):
+        self.job_name = job_name
+        self.future = Future()
+        self.submitted_at = time.time()
+        self.deadline = time.monotonic() + max_wait
+        self.interval = interval
+        self.next_check = time.monotonic() + interval
+        self.missing = 0
+
+
+class TranscriptionJobWaiter:
     """
-    Transcribe audio from an S3 URL using AWS Transcribe
+    Watches every in-flight transcription job from one background thread.
+    Each poll is a single paginated list_transcription_jobs call covering all due jobs,
+    and jobs that are still running back off exponentially from min_interval to max_interval.
+    A job missing from several listings is looked up by name, and a job not finished within
+    max_wait seconds fails with TranscriptionTimeout.
     """
-    try:
-        # Initialize AWS Transcribe client
-        transcribe = boto3.client(
-            'transcribe',
-            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-            region_name=os.getenv('AWS_REGION', 'us-west-2')
-        )
-
-        # Extract job name from S3 URL
-        job_name = f"transcription_{int(time.time())}"
-        
-        # Start transcription job
-        logger.info(f'🎙️ Starting transcription job: {job_name}')
-        response = transcribe.start_transcription_job(
-            TranscriptionJobName=job_name,
-            Media={'MediaFileUri': s3_url},
-            MediaFormat='wav',
-            LanguageCode='en-US'
-        )
-
-        # Wait for transcription to complete
+
+    def __init__(self, client=None, session=None, min_interval=1.0, max_interval=30.0, fetch_workers=4,
+                 max_wait=TRANSCRIPTION_TIMEOUT):
+        self.client = client or _transcribe_client()
+        self.session = session or _http_session()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_wait = max_wait
+
+        self._jobs = {}
+        self._condition = threading.Condition()
+        self._fetcher = ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix='transcript-fetch')
+        self._thread = threading.Thread(target=self._run, name='transcription-waiter', daemon=True)
+        self._thread.start()
+
+    def wait_for(self, job_name):
+        """returns a Future resolving to the transcript text, or failing with the job's failure reason"""
+        job = _PendingJob(job_name, self.min_interval, self.max_wait)
+        with self._condition:
+            self._jobs[job_name] = job
+            self._condition.notify()
+        return job.future
+
+    def pending(self):
+        with self._condition:
+            return len(self._jobs)
+
+    def _list_statuses(self, due):
+        """one listing pass, newest first, stopping once it is older than every due job"""
+        wanted = {job.job_name for job in due}
+        oldest = min(job.submitted_at for job in due) - 60
+        statuses = {}
+        kwargs = {'JobNameContains': JOB_NAME_PREFIX, 'MaxResults': 100}
+
         while True:
-            status = transcribe.get_transcription_job(TranscriptionJobName=job_name)
-            if status['TranscriptionJob']['TranscriptionJobStatus'] in ['COMPLETED', 'FAILED']:
-                break
-            time.sleep(1)
-
-        if status['TranscriptionJob']['TranscriptionJobStatus'] == 'COMPLETED':
-            # Get the transcription text from the transcript URI
-            transcript_uri = status['TranscriptionJob']['Transcript']['TranscriptFileUri']
-            response = requests.get(transcript_uri)
+            response = self.client.list_transcription_jobs(**kwargs)
+            summaries = response.get('TranscriptionJobSummaries', [])
+
+            for summary in summaries:
+                if summary['TranscriptionJobName'] in wanted:
+                    statuses[summary['TranscriptionJobName']] = summary
+
+            if len(statuses) == len(wanted) or 'NextToken' not in response:
+                return statuses
+            if summaries and summaries[-1]['CreationTime'].timestamp() < oldest:
+                return statuses
+            kwargs['NextToken'] = response['NextToken']
+
+    def _lookup(self, job):
+        """status of a job the listings keep missing, a job that no longer exists counts as failed"""
+        try:
+            return self.client.get_transcription_job(TranscriptionJobName=job.job_name)['TranscriptionJob']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('BadRequestException', 'NotFoundException'):
+                raise
+            return {'TranscriptionJobStatus': 'FAILED', 'FailureReason': f'job not found: {str(e)}'}
+
+    def _fetch_transcript(self, job):
+        try:
+            result = self.client.get_transcription_job(TranscriptionJobName=job.job_name)
+            transcript_uri = result['TranscriptionJob']['Transcript']['TranscriptFileUri']
+            response = self.session.get(transcript_uri, timeout=30)
+            response.raise_for_status()
             transcript_json = response.json()
-            transcript_text = transcript_json['results']['transcripts'][0]['transcript']
-            
-            logger.info('✅ Transcription completed successfully')
-            return transcript_text
-        else:
-            error_message = status['TranscriptionJob'].get('FailureReason', 'Unknown error')
-            logger.error(f'❌ Transcription failed: {error_message}')
-            raise Exception(f'Transcription failed: {error_message}')
+            job.future.set_result(transcript_json['results']['transcripts'][0]['transcript'])
+        except Exception as e:
+            job.future.set_exception(e)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                due = [job for job in self._jobs.values() if job.next_check <= now]
+                if not due:
+                    next_check = min((job.next_check for job in self._jobs.values()), default=None)
+                    self._condition.wait(None if next_check is None else next_check - now)
+                    continue
+
+            try:
+                statuses = self._list_statuses(due)
+            except Exception as e:
+                logger.error(f'❌ Error listing transcription jobs: {str(e)}')
+                statuses = None
+
+            if statuses is not None:
+                for job in due:
+                    if job.job_name in statuses:
+                        job.missing = 0
+                        continue
+                    job.missing += 1
+                    if job.missing >= MISSING_LISTINGS_BEFORE_LOOKUP:
+                        try:
+                            statuses[job.job_name] = self._lookup(job)
+                        except Exception as e:
+                            logger.error(f'❌ Error looking up transcription job {job.job_name}: {str(e)}')
+
+            with self._condition:
+                for job in due:
+                    summary = (statuses or {}).get(job.job_name)
+                    status = summary['TranscriptionJobStatus'] if summary else None
+                    timed_out = status not in ('COMPLETED', 'FAILED') and time.monotonic() >= job.deadline
+
+                    if status in ('COMPLETED', 'FAILED') or timed_out:
+                        del self._jobs[job.job_name]
+                    else:
+                        job.interval = min(self.max_interval, job.interval * 2)
+                        job.next_check = time.monotonic() + job.interval
+
+                    if status == 'COMPLETED':
+                        self._fetcher.submit(self._fetch_transcript, job)
+                    elif status == 'FAILED':
+                        error_message = summary.get('FailureReason', 'Unknown error')
+                        logger.error(f'❌ Transcription failed: {error_message}')
+                        job.future.set_exception(Exception(f'Transcription failed: {error_message}'))
+                    elif timed_out:
+                        logger.error(f'❌ Transcription job {job.job_name} not finished after {self.max_wait:.0f}s')
+                        job.future.set_exception(TranscriptionTimeout(f'Transcription job {job.job_name} not finished after {self.max_wait:.0f}s'))
+
+
+_waiter = None
+_waiter_lock = threading.Lock()
+_waiter_pid = None
+
+
+def get_waiter():
+    """process-wide waiter, recreated in a forked worker since threads don't survive fork"""
+    global _waiter, _waiter_pid
+
+    with _waiter_lock:
+        if _waiter is None or _waiter_pid != os.getpid():
+            _waiter = TranscriptionJobWaiter()
+            _waiter_pid = os.getpid()
+        return _waiter
+
+
+def start_transcription(s3_url):
+    """
+    Start transcribing audio at an S3 URL and return a Future for the transcript text
+    """
+    waiter = get_waiter()
+    job_name = f"{JOB_NAME_PREFIX}{int(time.time())}_{uuid.uuid4().hex[:8]}"
+
+    logger.info(f'🎙️ Starting transcription job: {job_name}')
+    waiter.client.start_transcription_job(
+        TranscriptionJobName=job_name,
+        Media={'MediaFileUri': s3_url},
+        MediaFormat='wav',
+        LanguageCode='en-US'
+    )
+
+    return waiter.wait_for(job_name)
+
+
+def transcribe_audio(s3_url, timeout=TRANSCRIPTION_TIMEOUT):
+    """
+    Transcribe audio from an S3 URL using AWS Transcribe, raising TranscriptionTimeout after timeout seconds
+    """
+    try:
+        future = start_transcription(s3_url)
+        try:
+            transcript_text = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise TranscriptionTimeout(f'Transcription not finished after {timeout:.0f}s') from None
+        logger.info('✅ Transcription completed successfully')
+        return transcript_text
 
     except ClientError as e:
         logger.error(f'❌ AWS Transcribe error: {str(e)}')
         raise
     except Exception as e:
         logger.error(f'❌ Error in transcription: {str(e)}')
-        raise 
\ No newline at end of file
+        raise
@@ -0,0 +1,120 @@
+from contextlib import contextmanager
+import hashlib
+import io
+import json
+import re
+import time
+from unittest import mock
+
+import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+import numpy as np
+
+from modules import aws_clients
+
+"""offline stand-ins for the AWS calls on the benchmarked paths.
+S3 and Comprehend are real botocore clients with a Stubber queue, so request validation and response
+parsing still run. Bedrock is an in-process object because its responses depend on the text being
+embedded and embed_texts calls it from several threads, which a Stubber queue can't follow."""
+
+REGION = "us-west-2"
+
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+def fake_embedding(text: str, dim: int) -> list[float]:
+    """deterministic unit vector per text, equal texts embed identically"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class StandInBedrock:
+    """answers invoke_model like amazon.titan-embed-text-v2, optionally after latency seconds"""
+
+    def __init__(self, dim = 1024, latency = 0.0):
+        self.dim = dim
+        self.latency = latency
+        self.calls = 0
+
+    def invoke_model(self, modelId, body, **kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        payload = json.dumps({
+            "embedding": fake_embedding(json.loads(body)["inputText"], self.dim),
+            "inputTextTokenCount": 0
+        }).encode("utf-8")
+        return {"body": StreamingBody(io.BytesIO(payload), len(payload)), "contentType": "application/json"}
+
+
+def _stubbed_client(service: str):
+    client = boto3.client(service, region_name=REGION, aws_access_key_id="benchmark", aws_secret_access_key="benchmark")
+    stubber = Stubber(client)
+    stubber.activate()
+    return client, stubber
+
+
+def syntax_response(documents: list[str]) -> dict:
+    """a batch_detect_syntax response tokenizing documents the way comprehend does, punctuation as its own token"""
+    return {
+        "ResultList": [
+            {
+                "Index": index,
+                "SyntaxTokens": [
+                    {
+                        "TokenId": token_id + 1,
+                        "Text": match.group(0),
+                        "BeginOffset": match.start(),
+                        "EndOffset": match.end(),
+                        "PartOfSpeech": {"Tag": "PUNCT" if not match.group(0)[0].isalnum() else "NOUN", "Score": 1.0}
+                    }
+                    for token_id, match in enumerate(_TOKEN.finditer(document))
+                ]
+            }
+            for index, document in enumerate(documents)
+        ],
+        "ErrorList": []
+    }
+
+
+class OfflineAWS:
+    """the clients handed out by aws_clients.get_client while offline() is active"""
+
+    def __init__(self, dim = 1024, bedrock_latency = 0.0):
+        self.bedrock = StandInBedrock(dim, bedrock_latency)
+        self.s3, self.s3_stubber = _stubbed_client("s3")
+        self.comprehend, self.comprehend_stubber = _stubbed_client("comprehend")
+
+    def client(self, service_name, *args, **kwargs):
+        if service_name == "bedrock-runtime":
+            return self.bedrock
+        if service_name == "s3":
+            return self.s3
+        if service_name == "comprehend":
+            return self.comprehend
+        raise RuntimeError(f"no offline stand-in for {service_name}")
+
+    def queue_s3_file(self, bucket: str, key: str, contents: dict) -> None:
+        """the get_object + delete_object pair read_pop_file makes for one file"""
+        body = json.dumps(contents).encode("utf-8")
+        self.s3_stubber.add_response(
+            "get_object",
+            {"Body": StreamingBody(io.BytesIO(body), len(body)), "ContentLength": len(body)},
+            {"Bucket": bucket, "Key": key}
+        )
+        self.s3_stubber.add_response("delete_object", {}, {"Bucket": bucket, "Key": key})
+
+    def queue_comprehend(self, batches: list[list[str]]) -> None:
+        for documents in batches:
+            self.comprehend_stubber.add_response("batch_detect_syntax", syntax_response(documents))
+
+
+@contextmanager
+def offline(dim = 1024, bedrock_latency = 0.0):
+    """routes every aws_clients.get_client call to the stand-ins, yields the OfflineAWS instance"""
+    aws = OfflineAWS(dim, bedrock_latency)
+    with mock.patch.object(aws_clients, "get_client", aws.client):
+        yield aws
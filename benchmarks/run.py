@@ -0,0 +1,370 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+"""micro-benchmarks for the ingestion and retrieval hot paths, offline by default.
+
+    python -m benchmarks.run
+    python -m benchmarks.run --sizes 10000 100000 1000000 --dim 256
+    python -m benchmarks.run --postgres                          # database from DB_* / SQL_PORT, use a scratch database
+    python -m benchmarks.run --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json # exits 1 if anything regressed past --tolerance
+
+AWS calls go to the stand-ins in benchmarks/aws_stubs.py. without --postgres, batch_upload_embeddings runs
+against benchmarks/standin_postgres.py (client-side cost only), similarity_search runs on the in-process
+exact and hnsw backends, and timestamp_search and expand_hits are skipped since they only exist in postgres.
+results are JSON: {"meta": {...}, "metrics": {name: {"value", "unit", "better"}}, "skipped": [...]}"""
+
+BENCHMARK_USER = "benchmark"
+
+WORDS = (
+    "the meeting moved to thursday because the budget review ran long and everyone wanted more time "
+    "to look at the numbers from last quarter before anyone signs off on hiring two more engineers"
+).split()
+OPENERS = ["Dr.", "Mr.", "e.g.", "U.S.", "approx.", "etc."]
+
+
+def synthetic_transcript(sentence_count: int, seed = 0) -> str:
+    """sentences of 6-25 words, some with abbreviations and initials the segmenter has to get right"""
+    rng = random.Random(seed)
+    sentences = []
+    for _ in range(sentence_count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(6, 25))]
+        if rng.random() < 0.2:
+            words.insert(rng.randint(0, len(words) - 1), rng.choice(OPENERS))
+        sentence = " ".join(words)
+        sentences.append(sentence[0].upper() + sentence[1:] + rng.choice([".", ".", ".", "?", "!"]))
+    return " ".join(sentences)
+
+
+class Results:
+
+    def __init__(self):
+        self.metrics = {}
+        self.skipped = []
+
+    def add(self, name: str, value: float, unit: str, better: str) -> None:
+        self.metrics[name] = {"value": round(float(value), 4), "unit": unit, "better": better}
+        print(f"  {name:<55} {value:>14.3f} {unit}", file=sys.stderr)
+
+    def latencies(self, name: str, seconds: list[float]) -> None:
+        milliseconds = np.asarray(seconds) * 1000
+        self.add(f"{name}.p50", np.percentile(milliseconds, 50), "ms", "lower")
+        self.add(f"{name}.p99", np.percentile(milliseconds, 99), "ms", "lower")
+
+    def skip(self, name: str, reason: str) -> None:
+        self.skipped.append({"name": name, "reason": reason})
+        print(f"  {name:<55} skipped: {reason}", file=sys.stderr)
+
+
+def _best_of(repeat: int, fn) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def bench_segmentation(results: Results, aws, sentence_count: int, repeat: int) -> None:
+    from modules import text_segmentation as ts
+
+    text = synthetic_transcript(sentence_count)
+    megabytes = len(text.encode("utf-8")) / 1e6
+    sentences = len(ts.text_segmentation(text, mode="regex"))
+
+    seconds = _best_of(repeat, lambda: ts.text_segmentation(text, mode="regex"))
+    results.add("segmentation.regex.sentences_per_sec", sentences / seconds, "sentences/s", "higher")
+    results.add("segmentation.regex.mb_per_sec", megabytes / seconds, "MB/s", "higher")
+
+    # client side of comprehend mode: chunking, stubbed batch calls, slicing sentences back out
+    chunks = ts._chunk_text(text)
+    batches = [chunks[i:i + ts.COMPREHEND_MAX_BATCH_SIZE] for i in range(0, len(chunks), ts.COMPREHEND_MAX_BATCH_SIZE)]
+
+    def comprehend_run():
+        aws.queue_comprehend(batches)
+        ts.text_segmentation(text, mode="comprehend")
+
+    seconds = _best_of(repeat, comprehend_run)
+    results.add("segmentation.comprehend.sentences_per_sec", sentences / seconds, "sentences/s", "higher")
+
+
+def _upload_batches(rows: int, batch_size: int, dim: int, start_id = 0, seed = 0):
+    rng = np.random.default_rng(seed + start_id)
+    for start in range(0, rows, batch_size):
+        count = min(batch_size, rows - start)
+        vectors = rng.standard_normal((count, dim)).astype(np.float32)
+        yield [
+            (f"benchmark segment {start_id + start + i}", vector.tolist(), BENCHMARK_USER, f"speaker{(start + i) % 3}")
+            for i, vector in enumerate(vectors)
+        ]
+
+
+def bench_upload(results: Results, rows: int, batch_size: int, dim: int) -> None:
+    from modules import database_interactor as db
+
+    batches = list(_upload_batches(rows, batch_size, dim))
+    started = time.perf_counter()
+    for batch in batches:
+        db.batch_upload_embeddings(batch)
+    seconds = time.perf_counter() - started
+
+    results.add("upload.batch_upload_embeddings.rows_per_sec", rows / seconds, "rows/s", "higher")
+
+
+def _local_backend(db, backend: str, path: str):
+    db.SEARCH_BACKEND = backend
+    db.LOCAL_INDEX_PATH = path
+    db._local_index_state.update(index=None, version=None)
+    index = db._open_local_index(empty=True)
+    db._local_index_state["index"] = index
+    return index
+
+
+def bench_local_search(results: Results, backend: str, sizes: list[int], dim: int, queries: int, max_rows: int) -> None:
+    from modules import database_interactor as db
+
+    previous = db.SEARCH_BACKEND, db.LOCAL_INDEX_PATH
+    rng = np.random.default_rng(1)
+    base = datetime(2024, 1, 1)
+
+    with tempfile.TemporaryDirectory() as path:
+        index = _local_backend(db, backend, path)
+        loaded = 0
+
+        for size in sizes:
+            if size > max_rows:
+                results.skip(f"search.{backend}.{size}", f"larger than --{backend}-max-rows {max_rows}")
+                continue
+
+            chunk = 50000
+            while loaded < size:
+                count = min(chunk, size - loaded)
+                vectors = rng.standard_normal((count, dim)).astype(np.float32)
+                index.add(
+                    list(range(loaded + 1, loaded + count + 1)),
+                    vectors,
+                    [(f"segment {loaded + i}", BENCHMARK_USER, "speaker", base + timedelta(seconds=loaded + i)) for i in range(count)]
+                )
+                loaded += count
+            db._save_local_index(index)
+
+            timings = []
+            for query in rng.standard_normal((queries, dim)).astype(np.float32).tolist():
+                started = time.perf_counter()
+                db.similarity_search(query, 0, 5)
+                timings.append(time.perf_counter() - started)
+            results.latencies(f"search.{backend}.{size}.similarity_search", timings)
+
+    db.SEARCH_BACKEND, db.LOCAL_INDEX_PATH = previous
+    db._local_index_state.update(index=None, version=None)
+
+
+def bench_postgres_search(results: Results, sizes: list[int], dim: int, queries: int, batch_size: int) -> None:
+    from modules import database_interactor as db
+
+    with db._pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*), MIN(created_at), MAX(created_at) FROM embeddings")
+            loaded, oldest, newest = cursor.fetchone()
+
+    rng = np.random.default_rng(2)
+    for size in sizes:
+        if loaded < size:
+            started = time.perf_counter()
+            for n, batch in enumerate(_upload_batches(size - loaded, batch_size, dim, start_id=loaded)):
+                db.batch_upload_embeddings(batch, recording=f"benchmark-{loaded}-{n}")
+            print(f"  loaded {size - loaded} rows in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+            loaded = size
+
+        with db._pooled_connection() as pooled:
+            with pooled.conn.cursor() as cursor:
+                cursor.execute("ANALYZE embeddings")
+                cursor.execute("SELECT MIN(created_at), MAX(created_at) FROM embeddings")
+                oldest, newest = cursor.fetchone()
+
+        timings = []
+        for query in rng.standard_normal((queries, dim)).astype(np.float32).tolist():
+            started = time.perf_counter()
+            db.similarity_search(query, 0, 5)
+            timings.append(time.perf_counter() - started)
+        results.latencies(f"search.pgvector.{size}.similarity_search", timings)
+
+        span = max((newest - oldest).total_seconds(), 1.0)
+        timings = []
+        for _ in range(queries):
+            timestamp = oldest + timedelta(seconds=rng.uniform(0, span))
+            started = time.perf_counter()
+            db.timestamp_search(timestamp, 5, 5)
+            timings.append(time.perf_counter() - started)
+        results.latencies(f"search.pgvector.{size}.timestamp_search", timings)
+
+        timings = []
+        for _ in range(queries):
+            hit_ids = rng.integers(1, size + 1, 20).tolist()
+            started = time.perf_counter()
+            db.expand_hits(hit_ids, 1, 5)
+            timings.append(time.perf_counter() - started)
+        results.latencies(f"search.pgvector.{size}.expand_hits", timings)
+
+
+def bench_process_file(results: Results, aws, sentence_count: int, repeat: int) -> None:
+    from modules import s3_interactor
+
+    contents = {"results": {"transcripts": [{"transcript": synthetic_transcript(sentence_count, seed=3)}]}}
+
+    # the processor prints on import and for every sentence
+    with contextlib.redirect_stdout(io.StringIO()):
+        from vector_embedding import processor
+
+        # upload under the benchmark user, so cleanup never touches the processor's real rows
+        username, processor.USERNAME = processor.USERNAME, BENCHMARK_USER
+        try:
+            seconds = _best_of(repeat, lambda: processor._process_file_contents(contents))
+            results.add("ingest.process_file_contents.seconds", seconds, "s", "lower")
+
+            def process_file():
+                aws.queue_s3_file(s3_interactor.BUCKET_NAME, "benchmark.json", contents)
+                processor._process_file("benchmark.json")
+
+            seconds = _best_of(repeat, process_file)
+            results.add("ingest.process_file.seconds", seconds, "s", "lower")
+        finally:
+            processor.USERNAME = username
+
+
+def compare(metrics: dict, baseline: dict, tolerance: float) -> list[str]:
+    """names of metrics that moved the wrong way by more than tolerance (a fraction) against baseline"""
+    regressions = []
+    print(f"\n  {'metric':<55} {'baseline':>12} {'current':>12} {'change':>8}", file=sys.stderr)
+
+    for name, metric in sorted(metrics.items()):
+        previous = baseline.get("metrics", {}).get(name)
+        if previous is None or not previous["value"]:
+            continue
+
+        change = metric["value"] / previous["value"] - 1
+        worse = -change if metric["better"] == "higher" else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        if flag:
+            regressions.append(name)
+        print(f"  {name:<55} {previous['value']:>12.3f} {metric['value']:>12.3f} {change:>+8.1%}{flag}", file=sys.stderr)
+
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv = None) -> int:
+    parser = argparse.ArgumentParser(description="ingestion and retrieval micro-benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="table sizes for the search benchmarks")
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200, help="queries per search latency measurement")
+    parser.add_argument("--upload-rows", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--sentences", type=int, default=2000, help="sentences in the segmentation transcript")
+    parser.add_argument("--file-sentences", type=int, default=200, help="sentences in the end-to-end transcript")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--bedrock-latency-ms", type=float, default=0.0, help="simulated latency per embedding call")
+    parser.add_argument("--hnsw-max-rows", type=int, default=20000, help="the python HNSW build is slow, skip larger sizes")
+    parser.add_argument("--exact-max-rows", type=int, default=1000000)
+    parser.add_argument("--postgres", action="store_true", help="use the database configured by DB_* and SQL_PORT")
+    parser.add_argument("--keep-rows", action="store_true", help="leave the benchmark rows in postgres")
+    parser.add_argument("--only", nargs="+", choices=["segmentation", "upload", "search", "ingest"], default=None)
+    parser.add_argument("--output", default=None, help="write results JSON here instead of stdout")
+    parser.add_argument("--baseline", default=None, help="compare against this results file")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--save-baseline", default=None, help="also write results to this file")
+    args = parser.parse_args(argv)
+
+    # read by the modules at import time. uploads go to postgres (or the stand-in) only,
+    # the local backends are benchmarked on their own temporary index
+    os.environ["EMBEDDING_DIM"] = str(args.dim)
+    os.environ["SEARCH_BACKEND"] = "pgvector"
+    os.environ.setdefault("EMBEDDING_CACHE_ENABLED", "false")
+    os.environ.setdefault("S3_BUCKET_NAME", "benchmark-transcripts")
+
+    from benchmarks import aws_stubs, standin_postgres
+    from modules import database_interactor as db
+
+    selected = set(args.only or ["segmentation", "upload", "search", "ingest"])
+    results = Results()
+
+    with aws_stubs.offline(dim=args.dim, bedrock_latency=args.bedrock_latency_ms / 1000) as aws:
+        if not args.postgres:
+            standin_postgres.install()
+
+        try:
+            if "segmentation" in selected:
+                bench_segmentation(results, aws, args.sentences, args.repeat)
+            if "upload" in selected:
+                bench_upload(results, args.upload_rows, args.batch_size, args.dim)
+            if "search" in selected:
+                if args.postgres:
+                    bench_postgres_search(results, args.sizes, args.dim, args.queries, args.batch_size)
+                else:
+                    bench_local_search(results, "exact", args.sizes, args.dim, args.queries, args.exact_max_rows)
+                    bench_local_search(results, "hnsw", args.sizes, args.dim, args.queries, args.hnsw_max_rows)
+                    for size in args.sizes:
+                        results.skip(f"search.pgvector.{size}", "needs --postgres")
+            if "ingest" in selected:
+                bench_process_file(results, aws, args.file_sentences, args.repeat)
+        finally:
+            if args.postgres and not args.keep_rows:
+                with db._pooled_connection() as pooled:
+                    with pooled.conn.cursor() as cursor:
+                        cursor.execute("DELETE FROM embeddings WHERE username = %s", (BENCHMARK_USER,))
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "postgres": args.postgres,
+            "args": vars(args)
+        },
+        "metrics": results.metrics,
+        "skipped": results.skipped
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results.metrics, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}", file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+from datetime import datetime
+import itertools
+import threading
+
+from psycopg2.extensions import adapt
+
+from modules import database_interactor
+
+"""an in-process stand-in for the postgres connection pool, used when no database is configured.
+it accepts batch_upload_embeddings' INSERT ... RETURNING, so everything on the client side
+(vector formatting, execute_values statement building, pooling) runs for real while the server's share
+of the time is zero. numbers from it are a lower bound; use --postgres for end-to-end figures."""
+
+
+class StandInCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._pending_rows = 0
+        self._results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def mogrify(self, template, args):
+        """what psycopg2 would send, quoted with the same adapters"""
+        if isinstance(template, bytes):
+            template = template.decode("utf-8")
+        self._pending_rows += 1
+        return (template % tuple(adapt(arg).getquoted().decode("utf-8") for arg in args)).encode("utf-8")
+
+    def execute(self, statement, params = None):
+        text = statement.decode("utf-8") if isinstance(statement, bytes) else statement
+        self.connection.statements += 1
+        self.connection.bytes_sent += len(text)
+
+        if "INSERT INTO embeddings" in text and "RETURNING" in text:
+            now = datetime.now()
+            self._results = [(next(self.connection.ids), now) for _ in range(self._pending_rows)]
+        else:
+            self._results = []
+        self._pending_rows = 0
+
+    def fetchall(self):
+        results, self._results = self._results, []
+        return results
+
+    def fetchone(self):
+        return self._results.pop(0) if self._results else None
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.statements = 0
+        self.bytes_sent = 0
+        self.autocommit = False
+        self.closed = 0
+        self.encoding = "UTF8"
+
+    def cursor(self, name = None):
+        return StandInCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class StandInPool:
+    """the parts of database_interactor.ConnectionPool that _pooled_connection uses"""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def getconn(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return database_interactor._PooledConnection(StandInConnection(self._ids))
+
+    def putconn(self, pooled, broken = False):
+        with self._lock:
+            self._idle.append(pooled)
+
+    def closeall(self):
+        self._idle.clear()
+
+    def bytes_sent(self) -> int:
+        return sum(pooled.conn.bytes_sent for pooled in self._idle)
+
+
+def install() -> StandInPool:
+    """replaces the process-wide pool, every _pooled_connection() afterwards gets a stand-in connection"""
+    pool = StandInPool()
+    database_interactor._pool = pool
+    return pool
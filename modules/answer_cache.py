@@ -0,0 +1,202 @@
+from collections import OrderedDict
+import itertools
+import os
+import threading
+import time
+
+import numpy as np
+
+from modules import database_interactor, tracing
+
+"""semantic cache of /bedrock answers.
+a query whose embedding is within ANSWER_CACHE_THRESHOLD cosine similarity of a cached query with the
+same scope (user, search mode and filters) gets the cached answer, skipping the search and the model call.
+entries expire after ANSWER_CACHE_TTL seconds, the least recently used are evicted past ANSWER_CACHE_SIZE,
+and an entry is dropped as soon as new segments are ingested for its user: directly through
+batch_upload_embeddings in this process, or by comparing the newest created_at in postgres against the
+one recorded with the entry when the upload happened in another process."""
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+
+# get() fetches the watermark itself unless the caller passes one
+_FETCH = object()
+
+
+class _Entry:
+
+    def __init__(self, scope: tuple, vector: np.ndarray, answer, watermark):
+        self.scope = scope
+        self.vector = vector
+        self.answer = answer
+        self.watermark = watermark
+        self.created_at = time.monotonic()
+
+
+def _unit(embedding) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticAnswerCache:
+
+    def __init__(self, max_entries = ANSWER_CACHE_SIZE, ttl = ANSWER_CACHE_TTL, threshold = ANSWER_CACHE_THRESHOLD,
+                 watermark_fn = database_interactor.ingest_watermark):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.watermark_fn = watermark_fn
+
+        self._entries = OrderedDict()   # entry id -> _Entry, least recently used first
+        self._scopes = {}               # scope -> {entry id: _Entry}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.stale = 0
+        self.evictions = 0
+
+    @staticmethod
+    def scope(username = None, **params) -> tuple:
+        """the part of a request, besides the query, that an answer depends on"""
+        return (username, *sorted((key, str(value)) for key, value in params.items() if value is not None))
+
+    def _drop(self, entry_id) -> None:
+        entry = self._entries.pop(entry_id)
+        entries = self._scopes[entry.scope]
+        del entries[entry_id]
+        if not entries:
+            del self._scopes[entry.scope]
+
+    def _nearest(self, scope: tuple, vector: np.ndarray):
+        """(entry id, entry) of the most similar live query in scope above the threshold, or None"""
+        entries = self._scopes.get(scope)
+        if not entries:
+            return None
+
+        now = time.monotonic()
+        for entry_id in [entry_id for entry_id, entry in entries.items() if now - entry.created_at > self.ttl]:
+            self._drop(entry_id)
+            self.expired += 1
+
+        entries = self._scopes.get(scope)
+        if not entries:
+            return None
+
+        ids = list(entries)
+        similarities = np.stack([entries[entry_id].vector for entry_id in ids]) @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        return ids[best], entries[ids[best]]
+
+    def get(self, scope: tuple, embedding, watermark = _FETCH):
+        """the cached answer for a query similar to embedding, or None.
+        a caller that already fetched the scope's current watermark (e.g. concurrently with embedding
+        the query) passes it to skip the round trip"""
+        vector = _unit(embedding)
+
+        with self._lock:
+            found = self._nearest(scope, vector)
+            if found is None:
+                self.misses += 1
+                return None
+            entry_id, entry = found
+
+        # outside the lock, this is a round trip to postgres
+        if watermark is _FETCH:
+            watermark = self.watermark(scope)
+        if watermark != entry.watermark:
+            with self._lock:
+                if entry_id in self._entries:
+                    self._drop(entry_id)
+                self.stale += 1
+                self.misses += 1
+            return None
+
+        with self._lock:
+            if entry_id in self._entries:
+                self._entries.move_to_end(entry_id)
+            self.hits += 1
+        return entry.answer
+
+    def watermark(self, scope: tuple):
+        """call before searching, and pass the result to put, so rows ingested meanwhile invalidate the answer"""
+        return self.watermark_fn(scope[0]) if self.watermark_fn is not None else None
+
+    def put(self, scope: tuple, embedding, answer, watermark = None) -> None:
+        if self.max_entries <= 0:
+            return
+
+        entry = _Entry(scope, _unit(embedding), answer, watermark)
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = entry
+            self._scopes.setdefault(scope, {})[entry_id] = entry
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, usernames = None) -> None:
+        """drops every answer for usernames, and answers not scoped to a user since those cover everyone.
+        None drops everything"""
+        with self._lock:
+            if usernames is None:
+                self._entries.clear()
+                self._scopes.clear()
+                return
+
+            affected = set(usernames) | {None}
+            for scope in [scope for scope in self._scopes if scope[0] in affected]:
+                for entry_id in list(self._scopes[scope]):
+                    self._drop(entry_id)
+
+    def clear(self) -> None:
+        self.invalidate()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        """hit/miss counters for this process, every hit is a search and a model call saved"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "expired": self.expired,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "entries": len(self._entries)
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """returns the process-wide cache, or None when ANSWER_CACHE_ENABLED is off.
+    the cache subscribes to batch_upload_embeddings so uploads in this process invalidate it right away"""
+    global _cache
+
+    if not ANSWER_CACHE_ENABLED:
+        return None
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SemanticAnswerCache()
+                database_interactor.add_ingest_listener(_cache.invalidate)
+
+    return _cache
+
+
+tracing.register_gauges("answer_cache", lambda: _cache.stats() if _cache is not None else {})
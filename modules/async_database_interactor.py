@@ -0,0 +1,202 @@
+import asyncio
+from datetime import datetime
+
+import asyncpg
+
+from modules import database_interactor as db, search_cursor
+
+"""asyncio counterparts of the database_interactor searches, on an asyncpg pool.
+the SQL is the same (database_interactor's statements already use $n parameters), asyncpg prepares
+and caches each statement per connection. local SEARCH_BACKENDs run the synchronous search on a
+worker thread since they are CPU bound."""
+
+_pools = {}   # event loop -> pool, a pool can't be shared across loops
+
+
+async def _init_connection(conn) -> None:
+    # pgvector has no binary codec in asyncpg, exchange vectors in their text form
+    await conn.set_type_codec("vector", encoder=db._format_embedding, decoder=str, schema="public", format="text")
+
+
+async def get_pool() -> asyncpg.Pool:
+    """returns the pool for the running event loop, creating it on first use"""
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+
+    if pool is None:
+        pool = await asyncpg.create_pool(
+            **db.connection_settings(),
+            min_size=db.DB_POOL_MIN_SIZE,
+            max_size=db.DB_POOL_MAX_SIZE,
+            timeout=db.DB_POOL_TIMEOUT,
+            max_inactive_connection_lifetime=db.DB_CONN_MAX_IDLE,
+            init=_init_connection
+        )
+        _pools[loop] = pool
+
+    return pool
+
+
+async def close_pool() -> None:
+    pool = _pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.close()
+
+
+async def _scope_filtered_search(conn, filters: dict, limit = None) -> None:
+    """same as database_interactor._scope_filtered_search, must run inside a transaction"""
+    if not filters and limit is None:
+        return
+    if db.HNSW_ITERATIVE_SCAN != "off":
+        await conn.execute("SELECT set_config('hnsw.iterative_scan', $1, true)", db.HNSW_ITERATIVE_SCAN)
+    if limit is not None:
+        await conn.execute(
+            "SELECT set_config('hnsw.ef_search', GREATEST(COALESCE(current_setting('hnsw.ef_search', true)::int, 0), LEAST($1, 1000))::text, true)",
+            limit
+        )
+    if filters:
+        await conn.execute("SELECT set_config('plan_cache_mode', 'force_custom_plan', true)")
+
+
+def _rows(records, detailed = False) -> list[tuple[str, str, str, datetime]]:
+    if detailed:
+        return [{**dict(record), "embedding": db._parse_vector(record["embedding"])} for record in records]
+    return [(record["text_segment"], record["username"], record["speaker"], record["created_at"]) for record in records]
+
+
+async def similarity_search(query_embedding: list[float], start = 0, end = 5, username = None, speaker = None,
+                            start_time = None, end_time = None, detailed = False) -> list[tuple[str, str, str, datetime]]:
+    """async database_interactor.similarity_search"""
+    if db.SEARCH_BACKEND != "pgvector":
+        return await asyncio.to_thread(db.similarity_search, query_embedding, start, end, username, speaker, start_time, end_time, detailed)
+
+    filters = db._search_filters(username, speaker, start_time, end_time)
+    limit = end - start
+
+    if db._quantized() == "binary":
+        where, values = db._filter_sql(filters, 5)
+        statement = db.QUANTIZED_SEARCH_STATEMENT.format(filters=where)
+        params = [query_embedding, end * db.QUANTIZATION_CANDIDATES, limit, start, *values]
+    elif db._quantized() is None:
+        where, values = db._filter_sql(filters, 4)
+        statement = db.SIMILARITY_SEARCH_STATEMENT.format(filters=where)
+        params = [query_embedding, limit, start, *values]
+    else:
+        raise ValueError(f"pgvector backend does not support {db.SEARCH_QUANTIZATION} quantization")
+
+    async with (await get_pool()).acquire() as conn:
+        async with conn.transaction():
+            await _scope_filtered_search(conn, filters)
+            return _rows(await conn.fetch(statement, *params), detailed)
+
+
+async def ranked_candidates(query_embedding: list[float], limit: int, page_size: int, after = None, offset = 0,
+                            username = None, speaker = None, start_time = None, end_time = None) -> tuple[list[tuple[int, float]], list[dict]]:
+    """async database_interactor.ranked_candidates"""
+    if db.SEARCH_BACKEND != "pgvector":
+        return await asyncio.to_thread(db.ranked_candidates, query_embedding, limit, page_size, after, offset, username, speaker, start_time, end_time)
+
+    filters = db._search_filters(username, speaker, start_time, end_time)
+    where, values = db._filter_sql(filters, 6)
+    last_distance, last_id = after if after is not None else (-1.0, 0)
+
+    async with (await get_pool()).acquire() as conn:
+        async with conn.transaction():
+            await _scope_filtered_search(conn, filters, limit=limit)
+            records = await conn.fetch(
+                db.RANKED_CANDIDATES_STATEMENT.format(filters=where),
+                query_embedding, limit, float(last_distance), int(last_id), page_size, *values
+            )
+
+    ranked = [(record["id"], record["distance"]) for record in records]
+    page = [(record["id"], *tuple(record)[2:]) for record in records[:page_size] if record["text_segment"] is not None]
+    return ranked, db._search_rows(page, detailed=True)
+
+
+async def rows_by_id(row_ids: list[int]) -> list[dict]:
+    """async database_interactor.rows_by_id"""
+    if not row_ids or db.SEARCH_BACKEND != "pgvector":
+        return await asyncio.to_thread(db.rows_by_id, row_ids)
+
+    async with (await get_pool()).acquire() as conn:
+        records = await conn.fetch(db.ROWS_BY_ID_STATEMENT, list(row_ids))
+
+    rows = {row["id"]: row for row in _rows(records, detailed=True)}
+    return [rows[row_id] for row_id in row_ids if row_id in rows]
+
+
+async def search_page(query_embedding: list[float], cursor = None, page_size = 5, username = None, speaker = None,
+                      start_time = None, end_time = None, detailed = False) -> tuple[list, str]:
+    """async search_cursor.search_page, sharing its candidate cache"""
+    filters = {"username": username, "speaker": speaker, "start_time": start_time, "end_time": end_time}
+    plan = search_cursor.PagePlan(query_embedding, cursor, page_size, filters)
+
+    if plan.row_ids is not None:
+        return plan.finish(await rows_by_id(plan.row_ids), detailed=detailed)
+
+    ranked, page = await ranked_candidates(query_embedding, plan.limit, page_size, plan.after, plan.position, **filters)
+    return plan.finish(page, ranked, detailed)
+
+
+async def hybrid_search(query_text: str, query_embedding: list[float], k = 5, username = None, speaker = None,
+                        start_time = None, end_time = None, detailed = False) -> list[tuple[str, str, str, datetime]]:
+    """async database_interactor.hybrid_search"""
+    filters = db._search_filters(username, speaker, start_time, end_time)
+    where, values = db._filter_sql(filters, 6)
+
+    async with (await get_pool()).acquire() as conn:
+        async with conn.transaction():
+            await _scope_filtered_search(conn, filters)
+            return _rows(await conn.fetch(
+                db.HYBRID_SEARCH_STATEMENT.format(filters=where),
+                query_embedding, query_text, max(db.HYBRID_CANDIDATES, k), db.RRF_K, k, *values
+            ), detailed)
+
+
+async def timestamp_search(timestamp: datetime, before = 5, after = 5, username = None, speaker = None,
+                           start_time = None, end_time = None, detailed = False) -> list[tuple[str, str, str, datetime]]:
+    """async database_interactor.timestamp_search"""
+    where, values = db._filter_sql(db._search_filters(username, speaker, start_time, end_time), 4)
+
+    async with (await get_pool()).acquire() as conn:
+        records = await conn.fetch(db.TIMELINE_STATEMENT.format(filters=where), timestamp, abs(before), abs(after), *values)
+
+    return db._segment_rows([tuple(record) for record in records], detailed)
+
+
+async def expand_hits(hit_ids: list[int], window = 2, max_gap = 5.0) -> dict[int, list[dict]]:
+    """async database_interactor.expand_hits"""
+    hit_ids = list(dict.fromkeys(hit_id for hit_id in hit_ids if hit_id is not None))
+    window = max(window, 0)
+    if not hit_ids:
+        return {}
+
+    async with (await get_pool()).acquire() as conn:
+        records = await conn.fetch(db.EXPAND_HITS_STATEMENT, hit_ids, window, float(max_gap))
+
+    return db._hit_windows(tuple(record) for record in records)
+
+
+async def recent_segments(username = None, limit = 5, speaker = None) -> list[tuple[str, str, str, datetime]]:
+    """the newest segments for username, oldest first, read backwards off the (username, created_at) index"""
+    filters = db._search_filters(username, speaker)
+    where, values = db._filter_sql(filters, 2)
+
+    async with (await get_pool()).acquire() as conn:
+        records = await conn.fetch(f"""
+        SELECT text_segment, username, speaker, created_at
+        FROM embeddings
+        WHERE {where}
+        ORDER BY created_at DESC
+        LIMIT $1
+        """, limit, *values)
+
+    return list(reversed(_rows(records)))
+
+
+async def ingest_watermark(username = None):
+    """async database_interactor.ingest_watermark"""
+    async with (await get_pool()).acquire() as conn:
+        if username is None:
+            return await conn.fetchval("SELECT created_at FROM embeddings ORDER BY id DESC LIMIT 1")
+        return await conn.fetchval("SELECT MAX(created_at) FROM embeddings WHERE username = $1", username)
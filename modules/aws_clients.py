@@ -0,0 +1,171 @@
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from modules import tracing
+
+"""process-wide AWS clients.
+building a client resolves credentials, loads the service model and opens a new connection pool, so
+get_client() creates each (service, region, endpoint, options) client once and hands the same one to every
+caller. botocore clients are thread safe. a forked child starts with an empty registry since the parent's
+sockets can't be shared. every client counts its calls and the time they took, see stats().
+boto3 itself is imported on the first get_client(), importing this module is cheap."""
+
+load_dotenv()
+
+# connections kept open per client, should cover the callers' thread pools (EMBEDDING_MAX_WORKERS, INGEST_MAX_WORKERS, S3 transfers)
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "50"))
+AWS_TCP_KEEPALIVE = os.getenv("AWS_TCP_KEEPALIVE", "true").lower() in ("1", "true", "yes")
+# "adaptive" also rate limits the client after throttling responses, "standard" only retries
+AWS_RETRY_MODE = os.getenv("AWS_RETRY_MODE", "adaptive")
+AWS_MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", "5"))
+AWS_CONNECT_TIMEOUT = float(os.getenv("AWS_CONNECT_TIMEOUT", "10"))
+AWS_READ_TIMEOUT = float(os.getenv("AWS_READ_TIMEOUT", "60"))
+
+
+def client_config(**options):
+    """the shared botocore Config, options (any Config argument) take precedence"""
+    from botocore.config import Config
+
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=AWS_TCP_KEEPALIVE,
+        retries={"mode": AWS_RETRY_MODE, "max_attempts": AWS_MAX_ATTEMPTS},
+        connect_timeout=AWS_CONNECT_TIMEOUT,
+        read_timeout=AWS_READ_TIMEOUT
+    ).merge(Config(**options))
+
+
+class _ClientStats:
+    """call counts and latency of one client, fed by its before-call/after-call events"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def before_call(self, context = None, **kwargs) -> None:
+        if context is not None:
+            context["aws_clients_started"] = time.perf_counter()
+
+    def _finish(self, context, failed: bool) -> None:
+        started = (context or {}).get("aws_clients_started")
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        with self._lock:
+            self.calls += 1
+            self.errors += failed
+            self.seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def after_call(self, http_response = None, context = None, **kwargs) -> None:
+        self._finish(context, http_response is not None and http_response.status_code >= 300)
+
+    def after_call_error(self, context = None, **kwargs) -> None:
+        self._finish(context, True)
+
+    def snapshot(self) -> tuple[int, int, float, float]:
+        with self._lock:
+            return self.calls, self.errors, self.seconds, self.max_seconds
+
+
+_lock = threading.Lock()
+_session = None
+_clients = {}   # key -> (client, _ClientStats)
+
+
+def _get_session():
+    global _session
+
+    if _session is None:
+        import boto3
+
+        _session = boto3.session.Session()
+        tracing.instrument_boto3(_session)
+    return _session
+
+
+def _key(service_name: str, region_name, endpoint_url, options: dict) -> tuple:
+    return service_name, region_name, endpoint_url, tuple(sorted((name, repr(value)) for name, value in options.items()))
+
+
+def get_client(service_name: str, region_name = None, endpoint_url = None, **options):
+    """the shared client for service_name, created on first use.
+    options are botocore Config arguments on top of client_config(), e.g. signature_version="s3v4".
+    region_name None uses the default region (AWS_DEFAULT_REGION or the AWS config file)"""
+    key = _key(service_name, region_name, endpoint_url, options)
+    entry = _clients.get(key)
+    if entry is not None:
+        return entry[0]
+
+    with _lock:
+        entry = _clients.get(key)
+        if entry is None:
+            # sessions aren't thread safe, clients are created under the lock
+            client = _get_session().client(service_name, region_name=region_name, endpoint_url=endpoint_url, config=client_config(**options))
+            client_stats = _ClientStats()
+            client.meta.events.register("before-call", client_stats.before_call)
+            client.meta.events.register("after-call", client_stats.after_call)
+            client.meta.events.register("after-call-error", client_stats.after_call_error)
+            entry = _clients[key] = (client, client_stats)
+
+    return entry[0]
+
+
+def stats() -> dict[str, dict]:
+    """per client, named "service@region" plus its endpoint and options if any: calls, errors, mean_ms and max_ms.
+    clients that only differ in how their region was given are reported together"""
+    with _lock:
+        entries = list(_clients.items())
+
+    totals = {}
+    for (service_name, _, endpoint_url, options), (client, client_stats) in entries:
+        name = " ".join([
+            f"{service_name}@{client.meta.region_name}",
+            *([endpoint_url] if endpoint_url else []),
+            *(f"{option}={value}" for option, value in options)
+        ])
+        calls, errors, seconds, max_seconds = client_stats.snapshot()
+        total = totals.setdefault(name, [0, 0, 0.0, 0.0])
+        total[0] += calls
+        total[1] += errors
+        total[2] += seconds
+        total[3] = max(total[3], max_seconds)
+
+    return {
+        name: {
+            "calls": calls,
+            "errors": errors,
+            "mean_ms": round(seconds / calls * 1000, 2) if calls else 0.0,
+            "max_ms": round(max_seconds * 1000, 2)
+        }
+        for name, (calls, errors, seconds, max_seconds) in totals.items()
+    }
+
+
+def _totals() -> dict[str, int]:
+    totals = {"clients": len(_clients), "calls": 0, "errors": 0}
+    for snapshot in stats().values():
+        totals["calls"] += snapshot["calls"]
+        totals["errors"] += snapshot["errors"]
+    return totals
+
+
+def reset() -> None:
+    """drops every client, the next get_client() builds new ones"""
+    global _session, _lock
+
+    _lock = threading.Lock()
+    _session = None
+    _clients.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset)
+
+tracing.register_gauges("aws_clients", _totals)
@@ -0,0 +1,333 @@
+import argparse
+from contextlib import contextmanager
+from datetime import timedelta
+import re
+import time
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from modules import database_interactor, text_embedding
+
+"""re-embeds the whole embeddings table with another model or dimension, without reingesting from S3.
+
+    python -m modules.backfill run titan_v2_512 --model-id amazon.titan-embed-text-v2:0 --dim 512
+    python -m modules.backfill status
+    python -m modules.backfill swap titan_v2_512
+    python -m modules.backfill discard titan_v2_512
+
+run streams (id, text_segment) through a server-side named cursor in id order, embeds each batch with
+text_embedding.embed_texts (--concurrency requests in flight, retried when bedrock throttles) and writes the
+vectors into a shadow column, embedding_<name>, with one UPDATE per batch. the batch and its checkpoint
+(the last id written) commit together, so a killed run resumes with `run` where it stopped and never
+writes a row twice; rows that committed below the checkpoint afterwards are picked up by a second pass.
+searches keep using embedding meanwhile.
+swap catches up on rows ingested since, then in one transaction that blocks writers embeds whatever is
+still missing and renames embedding to embedding_before_<name> and the shadow column to embedding.
+vector indexes stay on the old column, rebuild them with schema_manager create-vector-index and set
+EMBEDDING_DIM to the new dimension before restarting the services, queries and new segments are then
+embedded at that size too."""
+
+TABLE = "embeddings"
+
+# rows still missing from the shadow column that swap will embed while writes are blocked
+SWAP_MAX_PENDING = 1000
+
+
+@contextmanager
+def _connection(autocommit = False):
+    """a dedicated connection, a backfill runs for longer than pooled connections live"""
+    conn = psycopg2.connect(**database_interactor.connection_settings())
+    conn.autocommit = autocommit
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def _shadow_column(name: str) -> str:
+    if not re.fullmatch(r"[a-z0-9_]{1,40}", name):
+        raise ValueError(f"backfill names are lowercase letters, digits and underscores: {name}")
+    return f"embedding_{name}"
+
+
+def _ensure_bookkeeping(cursor) -> None:
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS embedding_backfills (
+        name TEXT PRIMARY KEY,
+        model_id TEXT NOT NULL,
+        dim INTEGER NOT NULL,
+        last_id BIGINT NOT NULL DEFAULT 0,
+        rows_done BIGINT NOT NULL DEFAULT 0,
+        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        swapped_at TIMESTAMP
+    )
+    """)
+
+
+def _checkpoint(cursor, name: str):
+    """(model_id, dim, last_id, rows_done, swapped_at) of a backfill, or None"""
+    cursor.execute("SELECT model_id, dim, last_id, rows_done, swapped_at FROM embedding_backfills WHERE name = %s", (name,))
+    return cursor.fetchone()
+
+
+def _format_eta(seconds) -> str:
+    return str(timedelta(seconds=round(seconds))) if seconds is not None else "-"
+
+
+class Progress:
+    """rows/s over this run and the time left at that rate"""
+
+    def __init__(self, total: int, done = 0):
+        self.total = total
+        self.done = done
+        self.run_rows = 0
+        self.started = time.perf_counter()
+
+    def add(self, rows: int) -> None:
+        self.done += rows
+        self.run_rows += rows
+
+    def rate(self) -> float:
+        elapsed = time.perf_counter() - self.started
+        return self.run_rows / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        rate = self.rate()
+        return max(self.total - self.done, 0) / rate if rate else None
+
+    def __str__(self) -> str:
+        percent = self.done / self.total * 100 if self.total else 100.0
+        return f"{self.done}/{self.total} rows ({percent:.1f}%), {self.rate():.0f} rows/s, eta {_format_eta(self.eta())}"
+
+
+def _embed(texts: list[str], model_id: str, dim: int, concurrency: int) -> list[str]:
+    """embeddings for texts in pgvector's text form. models with a configurable size are asked for dim values,
+    ValueError if the model returns anything else"""
+    dimensions = dim if model_id in text_embedding.VARIABLE_DIMENSION_MODELS else None
+    embeddings = text_embedding.embed_texts(texts, model_id, max_workers=concurrency, dimensions=dimensions)
+    for embedding in embeddings:
+        if len(embedding) != dim:
+            raise ValueError(f"{model_id} returned {len(embedding)} dimensions, the shadow column has {dim}")
+    return [database_interactor._format_embedding(embedding) for embedding in embeddings]
+
+
+def _write_batch(cursor, column: str, rows: list[tuple[int, str]]) -> None:
+    execute_values(
+        cursor,
+        sql.SQL("""
+        UPDATE {table} SET {column} = batch.embedding::vector
+        FROM (VALUES %s) AS batch (id, embedding)
+        WHERE {table}.id = batch.id
+        """).format(table=sql.Identifier(TABLE), column=sql.Identifier(column)),
+        rows,
+        page_size=len(rows)
+    )
+
+
+def _missing(column: str, bound = ""):
+    """rows whose shadow column is still empty, bound ("id > %s" or "id <= %s") restricts them to one side of an id"""
+    condition = sql.SQL("{column} IS NULL").format(column=sql.Identifier(column))
+    if bound:
+        condition = sql.SQL(bound + " AND ") + condition
+    return sql.SQL("SELECT id, text_segment FROM {table} WHERE ").format(table=sql.Identifier(TABLE)) + condition
+
+
+def start(name: str, model_id: str, dim: int) -> None:
+    """records the backfill and adds its shadow column, a no-op when both exist with the same model and dim"""
+    column = _shadow_column(name)
+
+    with _connection(autocommit=True) as conn, conn.cursor() as cursor:
+        _ensure_bookkeeping(cursor)
+        checkpoint = _checkpoint(cursor, name)
+        if checkpoint is not None and (checkpoint[0], checkpoint[1]) != (model_id, dim):
+            raise ValueError(f"backfill {name} was started with {checkpoint[0]} ({checkpoint[1]} dimensions)")
+        if checkpoint is not None and checkpoint[4] is not None:
+            raise ValueError(f"backfill {name} was already swapped in at {checkpoint[4]}")
+
+        cursor.execute(sql.SQL("ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} vector({dim})").format(
+            table=sql.Identifier(TABLE), column=sql.Identifier(column), dim=sql.Literal(dim)
+        ))
+        cursor.execute(
+            "INSERT INTO embedding_backfills (name, model_id, dim) VALUES (%s, %s, %s) ON CONFLICT (name) DO NOTHING",
+            (name, model_id, dim)
+        )
+
+
+def run(name: str, model_id = "amazon.titan-embed-text-v2:0", dim = None, batch_size = 500, concurrency = None,
+        limit = None) -> int:
+    """embeds every row whose shadow column is still empty, resuming from the checkpoint.
+    limit stops after that many rows. returns the number of rows written by this run"""
+    dim = dim or database_interactor.EMBEDDING_DIM
+    concurrency = concurrency or text_embedding.EMBEDDING_MAX_WORKERS
+    column = _shadow_column(name)
+    start(name, model_id, dim)
+
+    with _connection() as reader, _connection() as writer:
+        with writer.cursor() as cursor:
+            _, _, last_id, rows_done, _ = _checkpoint(cursor, name)
+            cursor.execute(sql.SQL("SELECT COUNT(*) FROM ({missing}) pending").format(missing=_missing(column)))
+            pending = cursor.fetchone()[0]
+        writer.commit()
+
+        if limit is not None:
+            pending = min(pending, limit)
+        progress = Progress(rows_done + pending, rows_done)
+        print(f"backfill {name}: {pending} rows to embed with {model_id} from id {last_id}, {rows_done} done before")
+
+        # last_id only says where to resume. ids are handed out before the rows commit, so ingest workers can
+        # commit a row below the checkpoint after its batch was written: a second pass picks those up
+        for bound in ("id > %s", "id <= %s"):
+            # a named cursor keeps the result set on the server, each fetchmany is one batch
+            with reader.cursor(name=f"backfill_{name}") as rows:
+                rows.execute(_missing(column, bound) + sql.SQL(" ORDER BY id"), (last_id,))
+
+                while limit is None or progress.run_rows < limit:
+                    batch = rows.fetchmany(batch_size if limit is None else min(batch_size, limit - progress.run_rows))
+                    if not batch:
+                        break
+
+                    vectors = _embed([text for _, text in batch], model_id, dim, concurrency)
+                    with writer.cursor() as cursor:
+                        _write_batch(cursor, column, [(row_id, vector) for (row_id, _), vector in zip(batch, vectors)])
+                        cursor.execute(
+                            "UPDATE embedding_backfills SET last_id = GREATEST(last_id, %s), rows_done = rows_done + %s, "
+                            "updated_at = CURRENT_TIMESTAMP WHERE name = %s",
+                            (batch[-1][0], len(batch), name)
+                        )
+                    writer.commit()
+
+                    progress.add(len(batch))
+                    print(progress)
+            reader.commit()
+
+    return progress.run_rows
+
+
+def swap(name: str, batch_size = 500, concurrency = None, max_pending = SWAP_MAX_PENDING) -> None:
+    """makes the shadow column the embedding column, keeping the old one as embedding_before_<name>"""
+    column = _shadow_column(name)
+
+    with _connection(autocommit=True) as conn, conn.cursor() as cursor:
+        _ensure_bookkeeping(cursor)
+        checkpoint = _checkpoint(cursor, name)
+    if checkpoint is None:
+        raise ValueError(f"no backfill named {name}")
+    model_id, dim, _, _, swapped_at = checkpoint
+    if swapped_at is not None:
+        raise ValueError(f"backfill {name} was already swapped in at {swapped_at}")
+
+    # most rows ingested since the last run are embedded before writes are blocked
+    run(name, model_id, dim, batch_size, concurrency)
+
+    with _connection() as conn:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL("LOCK TABLE {table} IN EXCLUSIVE MODE").format(table=sql.Identifier(TABLE)))
+                # no id bound: with writers blocked, every row still missing a vector is visible here
+                cursor.execute(_missing(column) + sql.SQL(" ORDER BY id"))
+                missing = cursor.fetchall()
+                if len(missing) > max_pending:
+                    raise RuntimeError(f"{len(missing)} rows are still missing, run the backfill again before swapping")
+
+                for i in range(0, len(missing), batch_size):
+                    batch = missing[i:i + batch_size]
+                    vectors = _embed([text for _, text in batch], model_id, dim, concurrency or text_embedding.EMBEDDING_MAX_WORKERS)
+                    _write_batch(cursor, column, [(row_id, vector) for (row_id, _), vector in zip(batch, vectors)])
+
+                cursor.execute(sql.SQL("ALTER TABLE {table} RENAME COLUMN embedding TO {previous}").format(
+                    table=sql.Identifier(TABLE), previous=sql.Identifier(f"embedding_before_{name}")
+                ))
+                cursor.execute(sql.SQL("ALTER TABLE {table} RENAME COLUMN {column} TO embedding").format(
+                    table=sql.Identifier(TABLE), column=sql.Identifier(column)
+                ))
+                cursor.execute(
+                    "UPDATE embedding_backfills SET rows_done = rows_done + %s, swapped_at = CURRENT_TIMESTAMP WHERE name = %s",
+                    (len(missing), name)
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    print(f"embedding now holds {model_id} ({dim} dimensions), the old vectors are in embedding_before_{name}")
+    print(f"set EMBEDDING_DIM={dim}, rebuild vector indexes (schema_manager create-vector-index) and local indexes, then VACUUM {TABLE}")
+
+
+def discard(name: str) -> None:
+    """drops an unswapped backfill's shadow column and checkpoint"""
+    column = _shadow_column(name)
+
+    with _connection(autocommit=True) as conn, conn.cursor() as cursor:
+        _ensure_bookkeeping(cursor)
+        checkpoint = _checkpoint(cursor, name)
+        if checkpoint is not None and checkpoint[4] is not None:
+            raise ValueError(f"backfill {name} was swapped in, embedding_before_{name} has to be dropped by hand")
+        cursor.execute(sql.SQL("ALTER TABLE {table} DROP COLUMN IF EXISTS {column}").format(
+            table=sql.Identifier(TABLE), column=sql.Identifier(column)
+        ))
+        cursor.execute("DELETE FROM embedding_backfills WHERE name = %s", (name,))
+
+
+def status() -> list[dict]:
+    """every backfill with its progress, pending counts the rows whose shadow column is still empty"""
+    with _connection(autocommit=True) as conn, conn.cursor() as cursor:
+        _ensure_bookkeeping(cursor)
+        cursor.execute("SELECT name, model_id, dim, last_id, rows_done, started_at, updated_at, swapped_at FROM embedding_backfills ORDER BY started_at")
+        backfills = [
+            dict(zip(("name", "model_id", "dim", "last_id", "rows_done", "started_at", "updated_at", "swapped_at"), row))
+            for row in cursor.fetchall()
+        ]
+
+        for backfill in backfills:
+            backfill["pending"] = 0
+            if backfill["swapped_at"] is None:
+                cursor.execute(sql.SQL("SELECT COUNT(*) FROM ({missing}) pending").format(missing=_missing(_shadow_column(backfill["name"]))))
+                backfill["pending"] = cursor.fetchone()[0]
+
+    return backfills
+
+
+def main(argv = None) -> None:
+    parser = argparse.ArgumentParser(description="re-embed the embeddings table into a shadow column and swap it in")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="start or resume a backfill")
+    run_parser.add_argument("name", help="names the checkpoint and the shadow column, embedding_<name>")
+    run_parser.add_argument("--model-id", default="amazon.titan-embed-text-v2:0")
+    run_parser.add_argument("--dim", type=int, default=None, help="dimensions the model returns, defaults to EMBEDDING_DIM")
+    run_parser.add_argument("--batch-size", type=int, default=500)
+    run_parser.add_argument("--concurrency", type=int, default=None, help="bedrock requests in flight, defaults to EMBEDDING_MAX_WORKERS")
+    run_parser.add_argument("--limit", type=int, default=None, help="stop after this many rows")
+
+    swap_parser = commands.add_parser("swap", help="catch up and make the shadow column the embedding column")
+    swap_parser.add_argument("name")
+    swap_parser.add_argument("--batch-size", type=int, default=500)
+    swap_parser.add_argument("--concurrency", type=int, default=None)
+    swap_parser.add_argument("--max-pending", type=int, default=SWAP_MAX_PENDING,
+                             help="most rows to embed while writes are blocked")
+
+    discard_parser = commands.add_parser("discard", help="drop a backfill's shadow column and checkpoint")
+    discard_parser.add_argument("name")
+
+    commands.add_parser("status", help="progress of every backfill")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        written = run(args.name, args.model_id, args.dim, args.batch_size, args.concurrency, args.limit)
+        print(f"embedded {written} row(s)")
+    elif args.command == "swap":
+        swap(args.name, args.batch_size, args.concurrency, args.max_pending)
+    elif args.command == "discard":
+        discard(args.name)
+    elif args.command == "status":
+        for backfill in status():
+            state = f"swapped {backfill['swapped_at']:%Y-%m-%d %H:%M}" if backfill["swapped_at"] else f"{backfill['pending']} pending"
+            print(f"{backfill['name']:<24} {backfill['model_id']} ({backfill['dim']})  {backfill['rows_done']} done, {state}, last id {backfill['last_id']}")
+
+
+if __name__ == "__main__":
+    main()
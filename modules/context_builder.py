@@ -0,0 +1,197 @@
+from datetime import datetime
+import math
+import os
+
+import numpy as np
+
+"""assembles retrieved segments into the prompt context.
+candidates come from similarity_search/hybrid_search with detailed=True, best first. the builder
+    1. drops near-duplicates (cosine similarity >= CONTEXT_DEDUP_THRESHOLD to a better-ranked segment)
+    2. orders the rest by maximal marginal relevance, trading relevance to the query against
+       similarity to what is already selected (CONTEXT_MMR_LAMBDA, 1.0 is pure relevance)
+    3. packs segments in that order until CONTEXT_TOKEN_BUDGET, or the size of the previous top-5 prompt if
+       that is smaller, is used up. with windows from database_interactor.expand_hits (CONTEXT_EXPAND_WINDOW
+       above 0), each hit comes with up to that many neighbours either side from its recording, or alone when
+       the whole window doesn't fit
+    4. merges segments that are adjacent in the same recording (consecutive ids, same user and speaker,
+       uploaded within CONTEXT_MERGE_GAP seconds) under a single header
+token counts are estimated at CHARS_PER_TOKEN characters per token, there is no local tokenizer for the model."""
+
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "20"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "600"))
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.95"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+CONTEXT_MERGE_GAP = float(os.getenv("CONTEXT_MERGE_GAP", "5"))
+# segments fetched either side of each hit, 0 sends the hits alone and skips the lookup
+CONTEXT_EXPAND_WINDOW = int(os.getenv("CONTEXT_EXPAND_WINDOW", "0"))
+
+CHARS_PER_TOKEN = 4
+# the prompt used to paste the top 5 similarity_search rows in full, stats are measured against that
+BASELINE_TOP_K = 5
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def _unit_rows(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+def _header(segment: dict) -> str:
+    created_at = segment["created_at"].strftime('%Y-%m-%d %H:%M') if segment["created_at"] else "unknown time"
+    return f"[{created_at}] {segment['speaker'] or 'unknown speaker'}: "
+
+
+def _format(group: list[dict]) -> str:
+    return _header(group[0]) + " ".join(segment["text_segment"] for segment in group)
+
+
+def format_rows(rows) -> str:
+    """(text_segment, username, speaker, created_at) rows, e.g. from timestamp_search, one line each"""
+    return "\n".join(
+        _format([{"text_segment": text_segment, "speaker": speaker, "created_at": created_at}])
+        for text_segment, _, speaker, created_at in rows
+    )
+
+
+def _baseline_tokens(candidates: list[dict]) -> int:
+    """tokens the previous prompt spent on matches: the top BASELINE_TOP_K rows, fields joined by spaces"""
+    return estimate_tokens(" | ".join(
+        " ".join(
+            segment[key].strftime('%Y-%m-%d %H:%M:%S') if isinstance(segment[key], datetime) else str(segment[key])
+            for key in ("text_segment", "username", "speaker", "created_at")
+        )
+        for segment in candidates[:BASELINE_TOP_K]
+    ))
+
+
+def deduplicate(segments: list[dict], vectors: np.ndarray, threshold = CONTEXT_DEDUP_THRESHOLD) -> list[int]:
+    """indexes of segments to keep, in rank order, dropping any too similar to a better-ranked kept one"""
+    kept = []
+    seen_texts = set()
+
+    for i, segment in enumerate(segments):
+        text = " ".join(segment["text_segment"].lower().split())
+        if text in seen_texts:
+            continue
+        if kept and float(np.max(vectors[kept] @ vectors[i])) >= threshold:
+            continue
+        kept.append(i)
+        seen_texts.add(text)
+
+    return kept
+
+
+def mmr_order(query: np.ndarray, vectors: np.ndarray, candidates: list[int], lambda_ = CONTEXT_MMR_LAMBDA) -> list[int]:
+    """candidates reordered by maximal marginal relevance"""
+    relevance = vectors @ query
+    remaining = list(candidates)
+    selected = []
+    redundancy = np.full(len(vectors), -np.inf, dtype=np.float32)
+
+    while remaining:
+        scores = [
+            lambda_ * relevance[i] - (1 - lambda_) * (redundancy[i] if selected else 0.0)
+            for i in remaining
+        ]
+        best = remaining.pop(int(np.argmax(scores)))
+        selected.append(best)
+        redundancy = np.maximum(redundancy, vectors @ vectors[best])
+
+    return selected
+
+
+def _adjacent(previous: dict, segment: dict, merge_gap: float) -> bool:
+    if previous["username"] != segment["username"] or previous["speaker"] != segment["speaker"]:
+        return False
+    if previous.get("id") is None or segment.get("id") is None or segment["id"] - previous["id"] != 1:
+        return False
+    if previous["created_at"] is None or segment["created_at"] is None:
+        return previous["created_at"] is segment["created_at"]
+    return abs((segment["created_at"] - previous["created_at"]).total_seconds()) <= merge_gap
+
+
+def merge_adjacent(segments: list[dict], merge_gap = CONTEXT_MERGE_GAP) -> list[list[dict]]:
+    """groups runs of consecutive segments from one recording, each group placed where its best-ranked member was"""
+    groups = []
+    group_of = {}
+
+    for segment in sorted(segments, key=lambda segment: (segment.get("id") is None, segment.get("id") or 0)):
+        previous = groups[-1][-1] if groups else None
+        if previous is not None and _adjacent(previous, segment, merge_gap):
+            groups[-1].append(segment)
+        else:
+            groups.append([segment])
+        group_of[id(segment)] = len(groups) - 1
+
+    order = []
+    for segment in segments:
+        group = group_of[id(segment)]
+        if group not in order:
+            order.append(group)
+    return [groups[group] for group in order]
+
+
+def build_context(query_embedding, candidates: list[dict], token_budget = CONTEXT_TOKEN_BUDGET,
+                  dedup_threshold = CONTEXT_DEDUP_THRESHOLD, mmr_lambda = CONTEXT_MMR_LAMBDA,
+                  merge_gap = CONTEXT_MERGE_GAP, windows = None) -> tuple[str, dict]:
+    """returns the context text and stats comparing it with the previous prompt, which pasted the top
+    BASELINE_TOP_K candidates in full. the context is never given more tokens than that prompt used.
+    candidates are dicts with text_segment, embedding, username, speaker, created_at and id, best first.
+    windows maps a candidate's id to its surrounding segments, oldest first, see database_interactor.expand_hits"""
+    baseline_tokens = _baseline_tokens(candidates)
+    token_budget = min(token_budget, baseline_tokens)
+
+    stats = {
+        "candidates": len(candidates),
+        "duplicates": 0,
+        "selected": 0,
+        "expanded": 0,
+        "merged": 0,
+        "baseline_tokens": baseline_tokens,
+        "context_tokens": 0,
+        "tokens_saved": baseline_tokens
+    }
+    if not candidates:
+        return "", stats
+
+    vectors = _unit_rows([segment["embedding"] for segment in candidates])
+    query = _unit_rows([query_embedding])[0]
+
+    kept = deduplicate(candidates, vectors, dedup_threshold)
+    stats["duplicates"] = len(candidates) - len(kept)
+
+    # a segment that doesn't fit is skipped, a shorter one further down may still fit
+    selected = []
+    selected_ids = set()
+    used = 0
+    for i in mmr_order(query, vectors, kept, mmr_lambda):
+        hit = candidates[i]
+        window = [
+            hit if segment["id"] == hit.get("id") else segment
+            for segment in (windows or {}).get(hit.get("id"), [])
+        ]
+        for segments in ([window, [hit]] if window else [[hit]]):
+            new = [segment for segment in segments if segment.get("id") is None or segment["id"] not in selected_ids]
+            if not new:
+                # already in as part of a better-ranked hit's window
+                break
+            cost = sum(estimate_tokens(_format([segment])) + 1 for segment in new)
+            if used + cost <= token_budget:
+                selected.extend(new)
+                selected_ids.update(segment["id"] for segment in new if segment.get("id") is not None)
+                stats["expanded"] += sum(segment is not hit for segment in new)
+                used += cost
+                break
+
+    groups = merge_adjacent(selected, merge_gap)
+    context = "\n".join(_format(group) for group in groups)
+
+    stats["selected"] = len(selected)
+    stats["merged"] = len(selected) - len(groups)
+    stats["context_tokens"] = estimate_tokens(context)
+    stats["tokens_saved"] = baseline_tokens - stats["context_tokens"]
+    return context, stats
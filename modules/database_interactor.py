@@ -1,42 +1,318 @@
 import psycopg2
 from psycopg2.extras import execute_values
+from contextlib import contextmanager
 from datetime import datetime
 from dotenv import load_dotenv
 import os
+import threading
+import time
+
+from modules import tracing
 
 """embedding schema:
 CREATE TABLE embeddings (
     id SERIAL PRIMARY KEY,
     text_segment TEXT NOT NULL,
-    embedding vector(1024),  
+    embedding vector(1024),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
 	username TEXT NOT NULL,
-	speaker TEXT
-);"""
+	speaker TEXT,
+    text_search tsvector GENERATED ALWAYS AS (to_tsvector('english', text_segment)) STORED,
+    recording TEXT
+);
+CREATE INDEX embeddings_text_search_idx ON embeddings USING GIN (text_search);
+CREATE INDEX embeddings_recording_id_idx ON embeddings (recording, id);
+migrations, vector/timestamp indexes and partitioning are managed by modules/schema_manager.py"""
 
 load_dotenv()
 
-DB_HOST = os.getenv("DB_HOST")
-DB_NAME = os.getenv("DB_NAME")
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
-DB_PORT = int(os.getenv("SQL_PORT"))
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_CONN_MAX_LIFETIME = float(os.getenv("DB_CONN_MAX_LIFETIME", "1800"))
+DB_CONN_MAX_IDLE = float(os.getenv("DB_CONN_MAX_IDLE", "60"))
 
-def _execute_retrieve_query(query: str, *args) -> list[tuple[str, list[float], str, str, datetime]]:
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        port=DB_PORT
-    )
+# "pgvector" ranks inside postgres. "hnsw" (approximate) and "exact" (memmap brute force) answer
+# similarity_search from an in-process index that batch_upload_embeddings keeps up to date
+# and persists under LOCAL_INDEX_PATH
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "pgvector").lower()
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".cache", SEARCH_BACKEND))
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "1024"))
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+EXACT_SEGMENT_ROWS = int(os.getenv("EXACT_SEGMENT_ROWS", "100000"))
+EXACT_MAX_SEGMENTS = int(os.getenv("EXACT_MAX_SEGMENTS", "8"))
+
+# "binary" or "int8" ranks compact codes first and reranks the top k * QUANTIZATION_CANDIDATES
+# with full vectors. pgvector supports "binary" (binary_quantize), the exact backend supports both
+SEARCH_QUANTIZATION = os.getenv("SEARCH_QUANTIZATION", "none").lower()
+QUANTIZATION_CANDIDATES = int(os.getenv("QUANTIZATION_CANDIDATES", "10"))
+
+# how many hits each side of a hybrid search contributes, and the reciprocal rank fusion constant
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# pgvector 0.8+ keeps scanning the HNSW index until a filtered query has enough rows,
+# "strict_order", "relaxed_order" or "off" for older pgvector versions
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "strict_order").lower()
+
+
+class _PooledConnection:
+    """a psycopg2 connection plus the bookkeeping the pool needs"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.prepared = set()
+
+
+class ConnectionPool:
+    """thread-safe psycopg2 connection pool.
+    connections idle for longer than max_idle are pinged before reuse,
+    connections older than max_lifetime are closed and replaced,
+    and a forked child drops the parent's sockets instead of sharing them."""
+
+    def __init__(self, min_size = 1, max_size = 10, timeout = 30.0, max_lifetime = 1800.0, max_idle = 60.0, **connect_kwargs):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.connect_kwargs = connect_kwargs
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = []
+        self._size = 0
+        self._pid = os.getpid()
+
+    def _connect(self) -> _PooledConnection:
+        return _PooledConnection(psycopg2.connect(**self.connect_kwargs))
+
+    def _discard(self, pooled: _PooledConnection) -> None:
+        try:
+            pooled.conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _expired(self, pooled: _PooledConnection) -> bool:
+        return self.max_lifetime and time.monotonic() - pooled.created_at > self.max_lifetime
+
+    def _healthy(self, pooled: _PooledConnection) -> bool:
+        if pooled.conn.closed:
+            return False
+
+        if time.monotonic() - pooled.last_used < self.max_idle:
+            return True
+
+        try:
+            with pooled.conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            pooled.conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _check_fork(self) -> None:
+        """called with the lock held. sockets inherited from the parent must never be used
+        (or closed, which would send a terminate message on the parent's session)"""
+        if self._pid != os.getpid():
+            self._idle = []
+            self._size = 0
+            self._pid = os.getpid()
+
+    def reset(self) -> None:
+        """forgets every connection without closing it, used in a freshly forked child"""
+        with self._lock:
+            self._idle = []
+            self._size = 0
+            self._pid = os.getpid()
+
+    def getconn(self) -> _PooledConnection:
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            with self._available:
+                self._check_fork()
+
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"no database connection available after {self.timeout}s")
+                    self._available.wait(remaining)
+                    self._check_fork()
+
+                pooled = self._idle.pop() if self._idle else None
+                if pooled is None:
+                    self._size += 1
+
+            if pooled is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._available:
+                        self._size -= 1
+                        self._available.notify()
+                    raise
+
+            if not self._expired(pooled) and self._healthy(pooled):
+                return pooled
+
+            self._discard(pooled)
+            with self._available:
+                self._size -= 1
+                self._available.notify()
+
+    def putconn(self, pooled: _PooledConnection, broken = False) -> None:
+        with self._available:
+            if self._pid != os.getpid():
+                return
+
+            if not broken and not pooled.conn.closed:
+                try:
+                    if pooled.conn.status != psycopg2.extensions.STATUS_READY:
+                        pooled.conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+
+            if broken or pooled.conn.closed or self._expired(pooled):
+                self._size -= 1
+                self._available.notify()
+                discard = True
+            else:
+                pooled.last_used = time.monotonic()
+                self._idle.append(pooled)
+                self._available.notify()
+                discard = False
+
+        if discard:
+            self._discard(pooled)
+
+    def fill(self) -> None:
+        """opens connections until min_size are idle"""
+        while True:
+            with self._lock:
+                self._check_fork()
+                if len(self._idle) >= self.min_size or self._size >= self.max_size:
+                    return
+                self._size += 1
+            try:
+                pooled = self._connect()
+            except Exception:
+                with self._available:
+                    self._size -= 1
+                    self._available.notify()
+                raise
+            self.putconn(pooled)
+
+    def closeall(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for pooled in idle:
+            self._discard(pooled)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "max_size": self.max_size
+            }
+
+
+def connection_settings() -> dict:
+    """postgres connection arguments (DB_HOST, DB_NAME, DB_USER, DB_PASSWORD, SQL_PORT), read when
+    the first connection is made rather than at import, so importing this module needs no database config"""
+    load_dotenv()
+    return {
+        "host": os.getenv("DB_HOST"),
+        "database": os.getenv("DB_NAME"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+        "port": int(os.getenv("SQL_PORT", "5432"))
+    }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """returns the process-wide connection pool, creating it on first use"""
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_lifetime=DB_CONN_MAX_LIFETIME,
+                    max_idle=DB_CONN_MAX_IDLE,
+                    **connection_settings()
+                )
+
+    return _pool
+
+
+def _reset_pool_after_fork() -> None:
+    global _pool_lock
+
+    _pool_lock = threading.Lock()
+    if _pool is not None:
+        _pool._lock = threading.Lock()
+        _pool._available = threading.Condition(_pool._lock)
+        _pool.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
+
+tracing.register_gauges("db_pool", lambda: _pool.stats() if _pool is not None else {})
 
-    cursor = conn.cursor()
 
-    cursor.execute(query, *args)
-    results = cursor.fetchall()
-    cursor.close()
-    conn.close()
+@contextmanager
+def _pooled_connection():
+    """checks a connection out of the pool, commits on success and rolls back on error"""
+    pool = get_pool()
+    with tracing.span("db.pool_wait"):
+        pooled = pool.getconn()
+    broken = False
+
+    try:
+        yield pooled
+        pooled.conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        pooled.conn.rollback()
+        raise
+    finally:
+        pool.putconn(pooled, broken=broken)
+
+
+def _prepare(pooled: _PooledConnection, cursor, name: str, statement: str) -> None:
+    """creates a server-side prepared statement once per connection"""
+    if name not in pooled.prepared:
+        cursor.execute(f"PREPARE {name} AS {statement}")
+        pooled.prepared.add(name)
+
+
+def _format_embedding(embedding: list[float]) -> str:
+    return f'[{",".join(map(str, embedding))}]'
+
+
+def _execute_retrieve_query(query: str, *args) -> list[tuple[str, list[float], str, str, datetime]]:
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            cursor.execute(query, *args)
+            results = cursor.fetchall()
 
     formatted_results = [
         (text_segment, username, speaker, created_at)
@@ -46,77 +322,714 @@ def _execute_retrieve_query(query: str, *args) -> list[tuple[str, list[float], s
     return formatted_results
 
 
-def batch_upload_embeddings(embedding_data: list[tuple[str, list[float], str, str]]) -> None:
-    """uploads a batch of embeddings to the database
-    each element in the list will be (embedded text, list that represents embedding, user, speaker)
-    e.g. [("sentence", [1, 2, 3, 4], "test_user", "speaker1")]"""
+_local_index_lock = threading.Lock()
+_local_index_state = {"index": None, "version": None}
+
+
+def _local_index_class():
+    if SEARCH_BACKEND == "hnsw":
+        from modules.hnsw_index import HNSWIndex
+        return HNSWIndex
+
+    if SEARCH_BACKEND == "exact":
+        from modules.exact_index import ExactIndex
+        return ExactIndex
+
+    raise ValueError(f"unknown SEARCH_BACKEND: {SEARCH_BACKEND}")
+
+
+def _open_local_index(empty = False):
+    index_class = _local_index_class()
+
+    if SEARCH_BACKEND == "exact":
+        index = index_class.open(LOCAL_INDEX_PATH, EMBEDDING_DIM, segment_rows=EXACT_SEGMENT_ROWS, max_segments=EXACT_MAX_SEGMENTS)
+        if empty:
+            index.clear()
+        return index
+
+    if empty or index_class.saved_version(LOCAL_INDEX_PATH) is None:
+        return index_class(EMBEDDING_DIM, M=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, ef_search=HNSW_EF_SEARCH)
+    return index_class.load(LOCAL_INDEX_PATH, ef_search=HNSW_EF_SEARCH)
+
+
+def _local_index():
+    """returns the in-process index for SEARCH_BACKEND, catching up whenever another process has saved
+    changes: hnsw applies just the new log records and exact reads just the new rows, a full reload
+    only happens when refresh() can't catch up"""
+    index_class = _local_index_class()
+
+    with _local_index_lock:
+        version = index_class.saved_version(LOCAL_INDEX_PATH)
+        index = _local_index_state["index"]
+
+        if index is None or (version is not None and version != _local_index_state["version"]):
+            if index is None or not index.refresh(LOCAL_INDEX_PATH):
+                _local_index_state["index"] = _open_local_index()
+            _local_index_state["version"] = version
+
+        return _local_index_state["index"]
 
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
 
-    cursor = conn.cursor()
+def _save_local_index(index) -> None:
+    with _local_index_lock:
+        # the exact index already committed its manifest in add() and remove()
+        if SEARCH_BACKEND != "exact":
+            index.save(LOCAL_INDEX_PATH)
+        _local_index_state["version"] = index.saved_version(LOCAL_INDEX_PATH)
+
+
+def rebuild_local_index(batch_size = 5000) -> int:
+    """builds the SEARCH_BACKEND index from every row in postgres, returns the number of rows indexed"""
+    index = _open_local_index(empty=True)
+
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor(name="rebuild_local_index") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute("SELECT id, embedding::real[], text_segment, username, speaker, created_at FROM embeddings ORDER BY id")
+
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                index.add(
+                    [row[0] for row in batch],
+                    [row[1] for row in batch],
+                    [row[2:] for row in batch]
+                )
+
+    with _local_index_lock:
+        _local_index_state["index"] = index
+    _save_local_index(index)
+
+    return len(index)
+
+
+_ingest_listeners = []
+
+
+def add_ingest_listener(listener) -> None:
+    """listener(usernames) is called after rows for those users are uploaded in this process,
+    and listener(None) after rows are deleted"""
+    _ingest_listeners.append(listener)
+
+
+def _notify_ingest(usernames) -> None:
+    for listener in _ingest_listeners:
+        listener(usernames)
+
+
+@tracing.traced("db.ingest_watermark")
+def ingest_watermark(username = None):
+    """created_at of the newest row for username (or of any row), changes whenever that user's data grows.
+    served from the (username, created_at) index and the primary key"""
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            if username is None:
+                cursor.execute("SELECT created_at FROM embeddings ORDER BY id DESC LIMIT 1")
+            else:
+                cursor.execute("SELECT MAX(created_at) FROM embeddings WHERE username = %s", (username,))
+            row = cursor.fetchone()
+
+    return row[0] if row else None
+
+
+@tracing.traced("db.batch_upload_embeddings")
+def batch_upload_embeddings(embedding_data: list[tuple[str, list[float], str, str]], recording = None) -> None:
+    """uploads a batch of embeddings to the database
+    each element in the list will be (embedded text, list that represents embedding, user, speaker)
+    e.g. [("sentence", [1, 2, 3, 4], "test_user", "speaker1")]
+    recording names the transcript the batch was segmented from (e.g. its S3 key), expand_hits groups by it"""
 
     formatted_data = [
-        (text, f'[{",".join(map(str, embedding))}]', username, speaker)
+        (text, _format_embedding(embedding), username, speaker, recording)
         for text, embedding, username, speaker in embedding_data
     ]
 
     sql = """
-    INSERT INTO embeddings (text_segment, embedding, username, speaker)
+    INSERT INTO embeddings (text_segment, embedding, username, speaker, recording)
     VALUES %s
+    RETURNING id, created_at
     """
 
-    execute_values(cursor, sql, formatted_data)
-    conn.commit()
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            inserted = execute_values(cursor, sql, formatted_data, fetch=True)
+
+    if SEARCH_BACKEND != "pgvector" and inserted:
+        index = _local_index()
+        index.add(
+            [row_id for row_id, _ in inserted],
+            [embedding for _, embedding, _, _ in embedding_data],
+            [
+                (text, username, speaker, created_at)
+                for (text, _, username, speaker), (_, created_at) in zip(embedding_data, inserted)
+            ]
+        )
+        _save_local_index(index)
+
+    if inserted:
+        _notify_ingest({username for _, _, username, _ in embedding_data})
+
+
+@tracing.traced("db.delete_embeddings")
+def delete_embeddings(row_ids: list[int]) -> None:
+    """deletes rows by id from the database and from the local index if one is in use"""
+    if not row_ids:
+        return
+
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            cursor.execute("DELETE FROM embeddings WHERE id = ANY(%s)", (list(row_ids),))
 
-    cursor.close()
-    conn.close()
+    if SEARCH_BACKEND != "pgvector":
+        index = _local_index()
+        index.remove(row_ids)
+        _save_local_index(index)
 
-def similarity_search(query_embedding: list[float], start = 0, end = 5) -> list[tuple[str, list[float], str, str, datetime]]:
+    _notify_ingest(None)
+
+
+def _search_filters(username = None, speaker = None, start_time = None, end_time = None) -> dict:
+    """the filters that were given, in a fixed order so equal filter sets share a prepared statement"""
+    filters = {"username": username, "speaker": speaker, "start_time": start_time, "end_time": end_time}
+    return {column: value for column, value in filters.items() if value is not None}
+
+
+_FILTER_CONDITIONS = {
+    "username": "username = {}",
+    "speaker": "speaker = {}",
+    "start_time": "created_at >= {}",
+    "end_time": "created_at < {}"
+}
+
+
+def _filter_sql(filters: dict, first_param = None) -> tuple[str, list]:
+    """AND-ed conditions for filters, numbered $first_param, $first_param + 1, ... for prepared statements
+    or %s placeholders when first_param is None. "TRUE" when there are no filters"""
+    conditions = []
+    for i, column in enumerate(filters):
+        placeholder = "%s" if first_param is None else f"${first_param + i}"
+        conditions.append(_FILTER_CONDITIONS[column].format(placeholder))
+    return " AND ".join(conditions) or "TRUE", list(filters.values())
+
+
+def _statement_name(name: str, filters: dict) -> str:
+    return "_".join([name, *filters])
+
+
+def _scope_filtered_search(cursor, filters: dict, limit = None) -> None:
+    """for the current transaction only: let HNSW scans continue past rows the filters reject, and plan with
+    the actual parameter values so per-user partial indexes can be chosen.
+    limit is for queries that need that many rows from the index even unfiltered: an HNSW scan yields at most
+    hnsw.ef_search rows without an iterative scan, so ef_search is raised to limit as well"""
+    if not filters and limit is None:
+        return
+    if HNSW_ITERATIVE_SCAN != "off":
+        cursor.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", (HNSW_ITERATIVE_SCAN,))
+    if limit is not None:
+        cursor.execute(
+            "SELECT set_config('hnsw.ef_search', GREATEST(COALESCE(current_setting('hnsw.ef_search', true)::int, 0), LEAST(%s, 1000))::text, true)",
+            (limit,)
+        )
+    if filters:
+        cursor.execute("SELECT set_config('plan_cache_mode', 'force_custom_plan', true)")
+
+
+def _row_filter(filters: dict):
+    """the same filters for local backends, as a predicate over (text_segment, username, speaker, created_at)"""
+    if not filters:
+        return None
+
+    def accept(row) -> bool:
+        _, username, speaker, created_at = row
+        if "username" in filters and username != filters["username"]:
+            return False
+        if "speaker" in filters and speaker != filters["speaker"]:
+            return False
+        if "start_time" in filters and (created_at is None or created_at < filters["start_time"]):
+            return False
+        if "end_time" in filters and (created_at is None or created_at >= filters["end_time"]):
+            return False
+        return True
+
+    return accept
+
+
+def _segment_mask(filters: dict):
+    """the same filters for the exact backend, as a mask_fn over segment columns"""
+    if not filters:
+        return None
+
+    import numpy as np
+
+    def mask_fn(segment):
+        mask = np.ones(segment.count, dtype=bool)
+        if "username" in filters:
+            mask &= segment.usernames == filters["username"]
+        if "speaker" in filters:
+            mask &= segment.speakers == filters["speaker"]
+        if "start_time" in filters:
+            mask &= segment.timestamps >= filters["start_time"].timestamp()
+        if "end_time" in filters:
+            mask &= segment.timestamps < filters["end_time"].timestamp()
+        return mask
+
+    return mask_fn
+
+
+SIMILARITY_SEARCH_STATEMENT = """
+    SELECT id, text_segment, embedding, username, speaker, created_at
+    FROM embeddings
+    WHERE {filters}
+    ORDER BY embedding <-> $1::vector
+    LIMIT $2 OFFSET $3
+"""
+
+
+QUANTIZED_SEARCH_STATEMENT = f"""
+    SELECT id, text_segment, embedding, username, speaker, created_at
+    FROM (
+        SELECT id, text_segment, embedding, username, speaker, created_at
+        FROM embeddings
+        WHERE {{filters}}
+        ORDER BY binary_quantize(embedding)::bit({EMBEDDING_DIM}) <~> binary_quantize($1::vector)
+        LIMIT $2
+    ) candidates
+    ORDER BY embedding <-> $1::vector
+    LIMIT $3 OFFSET $4
+"""
+
+
+def _quantized(mode = None) -> str:
+    mode = SEARCH_QUANTIZATION if mode is None else mode
+    return None if mode in ("", "none") else mode
+
+
+def _execute_similarity_search(pooled: _PooledConnection, cursor, query_embedding: list[float], limit: int, offset: int, quantization = None, filters = None) -> None:
+    filters = filters or {}
+
+    if _quantized(quantization) == "binary":
+        name = _statement_name("quantized_similarity_search", filters)
+        where, values = _filter_sql(filters, 5)
+        _prepare(pooled, cursor, name, QUANTIZED_SEARCH_STATEMENT.format(filters=where))
+        params = [_format_embedding(query_embedding), (limit + offset) * QUANTIZATION_CANDIDATES, limit, offset, *values]
+    elif _quantized(quantization) is None:
+        name = _statement_name("similarity_search", filters)
+        where, values = _filter_sql(filters, 4)
+        _prepare(pooled, cursor, name, SIMILARITY_SEARCH_STATEMENT.format(filters=where))
+        params = [_format_embedding(query_embedding), limit, offset, *values]
+    else:
+        raise ValueError(f"pgvector backend does not support {quantization} quantization")
+
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+
+def _parse_vector(value) -> list[float]:
+    """pgvector's text form '[1,2,3]' as a list of floats"""
+    if value is None or isinstance(value, list):
+        return value
+    return [float(x) for x in value.strip("[]").split(",")] if value.strip("[]") else []
+
+
+def _search_rows(results, detailed = False) -> list:
+    """(embedded text, user, speaker, timestamp) per (id, text_segment, embedding, username, speaker, created_at) row,
+    or dicts of all six columns with the embedding parsed when detailed"""
+    if detailed:
+        return [
+            {"id": row_id, "text_segment": text_segment, "embedding": _parse_vector(embedding),
+             "username": username, "speaker": speaker, "created_at": created_at}
+            for row_id, text_segment, embedding, username, speaker, created_at in results
+        ]
+
+    return [
+        (text_segment, username, speaker, created_at)
+        for _, text_segment, _, username, speaker, created_at in results
+    ]
+
+
+def _local_rows(index, hits, detailed = False) -> list:
+    """the same shapes as _search_rows for local index hits"""
+    if not detailed:
+        return [index.get_row(row_id) for row_id, _ in hits]
+
+    rows = []
+    for row_id, _ in hits:
+        text_segment, username, speaker, created_at = index.get_row(row_id)
+        vector = index.get_vector(row_id)
+        rows.append({"id": row_id, "text_segment": text_segment, "embedding": None if vector is None else vector.tolist(),
+                     "username": username, "speaker": speaker, "created_at": created_at})
+    return rows
+
+
+def _local_search(index, query_embeddings, k: int, quantization = None, filters = None) -> list[list[tuple[int, float]]]:
+    filters = filters or {}
+
+    if SEARCH_BACKEND == "exact":
+        return index.search_batch(
+            query_embeddings, k, mask_fn=_segment_mask(filters),
+            quantization=_quantized(quantization), candidate_multiplier=QUANTIZATION_CANDIDATES
+        )
+
+    accept = _row_filter({column: value for column, value in filters.items() if column != "username"})
+    filter_fn = (lambda row_id: accept(index.get_row(row_id))) if accept else None
+    return [index.search(query_embedding, k, username=filters.get("username"), filter_fn=filter_fn) for query_embedding in query_embeddings]
+
+
+@tracing.traced("db.similarity_search")
+def similarity_search(query_embedding: list[float], start = 0, end = 5, username = None, speaker = None,
+                      start_time = None, end_time = None, detailed = False) -> list[tuple[str, list[float], str, str, datetime]]:
     """given the a starting query embedding, returns the top queries from start to end index.
-    each returned query in format of (embedded text, list that represents embedding, user, speaker, timestamp)"""
-
-    query_embedding_str = f'[{",".join(map(str, query_embedding))}]'
-    sql = f"""
-    SELECT text_segment, embedding, username, speaker, created_at 
-    FROM embeddings 
-    ORDER BY embedding <-> '{query_embedding_str}' 
-    LIMIT {end - start} OFFSET {start};
-    """
+    username, speaker and the start_time (inclusive) to end_time (exclusive) range restrict which rows are ranked.
+    each returned query in format of (embedded text, user, speaker, timestamp),
+    or a dict with id, text_segment, embedding, username, speaker and created_at when detailed"""
+    filters = _search_filters(username, speaker, start_time, end_time)
 
-    formatted_results = _execute_retrieve_query(sql)
+    if SEARCH_BACKEND != "pgvector":
+        index = _local_index()
+        return _local_rows(index, _local_search(index, [query_embedding], end, filters=filters)[0][start:end], detailed)
 
-    return formatted_results
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            _scope_filtered_search(cursor, filters)
+            _execute_similarity_search(pooled, cursor, query_embedding, end - start, start, filters=filters)
+            results = cursor.fetchall()
 
-def timestamp_search(timestamp: datetime, before = 5, after = 5) -> list[tuple[str, list[float], str, str, datetime]]:
-    """given the a starting query based on timestamp, 
-    returns "before" number of data before current timestamp and 
-    "after" number of data after current timestamp.
-    each returned query in format of (embedded text, list that represents embedding, user, speaker, timestamp)"""
-
-    sql_before = f"""
-    SELECT text_segment, embedding, username, speaker, created_at 
-    FROM embeddings 
-    WHERE created_at <= %s 
-    ORDER BY created_at DESC 
-    LIMIT %s;
-    """
-    
-    sql_after = f"""
-    SELECT text_segment, embedding, username, speaker, created_at 
-    FROM embeddings 
-    WHERE created_at > %s 
-    ORDER BY created_at ASC 
-    LIMIT %s;
+    return _search_rows(results, detailed)
+
+# the next `limit` ids and distances after the keyset ($3, $4), with full rows for the first $5 of them.
+# the index scan orders by distance alone, ties are broken by id once the candidates are fetched
+RANKED_CANDIDATES_STATEMENT = """
+    WITH ranked AS (
+        SELECT id, embedding <-> $1::vector AS distance
+        FROM embeddings
+        WHERE {filters} AND (embedding <-> $1::vector > $3 OR (embedding <-> $1::vector = $3 AND id > $4))
+        ORDER BY embedding <-> $1::vector
+        LIMIT $2
+    ),
+    numbered AS (
+        SELECT id, distance, row_number() OVER (ORDER BY distance, id) AS position
+        FROM ranked
+    )
+    SELECT numbered.id, numbered.distance, e.text_segment, e.embedding, e.username, e.speaker, e.created_at
+    FROM numbered
+    LEFT JOIN embeddings e ON e.id = numbered.id AND numbered.position <= $5
+    ORDER BY numbered.position
+"""
+
+ROWS_BY_ID_STATEMENT = """
+    SELECT id, text_segment, embedding, username, speaker, created_at
+    FROM embeddings
+    WHERE id = ANY($1::bigint[])
+"""
+
+
+@tracing.traced("db.ranked_candidates")
+def ranked_candidates(query_embedding: list[float], limit: int, page_size: int, after = None, offset = 0,
+                      username = None, speaker = None, start_time = None, end_time = None) -> tuple[list[tuple[int, float]], list[dict]]:
+    """one round trip for a page of ranked results plus the ranking that follows it.
+    returns up to limit (id, distance) pairs, nearest first, and detailed rows for the first page_size of them.
+    pgvector resumes after the (distance, id) keyset `after` instead of skipping rows with OFFSET,
+    local backends (which have no keyset) skip the first offset hits"""
+    filters = _search_filters(username, speaker, start_time, end_time)
+
+    if SEARCH_BACKEND != "pgvector":
+        index = _local_index()
+        hits = _local_search(index, [query_embedding], offset + limit, filters=filters)[0][offset:]
+        ranked = [(int(row_id), float(score)) for row_id, score in hits]
+        return ranked, _local_rows(index, hits[:page_size], detailed=True)
+
+    last_distance, last_id = after if after is not None else (-1.0, 0)
+    name = _statement_name("ranked_candidates", filters)
+    where, values = _filter_sql(filters, 6)
+    params = [_format_embedding(query_embedding), limit, float(last_distance), int(last_id), page_size, *values]
+
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            _scope_filtered_search(cursor, filters, limit=limit)
+            _prepare(pooled, cursor, name, RANKED_CANDIDATES_STATEMENT.format(filters=where))
+            cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+            results = cursor.fetchall()
+
+    ranked = [(row_id, distance) for row_id, distance, *_ in results]
+    page = [(row_id, *row) for row_id, _, *row in results[:page_size] if row[0] is not None]
+    return ranked, _search_rows(page, detailed=True)
+
+
+@tracing.traced("db.rows_by_id")
+def rows_by_id(row_ids: list[int]) -> list[dict]:
+    """detailed rows in the order of row_ids, ids that no longer exist are left out"""
+    if not row_ids:
+        return []
+
+    if SEARCH_BACKEND != "pgvector":
+        index = _local_index()
+        return _local_rows(index, [(row_id, None) for row_id in row_ids if index.get_row(row_id) is not None], detailed=True)
+
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            _prepare(pooled, cursor, "rows_by_id", ROWS_BY_ID_STATEMENT)
+            cursor.execute("EXECUTE rows_by_id (%s)", (list(row_ids),))
+            results = cursor.fetchall()
+
+    rows = {row["id"]: row for row in _search_rows(results, detailed=True)}
+    return [rows[row_id] for row_id in row_ids if row_id in rows]
+
+@tracing.traced("db.batch_similarity_search")
+def batch_similarity_search(query_embeddings: list[list[float]], k = 5, username = None, speaker = None,
+                            start_time = None, end_time = None) -> list[list[tuple[str, str, str, datetime]]]:
+    """runs several similarity searches at once, returning the top k rows for each query in order.
+    the exact backend answers all of them with a single matrix product"""
+    filters = _search_filters(username, speaker, start_time, end_time)
+
+    if SEARCH_BACKEND != "pgvector":
+        index = _local_index()
+        return [_local_rows(index, hits) for hits in _local_search(index, query_embeddings, k, filters=filters)]
+
+    results = []
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            _scope_filtered_search(cursor, filters)
+            for query_embedding in query_embeddings:
+                _execute_similarity_search(pooled, cursor, query_embedding, k, 0, filters=filters)
+                results.append(_search_rows(cursor.fetchall()))
+
+    return results
+
+def quantization_recall_report(k = 10, sample_size = 100, multipliers = (1, 2, 4, 8, 16, 32), quantization = None) -> list[dict]:
+    """measures recall@k of quantized search against exact search for sample_size stored embeddings used as queries,
+    for each candidate multiplier. uses the configured SEARCH_BACKEND and SEARCH_QUANTIZATION unless overridden"""
+    from modules.quantization import recall_report
+
+    quantization = _quantized(quantization) or "binary"
+
+    if SEARCH_BACKEND == "exact":
+        index = _local_index()
+        queries = index.sample_vectors(sample_size)
+        return recall_report(
+            lambda queries, k: index.search_batch(queries, k),
+            lambda queries, k, multiplier: index.search_batch(queries, k, quantization=quantization, candidate_multiplier=multiplier),
+            queries, k, multipliers
+        )
+
+    if SEARCH_BACKEND != "pgvector":
+        raise ValueError(f"{SEARCH_BACKEND} backend does not support quantization")
+
+    if quantization != "binary":
+        raise ValueError(f"pgvector backend does not support {quantization} quantization")
+
+    exact_sql = "SELECT id, embedding <-> %s::vector FROM embeddings ORDER BY 2 LIMIT %s"
+    quantized_sql = f"""
+    SELECT id, embedding <-> %(query)s::vector
+    FROM (
+        SELECT id, embedding FROM embeddings
+        ORDER BY binary_quantize(embedding)::bit({EMBEDDING_DIM}) <~> binary_quantize(%(query)s::vector)
+        LIMIT %(candidates)s
+    ) candidates
+    ORDER BY 2 LIMIT %(k)s
     """
 
-    results_before = _execute_retrieve_query(sql_before, (timestamp, abs(before)))
-    results_after  = _execute_retrieve_query(sql_after, (timestamp, abs(after)))
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            cursor.execute("SELECT embedding::text FROM embeddings ORDER BY random() LIMIT %s", (sample_size,))
+            queries = [row[0] for row in cursor.fetchall()]
+
+            def search_exact(queries, k):
+                hits = []
+                for query in queries:
+                    cursor.execute(exact_sql, (query, k))
+                    hits.append(cursor.fetchall())
+                return hits
+
+            def search_quantized(queries, k, multiplier):
+                hits = []
+                for query in queries:
+                    cursor.execute(quantized_sql, {"query": query, "candidates": k * multiplier, "k": k})
+                    hits.append(cursor.fetchall())
+                return hits
+
+            return recall_report(search_exact, search_quantized, queries, k, multipliers)
+
+def ensure_text_search_schema() -> None:
+    """adds the generated tsvector column and its GIN index used by hybrid_search, if missing"""
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            cursor.execute("""
+            ALTER TABLE embeddings
+            ADD COLUMN IF NOT EXISTS text_search tsvector
+            GENERATED ALWAYS AS (to_tsvector('english', text_segment)) STORED
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS embeddings_text_search_idx ON embeddings USING GIN (text_search)")
+
+
+HYBRID_SEARCH_STATEMENT = """
+    WITH vector_hits AS (
+        SELECT id, row_number() OVER (ORDER BY distance) AS rank
+        FROM (
+            SELECT id, embedding <-> $1::vector AS distance
+            FROM embeddings
+            WHERE {filters}
+            ORDER BY distance
+            LIMIT $3
+        ) nearest
+    ),
+    text_hits AS (
+        SELECT id, row_number() OVER (ORDER BY relevance DESC) AS rank
+        FROM (
+            SELECT id, ts_rank_cd(text_search, query) AS relevance
+            FROM embeddings, websearch_to_tsquery('english', $2) query
+            WHERE text_search @@ query AND {filters}
+            ORDER BY relevance DESC
+            LIMIT $3
+        ) matching
+    ),
+    fused AS (
+        SELECT id, SUM(1.0 / ($4 + rank)) AS score
+        FROM (SELECT * FROM vector_hits UNION ALL SELECT * FROM text_hits) hits
+        GROUP BY id
+    )
+    SELECT e.id, e.text_segment, e.embedding, e.username, e.speaker, e.created_at
+    FROM fused
+    JOIN embeddings e USING (id)
+    ORDER BY fused.score DESC, e.id
+    LIMIT $5
+"""
+
+
+@tracing.traced("db.hybrid_search")
+def hybrid_search(query_text: str, query_embedding: list[float], k = 5, username = None, speaker = None,
+                  start_time = None, end_time = None, detailed = False) -> list[tuple[str, str, str, datetime]]:
+    """full-text and vector search in one round trip, merged with reciprocal rank fusion.
+    exact names, numbers and jargon that the embedding misses still rank through the tsvector match.
+    each returned query in format of (embedded text, user, speaker, timestamp), or a dict when detailed"""
+    filters = _search_filters(username, speaker, start_time, end_time)
+    name = _statement_name("hybrid_search", filters)
+    where, values = _filter_sql(filters, 6)
+    params = [_format_embedding(query_embedding), query_text, max(HYBRID_CANDIDATES, k), RRF_K, k, *values]
+
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            _scope_filtered_search(cursor, filters)
+            _prepare(pooled, cursor, name, HYBRID_SEARCH_STATEMENT.format(filters=where))
+            cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+            results = cursor.fetchall()
+
+    return _search_rows(results, detailed)
+
+TIMELINE_STATEMENT = """
+    SELECT id, text_segment, username, speaker, created_at
+    FROM (
+        (SELECT id, text_segment, username, speaker, created_at
+         FROM embeddings
+         WHERE created_at <= $1 AND {filters}
+         ORDER BY created_at DESC, id DESC
+         LIMIT $2)
+        UNION ALL
+        (SELECT id, text_segment, username, speaker, created_at
+         FROM embeddings
+         WHERE created_at > $1 AND {filters}
+         ORDER BY created_at, id
+         LIMIT $3)
+    ) timeline
+    ORDER BY created_at, id
+"""
+
+# a recording's segments are inserted in order in one transaction. the first two branches walk the
+# (recording, id) index outwards from the hit. rows uploaded before recordings were stored have none, for
+# those the last two approximate the recording by the user's segments uploaded within $3 seconds, off the
+# (username, created_at) index. which pair runs is decided once per hit
+EXPAND_HITS_STATEMENT = """
+    SELECT hit.id AS hit_id, window_rows.id, window_rows.text_segment, window_rows.username,
+           window_rows.speaker, window_rows.created_at
+    FROM embeddings hit
+    CROSS JOIN LATERAL (
+        (SELECT id, text_segment, username, speaker, created_at
+         FROM embeddings
+         WHERE hit.recording IS NOT NULL AND recording = hit.recording AND id < hit.id
+         ORDER BY id DESC
+         LIMIT $2)
+        UNION ALL
+        (SELECT id, text_segment, username, speaker, created_at
+         FROM embeddings
+         WHERE hit.recording IS NOT NULL AND recording = hit.recording AND id >= hit.id
+         ORDER BY id
+         LIMIT $2 + 1)
+        UNION ALL
+        (SELECT id, text_segment, username, speaker, created_at
+         FROM embeddings
+         WHERE hit.recording IS NULL AND username = hit.username AND (created_at, id) < (hit.created_at, hit.id)
+           AND created_at >= hit.created_at - make_interval(secs => $3)
+         ORDER BY created_at DESC, id DESC
+         LIMIT $2)
+        UNION ALL
+        (SELECT id, text_segment, username, speaker, created_at
+         FROM embeddings
+         WHERE hit.recording IS NULL AND username = hit.username AND (created_at, id) >= (hit.created_at, hit.id)
+           AND created_at <= hit.created_at + make_interval(secs => $3)
+         ORDER BY created_at, id
+         LIMIT $2 + 1)
+    ) window_rows
+    WHERE hit.id = ANY($1::bigint[])
+    ORDER BY hit.id, window_rows.created_at, window_rows.id
+"""
+
+
+def _segment_rows(results, detailed = False) -> list:
+    """(embedded text, user, speaker, timestamp) per (id, text_segment, username, speaker, created_at) row,
+    or dicts of all five columns when detailed"""
+    if detailed:
+        return [
+            {"id": row_id, "text_segment": text_segment, "username": username, "speaker": speaker, "created_at": created_at}
+            for row_id, text_segment, username, speaker, created_at in results
+        ]
+
+    return [(text_segment, username, speaker, created_at) for _, text_segment, username, speaker, created_at in results]
+
+
+def _hit_windows(results) -> dict[int, list[dict]]:
+    """(hit_id, id, text_segment, username, speaker, created_at) rows grouped by hit_id"""
+    windows = {}
+    for hit_id, *row in results:
+        windows.setdefault(hit_id, []).append(row)
+    return {hit_id: _segment_rows(rows, detailed=True) for hit_id, rows in windows.items()}
+
+
+@tracing.traced("db.timestamp_search")
+def timestamp_search(timestamp: datetime, before = 5, after = 5, username = None, speaker = None,
+                     start_time = None, end_time = None, detailed = False) -> list[tuple[str, str, str, datetime]]:
+    """the timeline around a timestamp in one round trip:
+    up to "before" rows at or before the timestamp and up to "after" rows after it, oldest first.
+    username, speaker and the start_time to end_time range restrict which rows are returned.
+    each returned query in format of (embedded text, user, speaker, timestamp), or a dict with the id too when detailed"""
+    filters = _search_filters(username, speaker, start_time, end_time)
+    name = _statement_name("timeline", filters)
+    where, values = _filter_sql(filters, 4)
+    params = [timestamp, abs(before), abs(after), *values]
+
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            _prepare(pooled, cursor, name, TIMELINE_STATEMENT.format(filters=where))
+            cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+            results = cursor.fetchall()
+
+    return _segment_rows(results, detailed)
+
+
+@tracing.traced("db.expand_hits")
+def expand_hits(hit_ids: list[int], window = 2, max_gap = 5.0) -> dict[int, list[dict]]:
+    """the recording around each search hit, for every hit in one round trip.
+    returns hit id -> up to window segments before the hit, the hit itself and up to window segments after it,
+    oldest first, as detailed dicts without the embedding. window 0 returns each hit on its own.
+    the recording is the one stored with the hit, whichever speaker. rows without one fall back to the hit
+    user's segments uploaded within max_gap seconds of the hit. hits that no longer exist are left out"""
+    hit_ids = list(dict.fromkeys(hit_id for hit_id in hit_ids if hit_id is not None))
+    window = max(window, 0)
+    if not hit_ids:
+        return {}
 
-    formatted_results = results_after+results_before
+    with _pooled_connection() as pooled:
+        with pooled.conn.cursor() as cursor:
+            _prepare(pooled, cursor, "expand_hits", EXPAND_HITS_STATEMENT)
+            cursor.execute("EXECUTE expand_hits (%s, %s, %s)", (hit_ids, window, float(max_gap)))
+            results = cursor.fetchall()
 
-    return formatted_results
\ No newline at end of file
+    return _hit_windows(results)
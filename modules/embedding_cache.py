@@ -0,0 +1,231 @@
+from array import array
+from collections import OrderedDict
+import hashlib
+import os
+import sqlite3
+import threading
+
+from modules import tracing
+
+"""two-tier cache for text embeddings.
+entries are keyed by sha256(model_id, normalized text). the first tier is an in-process LRU,
+the second an sqlite database (WAL mode) that survives restarts and is shared by every process
+pointed at the same EMBEDDING_CACHE_PATH, e.g. the ingestion processor and the query server.
+vectors are stored as packed float32 bytes in both tiers, the same precision pgvector keeps them at,
+about 4 KB per 1024-dimension vector in memory where a list of python floats takes 32 KB."""
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".cache", "embeddings.sqlite3")
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", DEFAULT_CACHE_PATH)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+
+
+def normalize_text(text: str) -> str:
+    """collapses runs of whitespace so formatting differences don't cause misses"""
+    return " ".join(text.split())
+
+
+def _pack(embedding) -> bytes:
+    return array("f", embedding).tobytes()
+
+
+def _unpack(blob: bytes) -> list[float]:
+    return array("f", blob).tolist()
+
+
+def cache_key(model_id: str, text: str) -> str:
+    digest = hashlib.sha256()
+    digest.update(model_id.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(normalize_text(text).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class LRUCache:
+    """thread-safe in-memory LRU bounded by number of entries"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteEmbeddingStore:
+    """on-disk embedding store, one sqlite connection per thread"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, model_id TEXT NOT NULL, embedding BLOB NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get_many(self, keys: list[str]) -> dict[str, bytes]:
+        """packed embeddings by key for the keys that are stored"""
+        found = {}
+        conn = self._connection()
+
+        # stay well under sqlite's bound parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})", chunk)
+            for key, blob in rows:
+                found[key] = bytes(blob)
+
+        return found
+
+    def put_many(self, entries: list[tuple[str, str, bytes]]) -> None:
+        """entries are (key, model_id, packed embedding)"""
+        with self._connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, model_id, embedding) VALUES (?, ?, ?)", entries)
+
+    def recent(self, limit: int) -> list[tuple[str, bytes]]:
+        """the limit most recently written entries as (key, packed embedding), newest first"""
+        rows = self._connection().execute("SELECT key, embedding FROM embeddings ORDER BY rowid DESC LIMIT ?", (limit,))
+        return [(key, bytes(blob)) for key, blob in rows]
+
+    def clear(self) -> None:
+        with self._connection() as conn:
+            conn.execute("DELETE FROM embeddings")
+
+
+class EmbeddingCache:
+
+    def __init__(self, path = EMBEDDING_CACHE_PATH, max_entries = EMBEDDING_CACHE_SIZE):
+        self.memory = LRUCache(max_entries)
+        self.disk = SQLiteEmbeddingStore(path) if path else None
+
+        self._stats_lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _count(self, memory_hits = 0, disk_hits = 0, misses = 0) -> None:
+        with self._stats_lock:
+            self.memory_hits += memory_hits
+            self.disk_hits += disk_hits
+            self.misses += misses
+
+    def get(self, model_id: str, text: str):
+        return self.get_many(model_id, [text])[0]
+
+    def get_many(self, model_id: str, texts: list[str]) -> list:
+        """returns one embedding or None per text, promoting disk hits into memory"""
+        keys = [cache_key(model_id, text) for text in texts]
+        results = [self.memory.get(key) for key in keys]
+        memory_hits = sum(result is not None for result in results)
+
+        missing = list({key for key, result in zip(keys, results) if result is None})
+        disk_hits = 0
+        if missing and self.disk is not None:
+            found = self.disk.get_many(missing)
+            disk_hits = len(found)
+            for key, embedding in found.items():
+                self.memory.put(key, embedding)
+            results = [found.get(key) if result is None else result for key, result in zip(keys, results)]
+
+        self._count(memory_hits=memory_hits, disk_hits=disk_hits, misses=len(missing) - disk_hits)
+        return [None if result is None else _unpack(result) for result in results]
+
+    def put(self, model_id: str, text: str, embedding: list[float]) -> None:
+        self.put_many(model_id, [(text, embedding)])
+
+    def put_many(self, model_id: str, items: list[tuple[str, list[float]]]) -> None:
+        entries = [(cache_key(model_id, text), model_id, _pack(embedding)) for text, embedding in items]
+        for key, _, embedding in entries:
+            self.memory.put(key, embedding)
+        if self.disk is not None and entries:
+            self.disk.put_many(entries)
+
+    def preload(self, limit = None) -> int:
+        """fills the memory tier with the most recently written disk entries, returns how many were loaded"""
+        if self.disk is None:
+            return 0
+
+        limit = self.memory.max_entries if limit is None else min(limit, self.memory.max_entries)
+        entries = self.disk.recent(limit) if limit > 0 else []
+        # oldest first, so the newest end up most recently used
+        for key, embedding in reversed(entries):
+            self.memory.put(key, embedding)
+        return len(entries)
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict[str, int]:
+        """hit/miss counters for this process, every hit is a bedrock call saved"""
+        with self._stats_lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bedrock_calls_saved": self.memory_hits + self.disk_hits,
+                "memory_entries": len(self.memory)
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """returns the process-wide cache, or None when EMBEDDING_CACHE_ENABLED is off"""
+    global _cache
+
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache()
+
+    return _cache
+
+
+tracing.register_gauges("embedding_cache", lambda: _cache.stats() if _cache is not None else {})
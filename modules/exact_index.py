@@ -0,0 +1,457 @@
+from datetime import datetime
+import json
+import os
+import threading
+
+import numpy as np
+
+from modules.quantization import QuantizedCodes
+
+"""exact k-NN over embeddings stored as append-only float32 memmap segments.
+each segment is a set of parallel files: <name>.f32 (vectors), <name>.norms (squared norms),
+<name>.ids (row ids), <name>.ts (created_at as epoch seconds) and <name>.rows (one json row per line).
+manifest.json records how many rows of each segment are committed (and which were deleted),
+so a reader never sees a half-written append, and refresh() only reads the rows committed since it last looked.
+compaction merges every segment into one contiguous memmap and drops deletes. the merged segments' files
+stay until the next compaction, so a reader that read the manifest before it can still open them."""
+
+
+class _Segment:
+
+    def __init__(self, path: str, name: str, dim: int, count: int):
+        self.path = path
+        self.name = name
+        self.dim = dim
+        self.count = count
+        self.rows = []
+        self._rows_offset = 0    # bytes of the rows file already read
+        self.usernames = np.empty(0, dtype=object)
+        self.speakers = np.empty(0, dtype=object)
+        self.deleted = np.empty(0, dtype=np.int64)   # offsets of removed rows
+        self._mask = None
+        self._codes = {}
+        self.remap()
+
+    def file(self, suffix: str) -> str:
+        return os.path.join(self.path, f"{self.name}.{suffix}")
+
+    def _map(self, suffix: str, dtype, shape):
+        if not self.count:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.file(suffix), dtype=dtype, mode="r", shape=shape)
+
+    def remap(self) -> None:
+        self.vectors = self._map("f32", np.float32, (self.count, self.dim))
+        self.norms = self._map("norms", np.float32, (self.count,))
+        self.ids = self._map("ids", np.int64, (self.count,))
+        self.timestamps = self._map("ts", np.float64, (self.count,))
+        self._mask = None
+        self._codes = {}
+
+    def codes(self, mode: str) -> QuantizedCodes:
+        """coarse codes for this segment, built on first use after every append"""
+        codes = self._codes.get(mode)
+        if codes is None:
+            codes = self._codes[mode] = QuantizedCodes(self.vectors, mode)
+        return codes
+
+    def load_rows(self) -> None:
+        """reads the rows committed after the ones already loaded, up to count"""
+        if len(self.rows) >= self.count:
+            return
+
+        rows = []
+        with open(self.file("rows"), "rb") as f:
+            f.seek(self._rows_offset)
+            for line in f:
+                if len(self.rows) + len(rows) == self.count:
+                    break
+                text_segment, username, speaker, created_at = json.loads(line)
+                rows.append((text_segment, username, speaker, datetime.fromisoformat(created_at) if created_at else None))
+                self._rows_offset += len(line)
+        self.rows.extend(rows)
+        self._index_columns(rows)
+
+    def _index_columns(self, rows: list) -> None:
+        """username and speaker as arrays so filters become vectorized comparisons, extended by the new rows"""
+        self.usernames = np.concatenate([self.usernames, np.array([row[1] for row in rows], dtype=object)])
+        self.speakers = np.concatenate([self.speakers, np.array([row[2] for row in rows], dtype=object)])
+
+    def append(self, ids, vectors, timestamps, rows) -> None:
+        norms = np.einsum("ij,ij->i", vectors, vectors).astype(np.float32)
+
+        for suffix, values in (("f32", vectors), ("norms", norms), ("ids", ids), ("ts", timestamps)):
+            with open(self.file(suffix), "r+b" if os.path.exists(self.file(suffix)) else "wb") as f:
+                # truncate anything a crashed writer left past the committed count
+                f.truncate(self.count * values.itemsize * (values.shape[1] if values.ndim == 2 else 1))
+                f.seek(0, os.SEEK_END)
+                f.write(np.ascontiguousarray(values).tobytes())
+
+        with open(self.file("rows"), "ab") as f:
+            for text_segment, username, speaker, created_at in rows:
+                line = (json.dumps([text_segment, username, speaker, created_at.isoformat() if created_at else None]) + "\n").encode("utf-8")
+                f.write(line)
+                self._rows_offset += len(line)
+
+        self.count += len(ids)
+        self.rows.extend(rows)
+        self._index_columns(rows)
+        self.remap()
+
+    def delete(self, offsets: list[int]) -> None:
+        self.deleted = np.union1d(self.deleted, np.asarray(offsets, dtype=np.int64))
+        self._mask = None
+
+    def live_mask(self):
+        """boolean mask of rows not deleted, None when nothing in this segment is"""
+        if not self.deleted.size:
+            return None
+        if self._mask is None:
+            self._mask = np.ones(self.count, dtype=bool)
+            self._mask[self.deleted] = False
+        return self._mask
+
+    def remove_files(self) -> None:
+        for suffix in ("f32", "norms", "ids", "ts", "rows"):
+            if os.path.exists(self.file(suffix)):
+                os.remove(self.file(suffix))
+
+
+class ExactIndex:
+
+    MANIFEST_FILE = "manifest.json"
+
+    def __init__(self, path: str, dim: int, segment_rows = 100000, max_segments = 8):
+        self.path = path
+        self.dim = dim
+        self.segment_rows = segment_rows
+        self.max_segments = max_segments
+
+        self._segments = []
+        self._retired = []     # names of segments merged by the last compaction, deleted by the next one
+        self._next_seq = 0
+        self._locations = {}   # row id -> (segment, offset)
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+    def __contains__(self, row_id) -> bool:
+        return row_id in self._locations
+
+    @classmethod
+    def open(cls, path: str, dim: int, **kwargs):
+        """opens the index at path, creating an empty one if it doesn't exist yet"""
+        index = cls(path, dim, **kwargs)
+        os.makedirs(path, exist_ok=True)
+        index.refresh()
+        return index
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, self.MANIFEST_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def refresh(self, path = None) -> bool:
+        """catches up with the manifest another process committed: segments already loaded only read
+        the rows appended since, and only segments new to this index are read whole"""
+        with self._lock:
+            for attempt in range(3):
+                manifest = self._read_manifest()
+                if manifest is None:
+                    return True
+                try:
+                    self._apply_manifest(manifest)
+                    return True
+                except FileNotFoundError:
+                    # two compactions removed the segments this manifest names, read the current one
+                    if attempt == 2:
+                        raise
+
+    def _apply_manifest(self, manifest: dict) -> None:
+        loaded = {segment.name: segment for segment in self._segments}
+        segments = []
+        grown = []
+        removed = []
+
+        for name, count, deleted in manifest["segments"]:
+            segment = loaded.get(name)
+            if segment is None:
+                segment = _Segment(self.path, name, manifest["dim"], count)
+                segment.load_rows()
+                grown.append((segment, 0))
+            elif count > segment.count:
+                grown.append((segment, segment.count))
+                segment.count = count
+                segment.remap()
+                segment.load_rows()
+            if len(deleted) != segment.deleted.size:
+                removed.append((segment, np.setdiff1d(deleted, segment.deleted)))
+                segment.delete(deleted)
+            segments.append(segment)
+
+        self.dim = manifest["dim"]
+        self._next_seq = manifest["next_seq"]
+        self._retired = manifest.get("retired", [])
+        dropped = set(loaded) - {segment.name for segment in segments}
+        self._segments = segments
+
+        if dropped or any(start == 0 for _, start in grown):
+            self._reindex()
+            return
+
+        # deletes first, a replaced row is deleted from one segment and appended to another
+        for segment, offsets in removed:
+            for offset in offsets.tolist():
+                row_id = int(segment.ids[offset])
+                if self._locations.get(row_id) == (segment, offset):
+                    del self._locations[row_id]
+        for segment, start in grown:
+            deleted = set(segment.deleted.tolist())
+            for offset, row_id in enumerate(segment.ids[start:].tolist(), start):
+                if offset not in deleted:
+                    self._locations[row_id] = (segment, offset)
+
+    @classmethod
+    def saved_version(cls, path: str):
+        try:
+            return os.stat(os.path.join(path, cls.MANIFEST_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _reindex(self) -> None:
+        self._locations = {}
+        for segment in self._segments:
+            deleted = set(segment.deleted.tolist())
+            for offset, row_id in enumerate(segment.ids.tolist()):
+                if offset not in deleted:
+                    self._locations[row_id] = (segment, offset)
+
+    def _new_segment(self) -> _Segment:
+        segment = _Segment(self.path, f"segment-{self._next_seq:08d}", self.dim, 0)
+        self._next_seq += 1
+        self._segments.append(segment)
+        return segment
+
+    def save(self, path = None) -> None:
+        """commits the manifest, appends are only visible to other processes after this"""
+        manifest = {
+            "dim": self.dim,
+            "next_seq": self._next_seq,
+            "segments": [[segment.name, segment.count, segment.deleted.tolist()] for segment in self._segments],
+            "retired": self._retired
+        }
+
+        manifest_path = os.path.join(self.path, self.MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def add(self, row_ids: list, vectors, rows) -> None:
+        """appends rows to the active segment. rows are (text_segment, username, speaker, created_at)"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+
+        with self._lock:
+            replaced = [row_id for row_id in row_ids if row_id in self._locations]
+            if replaced:
+                self.remove(replaced)
+
+            start = 0
+            while start < len(row_ids):
+                segment = self._segments[-1] if self._segments else None
+                if segment is None or segment.count >= self.segment_rows:
+                    segment = self._new_segment()
+
+                end = min(len(row_ids), start + self.segment_rows - segment.count)
+                batch_rows = list(rows[start:end])
+                offset = segment.count
+                segment.append(
+                    np.asarray(row_ids[start:end], dtype=np.int64),
+                    vectors[start:end],
+                    np.array([row[3].timestamp() if row[3] else np.nan for row in batch_rows], dtype=np.float64),
+                    batch_rows
+                )
+                for i, row_id in enumerate(row_ids[start:end]):
+                    self._locations[row_id] = (segment, offset + i)
+                start = end
+
+            self.save()
+            self.maybe_compact()
+
+    def remove(self, row_ids: list) -> None:
+        with self._lock:
+            removed = {}
+            for row_id in row_ids:
+                location = self._locations.pop(row_id, None)
+                if location is not None:
+                    segment, offset = location
+                    removed.setdefault(segment, []).append(offset)
+
+            if not removed:
+                return
+
+            for segment, offsets in removed.items():
+                segment.delete(offsets)
+            self.save()
+
+    def clear(self) -> None:
+        """drops every row, leaving an empty index at the same path"""
+        with self._lock:
+            self.remove(list(self._locations))
+            self.compact()
+
+    def get_row(self, row_id):
+        location = self._locations.get(row_id)
+        if location is None:
+            return None
+        segment, offset = location
+        return segment.rows[offset]
+
+    def get_vector(self, row_id):
+        location = self._locations.get(row_id)
+        if location is None:
+            return None
+        segment, offset = location
+        return np.array(segment.vectors[offset])
+
+    def maybe_compact(self) -> bool:
+        """compacts when there are too many segments or more than a fifth of the rows are deleted"""
+        total = sum(segment.count for segment in self._segments)
+        deleted = sum(segment.deleted.size for segment in self._segments)
+        if len(self._segments) > self.max_segments or (total and deleted > total / 5):
+            self.compact()
+            return True
+        return False
+
+    def compact(self) -> None:
+        """rewrites all live rows into one contiguous segment"""
+        with self._lock:
+            old_segments = self._segments
+            merged = _Segment(self.path, f"segment-{self._next_seq:08d}", self.dim, 0)
+            self._next_seq += 1
+
+            for segment in old_segments:
+                if not segment.count:
+                    continue
+                keep = segment.live_mask()
+                keep = np.ones(segment.count, dtype=bool) if keep is None else keep
+                if keep.any():
+                    merged.append(
+                        segment.ids[keep],
+                        np.asarray(segment.vectors[keep]),
+                        segment.timestamps[keep],
+                        [row for row, live in zip(segment.rows, keep) if live]
+                    )
+
+            # the segments merged last time are gone from every manifest a reader can still be opening
+            for name in self._retired:
+                _Segment(self.path, name, self.dim, 0).remove_files()
+
+            self._segments = [merged]
+            self._retired = [segment.name for segment in old_segments]
+            self._reindex()
+            self.save()
+
+    def _segment_topk(self, segment: _Segment, queries: np.ndarray, k: int, mask = None) -> tuple[np.ndarray, np.ndarray]:
+        """one matrix product for all queries, returns (distances, ids) of shape (queries, <=k)"""
+        live = segment.live_mask()
+        if mask is not None:
+            live = mask if live is None else live & mask
+
+        offsets = np.flatnonzero(live) if live is not None else None
+        if offsets is not None and offsets.size * 4 < segment.count:
+            # a selective filter, e.g. one user's rows, only pays for the rows it keeps
+            if not offsets.size:
+                return np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+            return self._rows_topk(segment, queries, k, offsets)
+
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        distances = segment.norms[None, :] - 2.0 * (queries @ segment.vectors.T) + query_norms[:, None]
+        if live is not None:
+            distances = np.where(live[None, :], distances, np.inf)
+
+        kk = min(k, segment.count)
+        top = np.argpartition(distances, kk - 1, axis=1)[:, :kk] if kk < segment.count else np.tile(np.arange(segment.count), (len(queries), 1))
+        return np.take_along_axis(distances, top, axis=1), segment.ids[top]
+
+    def _rows_topk(self, segment: _Segment, queries: np.ndarray, k: int, offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        distances = segment.norms[offsets][None, :] - 2.0 * (queries @ segment.vectors[offsets].T) + query_norms[:, None]
+
+        kk = min(k, offsets.size)
+        top = np.argpartition(distances, kk - 1, axis=1)[:, :kk] if kk < offsets.size else np.tile(np.arange(offsets.size), (len(queries), 1))
+        return np.take_along_axis(distances, top, axis=1), segment.ids[offsets[top]]
+
+    def _segment_topk_quantized(self, segment: _Segment, queries: np.ndarray, k: int, mask, mode: str, candidate_multiplier: int) -> tuple[np.ndarray, np.ndarray]:
+        """coarse pass over compact codes, then exact distances for only the surviving candidates"""
+        live = segment.live_mask()
+        if mask is not None:
+            live = mask if live is None else live & mask
+
+        if live is not None and np.count_nonzero(live) <= k * candidate_multiplier:
+            # the filter already leaves fewer rows than the coarse pass would keep
+            return self._segment_topk(segment, queries, k, live)
+
+        codes = segment.codes(mode)
+        width = min(k, segment.count)
+        distances = np.full((len(queries), width), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), width), -1, dtype=np.int64)
+
+        for i, (query, candidates) in enumerate(zip(queries, codes.coarse_candidates(queries, k * candidate_multiplier, live))):
+            candidates = np.sort(candidates)
+            if not candidates.size:
+                continue
+
+            diff = segment.vectors[candidates] - query
+            exact = np.einsum("ij,ij->i", diff, diff)
+            best = np.argsort(exact, kind="stable")[:width]
+            distances[i, :len(best)] = exact[best]
+            ids[i, :len(best)] = segment.ids[candidates[best]]
+
+        return distances, ids
+
+    def search_batch(self, query_embeddings, k: int, mask_fn = None, quantization = None, candidate_multiplier = 10) -> list[list[tuple[int, float]]]:
+        """top-k for many queries at once, each result is [(row id, squared distance)] nearest first.
+        ties are broken by row id so results are deterministic.
+        mask_fn(segment) may return a boolean mask restricting which rows are eligible,
+        e.g. segment.usernames == username. selective masks only compute distances for the rows they keep.
+        quantization ("binary" or "int8") ranks k * candidate_multiplier rows by compact codes first
+        and computes exact distances only for those, trading recall for speed"""
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dim)
+
+        with self._lock:
+            segments = [segment for segment in self._segments if segment.count]
+            if k <= 0 or not segments:
+                return [[] for _ in range(len(queries))]
+
+            if quantization:
+                parts = [
+                    self._segment_topk_quantized(segment, queries, k, mask_fn(segment) if mask_fn else None, quantization, candidate_multiplier)
+                    for segment in segments
+                ]
+            else:
+                parts = [self._segment_topk(segment, queries, k, mask_fn(segment) if mask_fn else None) for segment in segments]
+
+        distances = np.concatenate([part[0] for part in parts], axis=1)
+        ids = np.concatenate([part[1] for part in parts], axis=1)
+
+        results = []
+        for query_distances, query_ids in zip(distances, ids):
+            order = np.lexsort((query_ids, query_distances))[:k]
+            results.append([
+                (int(query_ids[i]), float(max(query_distances[i], 0.0)))
+                for i in order if np.isfinite(query_distances[i])
+            ])
+        return results
+
+    def search(self, query_embedding: list[float], k: int, mask_fn = None, quantization = None, candidate_multiplier = 10) -> list[tuple[int, float]]:
+        return self.search_batch([query_embedding], k, mask_fn, quantization, candidate_multiplier)[0]
+
+    def sample_vectors(self, n: int, seed = 0) -> np.ndarray:
+        """n stored vectors chosen at random, used as queries for recall measurements"""
+        rng = np.random.default_rng(seed)
+        locations = list(self._locations.values())
+        chosen = rng.choice(len(locations), size=min(n, len(locations)), replace=False)
+        return np.array([locations[i][0].vectors[locations[i][1]] for i in chosen], dtype=np.float32)
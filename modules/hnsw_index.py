@@ -0,0 +1,502 @@
+import heapq
+import math
+import os
+import pickle
+import random
+import struct
+import threading
+import time
+
+import numpy as np
+
+"""in-process HNSW (hierarchical navigable small world) index over embeddings.
+distances are squared L2, which ranks the same way as pgvector's <-> operator.
+deletes are tombstones: the node stays in the graph for connectivity but is never returned,
+compact() rebuilds the graph without them, save() does so once more than a fifth of the nodes are tombstones.
+on disk the index is a snapshot (graph.pkl plus the vectors-*.npy it names) and graph.log, the changes saved
+since that snapshot. save() appends one record per call and only writes a new snapshot once the log holds
+more than a quarter of the rows, and refresh() applies just the records another process appended.
+one process writes at a time, any number read."""
+
+
+class HNSWIndex:
+
+    GRAPH_FILE = "graph.pkl"
+    LOG_FILE = "graph.log"
+
+    # a new snapshot is written once the log holds more than max(SNAPSHOT_ROWS, SNAPSHOT_FRACTION * rows) rows
+    SNAPSHOT_ROWS = 10000
+    SNAPSHOT_FRACTION = 0.25
+    # save() compacts once tombstones are more than this fraction of the nodes
+    COMPACT_FRACTION = 0.2
+
+    # users with at most this many rows are searched exactly instead of through the graph
+    TENANT_SCAN_ROWS = 2000
+
+    def __init__(self, dim: int, M = 16, ef_construction = 200, ef_search = 64, seed = None):
+        self.dim = dim
+        self.M = M
+        self.max_neighbors0 = 2 * M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_mult = 1 / math.log(M)
+
+        self._rng = random.Random(seed)
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        self._count = 0
+        self._neighbors = []   # node -> one neighbor list per level
+        self._labels = []      # node -> row id
+        self._nodes = {}       # row id -> live node
+        self._rows = {}        # row id -> (text_segment, username, speaker, created_at)
+        self._tenants = {}     # username -> set of live row ids
+        self._deleted = set()
+        self._entry_point = None
+        self._max_level = -1
+        self._lock = threading.RLock()
+
+        # persistence: the snapshot this index was saved as or loaded from, how far into its log it is,
+        # and what changed since then
+        self._snapshot = None
+        self._log_position = 0
+        self._log_rows = 0
+        self._saved_count = 0
+        self._dirty_nodes = set()    # nodes below _saved_count whose neighbor lists changed
+        self._dirty_rows = set()
+        self._new_deleted = set()
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, row_id) -> bool:
+        return row_id in self._nodes
+
+    def _ensure_capacity(self, extra: int) -> None:
+        needed = self._count + extra
+        if needed <= self._vectors.shape[0] and self._vectors.flags.writeable:
+            return
+
+        # also copies a read-only memmap from load() into memory on the first write
+        capacity = max(needed, 2 * self._vectors.shape[0], 1024)
+        grown = np.empty((capacity, self.dim), dtype=np.float32)
+        grown[:self._count] = self._vectors[:self._count]
+        self._vectors = grown
+
+    def _distances(self, query: np.ndarray, nodes: list[int]) -> np.ndarray:
+        diff = self._vectors[nodes] - query
+        return np.einsum("ij,ij->i", diff, diff)
+
+    def _search_layer(self, query: np.ndarray, entry_points: list[tuple[float, int]], ef: int, level: int) -> list[tuple[float, int]]:
+        """greedy best-first search of one layer, returns up to ef (distance, node) pairs sorted by distance"""
+        visited = {node for _, node in entry_points}
+        candidates = list(entry_points)
+        heapq.heapify(candidates)
+        results = [(-dist, node) for dist, node in entry_points]
+        heapq.heapify(results)
+
+        while candidates:
+            dist, node = heapq.heappop(candidates)
+            if dist > -results[0][0]:
+                break
+
+            fresh = [neighbor for neighbor in self._neighbors[node][level] if neighbor not in visited]
+            if not fresh:
+                continue
+            visited.update(fresh)
+
+            for neighbor_dist, neighbor in zip(self._distances(query, fresh).tolist(), fresh):
+                if len(results) < ef or neighbor_dist < -results[0][0]:
+                    heapq.heappush(candidates, (neighbor_dist, neighbor))
+                    heapq.heappush(results, (-neighbor_dist, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted((-dist, node) for dist, node in results)
+
+    def _select_neighbors(self, candidates: list[tuple[float, int]], max_count: int) -> list[int]:
+        """neighbor selection heuristic from the HNSW paper: prefer candidates that are closer
+        to the new node than to any already selected neighbor, then fill up with the rest"""
+        selected = []
+        for dist, node in candidates:
+            if len(selected) >= max_count:
+                break
+            if selected and (self._distances(self._vectors[node], selected) < dist).any():
+                continue
+            selected.append(node)
+
+        if len(selected) < max_count:
+            chosen = set(selected)
+            for _, node in candidates:
+                if len(selected) >= max_count:
+                    break
+                if node not in chosen:
+                    selected.append(node)
+                    chosen.add(node)
+
+        return selected
+
+    def _greedy_descend(self, query: np.ndarray, target_level: int) -> list[tuple[float, int]]:
+        entry = [(float(self._distances(query, [self._entry_point])[0]), self._entry_point)]
+        for level in range(self._max_level, target_level, -1):
+            entry = self._search_layer(query, entry, 1, level)[:1]
+        return entry
+
+    def _insert(self, row_id, vector: np.ndarray) -> None:
+        node = self._count
+        self._vectors[node] = vector
+        self._count += 1
+
+        level = int(-math.log(1.0 - self._rng.random()) * self.level_mult)
+        self._neighbors.append([[] for _ in range(level + 1)])
+        self._labels.append(row_id)
+        self._nodes[row_id] = node
+
+        if self._entry_point is None:
+            self._entry_point = node
+            self._max_level = level
+            return
+
+        query = self._vectors[node]
+        entry = self._greedy_descend(query, level)
+
+        for current_level in range(min(level, self._max_level), -1, -1):
+            candidates = self._search_layer(query, entry, self.ef_construction, current_level)
+            max_count = self.max_neighbors0 if current_level == 0 else self.M
+
+            neighbors = self._select_neighbors(candidates, self.M)
+            self._neighbors[node][current_level] = neighbors
+
+            self._dirty_nodes.update(neighbors)
+            for neighbor in neighbors:
+                links = self._neighbors[neighbor][current_level]
+                links.append(node)
+                if len(links) > max_count:
+                    ranked = sorted(zip(self._distances(self._vectors[neighbor], links).tolist(), links))
+                    self._neighbors[neighbor][current_level] = self._select_neighbors(ranked, max_count)
+
+            entry = candidates
+
+        if level > self._max_level:
+            self._max_level = level
+            self._entry_point = node
+
+    def add(self, row_ids: list, vectors, rows = None) -> None:
+        """inserts vectors under the given row ids, re-adding an existing id replaces it.
+        rows are the (text_segment, username, speaker, created_at) tuples returned by search"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+
+        with self._lock:
+            self._ensure_capacity(len(row_ids))
+            self._dirty_rows.update(row_ids)
+            for i, row_id in enumerate(row_ids):
+                if row_id in self._nodes:
+                    self._tombstone(self._nodes.pop(row_id))
+                self._insert(row_id, vectors[i])
+                if rows is not None:
+                    self._untrack(row_id)
+                    self._rows[row_id] = rows[i]
+                    self._tenants.setdefault(rows[i][1], set()).add(row_id)
+
+    def remove(self, row_ids: list) -> None:
+        with self._lock:
+            self._dirty_rows.update(row_ids)
+            for row_id in row_ids:
+                node = self._nodes.pop(row_id, None)
+                if node is not None:
+                    self._tombstone(node)
+                self._untrack(row_id)
+                self._rows.pop(row_id, None)
+
+    def _tombstone(self, node: int) -> None:
+        self._deleted.add(node)
+        self._new_deleted.add(node)
+
+    def _untrack(self, row_id) -> None:
+        row = self._rows.get(row_id)
+        if row is not None:
+            tenant = self._tenants.get(row[1])
+            if tenant is not None:
+                tenant.discard(row_id)
+                if not tenant:
+                    del self._tenants[row[1]]
+
+    def get_row(self, row_id):
+        return self._rows.get(row_id)
+
+    def get_vector(self, row_id):
+        node = self._nodes.get(row_id)
+        return None if node is None else np.array(self._vectors[node])
+
+    def tenant_size(self, username) -> int:
+        return len(self._tenants.get(username, ()))
+
+    def _search_rows(self, query: np.ndarray, row_ids, k: int, filter_fn = None) -> list[tuple[int, float]]:
+        """exact search over just row_ids, for tenants small enough that scanning them beats the graph"""
+        row_ids = [row_id for row_id in row_ids if filter_fn is None or filter_fn(row_id)]
+        if not row_ids:
+            return []
+        distances = self._distances(query, [self._nodes[row_id] for row_id in row_ids])
+        order = np.argsort(distances)[:k]
+        return [(row_ids[i], float(distances[i])) for i in order]
+
+    def search(self, query_embedding: list[float], k: int, ef = None, username = None, filter_fn = None) -> list[tuple[int, float]]:
+        """returns up to k (row id, squared distance) pairs, nearest first.
+        username restricts results to that user's rows and filter_fn(row id) to rows it accepts.
+        a user with few rows is scanned exactly, otherwise filtered-out rows are skipped like tombstones
+        while the beam widens, so a filtered search costs about what an unfiltered one does"""
+        query = np.asarray(query_embedding, dtype=np.float32)
+
+        with self._lock:
+            if self._entry_point is None or k <= 0 or not self._nodes:
+                return []
+
+            ef = max(ef or self.ef_search, k)
+
+            if username is not None:
+                tenant = self._tenants.get(username, ())
+                if len(tenant) <= max(self.TENANT_SCAN_ROWS, ef):
+                    return self._search_rows(query, list(tenant), k, filter_fn)
+                accept = filter_fn
+                filter_fn = lambda row_id: self._rows[row_id][1] == username and (accept is None or accept(row_id))
+
+            entry = self._greedy_descend(query, 0)
+
+            while True:
+                candidates = self._search_layer(query, entry, ef, 0)
+                live = [
+                    (self._labels[node], dist) for dist, node in candidates
+                    if node not in self._deleted and (filter_fn is None or filter_fn(self._labels[node]))
+                ]
+                # tombstones and filtered-out rows take up slots in the beam, widen it until k rows come back
+                if len(live) >= k or ef >= self._count:
+                    return live[:k]
+                ef *= 2
+
+    def compact(self) -> None:
+        """rebuilds the graph from live nodes only, dropping tombstones"""
+        with self._lock:
+            live = sorted(self._nodes.items(), key=lambda item: item[1])
+            rebuilt = HNSWIndex(self.dim, self.M, self.ef_construction, self.ef_search)
+            if live:
+                rebuilt.add([row_id for row_id, _ in live], self._vectors[[node for _, node in live]])
+
+            self._vectors = rebuilt._vectors
+            self._count = rebuilt._count
+            self._neighbors = rebuilt._neighbors
+            self._labels = rebuilt._labels
+            self._nodes = rebuilt._nodes
+            self._deleted = set()
+            self._entry_point = rebuilt._entry_point
+            self._max_level = rebuilt._max_level
+            # node numbers changed, the next save has to write a snapshot
+            self._snapshot = None
+
+    def maybe_compact(self) -> bool:
+        """compacts when more than COMPACT_FRACTION of the nodes are tombstones"""
+        with self._lock:
+            if self._count and len(self._deleted) > self._count * self.COMPACT_FRACTION:
+                self.compact()
+                return True
+            return False
+
+    def save(self, path: str) -> None:
+        """persists what changed since the last save: one record appended to the log, or a new snapshot
+        when there is none yet, this index isn't the one on disk, or the log has grown past SNAPSHOT_ROWS.
+        compacts first when there are too many tombstones"""
+        os.makedirs(path, exist_ok=True)
+
+        with self._lock:
+            self.maybe_compact()
+
+            added = self._count - self._saved_count
+            if (self._snapshot is None or self._snapshot != self._log_snapshot(path)
+                    or self._log_rows + added > max(self.SNAPSHOT_ROWS, self._count * self.SNAPSHOT_FRACTION)):
+                self._write_snapshot(path)
+            elif added or self._dirty_rows or self._new_deleted:
+                self._append_log(path)
+
+    def _mark_saved(self) -> None:
+        self._saved_count = self._count
+        self._dirty_nodes = set()
+        self._dirty_rows = set()
+        self._new_deleted = set()
+
+    def _log_snapshot(self, path: str):
+        """the snapshot id in graph.log's header, None without a log"""
+        try:
+            with open(os.path.join(path, self.LOG_FILE), "rb") as f:
+                header = f.read(8)
+        except FileNotFoundError:
+            return None
+        return struct.unpack("<Q", header)[0] if len(header) == 8 else None
+
+    def _append_log(self, path: str) -> None:
+        start = self._saved_count
+        record = {
+            "start": start,
+            "vectors": np.array(self._vectors[start:self._count]),
+            "labels": self._labels[start:self._count],
+            "neighbors": {node: self._neighbors[node] for node in self._dirty_nodes if node < start},
+            "new_neighbors": self._neighbors[start:self._count],
+            "rows": {row_id: (self._nodes.get(row_id), self._rows.get(row_id)) for row_id in self._dirty_rows},
+            "deleted": self._new_deleted,
+            "entry_point": self._entry_point,
+            "max_level": self._max_level
+        }
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # one write of length + payload, a reader that catches it half written stops before it
+        with open(os.path.join(path, self.LOG_FILE), "ab") as f:
+            f.write(struct.pack("<Q", len(payload)) + payload)
+            self._log_position = f.tell()
+
+        self._log_rows += self._count - start
+        self._mark_saved()
+
+    def _write_snapshot(self, path: str) -> None:
+        """writes vectors as a .npy file (memory-mapped on load), a pickled graph and an empty log.
+        the log is replaced before the graph, and a reader only applies a log whose header names the
+        snapshot it loaded, so readers never see a mix"""
+        snapshot = time.time_ns()
+        vectors_file = f"vectors-{snapshot}.npy"
+        np.save(os.path.join(path, vectors_file), self._vectors[:self._count])
+
+        state = {
+            "dim": self.dim,
+            "M": self.M,
+            "ef_construction": self.ef_construction,
+            "ef_search": self.ef_search,
+            "snapshot": snapshot,
+            "vectors_file": vectors_file,
+            "count": self._count,
+            "neighbors": self._neighbors,
+            "labels": self._labels,
+            "nodes": self._nodes,
+            "rows": self._rows,
+            "deleted": self._deleted,
+            "entry_point": self._entry_point,
+            "max_level": self._max_level
+        }
+
+        graph_path = os.path.join(path, self.GRAPH_FILE)
+        log_path = os.path.join(path, self.LOG_FILE)
+        with open(log_path + ".tmp", "wb") as f:
+            f.write(struct.pack("<Q", snapshot))
+        os.replace(log_path + ".tmp", log_path)
+
+        with open(graph_path + ".tmp", "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(graph_path + ".tmp", graph_path)
+
+        self._snapshot = snapshot
+        self._log_position = 8
+        self._log_rows = 0
+        self._mark_saved()
+
+        # readers that read the previous graph file may not have opened its vectors yet, keep them until the next snapshot
+        older = sorted(
+            (filename for filename in os.listdir(path) if filename.startswith("vectors-") and filename != vectors_file),
+            key=lambda filename: int(filename[len("vectors-"):-len(".npy")])
+        )
+        for filename in older[:-1]:
+            os.remove(os.path.join(path, filename))
+
+    @classmethod
+    def load(cls, path: str, ef_search = None):
+        """the snapshot at path with every complete log record applied"""
+        for attempt in range(3):
+            with open(os.path.join(path, cls.GRAPH_FILE), "rb") as f:
+                state = pickle.load(f)
+            try:
+                vectors = np.load(os.path.join(path, state["vectors_file"]), mmap_mode="r")
+                break
+            except FileNotFoundError:
+                # two snapshots were written since the graph file was read, read the current one
+                if attempt == 2:
+                    raise
+
+        index = cls(state["dim"], state["M"], state["ef_construction"], ef_search or state["ef_search"])
+        index._vectors = vectors
+        index._count = state["count"]
+        index._neighbors = state["neighbors"]
+        index._labels = state["labels"]
+        index._nodes = state["nodes"]
+        index._rows = state["rows"]
+        for row_id, row in index._rows.items():
+            index._tenants.setdefault(row[1], set()).add(row_id)
+        index._deleted = state["deleted"]
+        index._entry_point = state["entry_point"]
+        index._max_level = state["max_level"]
+        index._snapshot = state.get("snapshot")
+        index._saved_count = index._count
+        index._log_position = 8
+        index.refresh(path)
+
+        return index
+
+    def refresh(self, path: str) -> bool:
+        """applies the log records appended since this index was loaded or last refreshed.
+        False when the log belongs to a different snapshot, the index has to be loaded again then"""
+        with self._lock:
+            try:
+                with open(os.path.join(path, self.LOG_FILE), "rb") as f:
+                    header = f.read(8)
+                    if len(header) < 8 or struct.unpack("<Q", header)[0] != self._snapshot:
+                        return False
+                    f.seek(self._log_position)
+                    data = f.read()
+            except FileNotFoundError:
+                return False
+
+            position = 0
+            while position + 8 <= len(data):
+                length = struct.unpack_from("<Q", data, position)[0]
+                if position + 8 + length > len(data):
+                    break
+                if not self._apply(pickle.loads(data[position + 8:position + 8 + length])):
+                    return False
+                position += 8 + length
+                self._log_position += 8 + length
+
+            self._mark_saved()
+            return True
+
+    def _apply(self, record: dict) -> bool:
+        start = record["start"]
+        if start != self._count:
+            return False
+
+        added = len(record["labels"])
+        if added:
+            self._ensure_capacity(added)
+            self._vectors[start:start + added] = record["vectors"]
+            self._count += added
+        self._labels.extend(record["labels"])
+        self._neighbors.extend(record["new_neighbors"])
+        for node, links in record["neighbors"].items():
+            self._neighbors[node] = links
+
+        for row_id, (node, row) in record["rows"].items():
+            self._untrack(row_id)
+            if node is None:
+                self._nodes.pop(row_id, None)
+            else:
+                self._nodes[row_id] = node
+            if row is None:
+                self._rows.pop(row_id, None)
+            else:
+                self._rows[row_id] = row
+                self._tenants.setdefault(row[1], set()).add(row_id)
+
+        self._deleted.update(record["deleted"])
+        self._entry_point = record["entry_point"]
+        self._max_level = record["max_level"]
+        self._log_rows += added
+        return True
+
+    @classmethod
+    def saved_version(cls, path: str):
+        """modification time of the saved graph and size of its log, None if nothing has been saved yet"""
+        try:
+            return os.stat(os.path.join(path, cls.GRAPH_FILE)).st_mtime_ns, os.stat(os.path.join(path, cls.LOG_FILE)).st_size
+        except FileNotFoundError:
+            return None
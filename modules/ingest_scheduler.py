@@ -0,0 +1,212 @@
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from modules import aws_clients, s3_interactor
+
+"""schedules s3 files for ingestion.
+new keys come from object-created notifications (an SQS queue subscribed to the bucket, or a
+local in-process queue standing in for it). a paginated listing runs as a fallback: continuously
+with adaptive backoff when there is no notification source, otherwise every listing_interval seconds
+to pick up anything a notification missed. keys are handed to a worker pool, each key at most once at a time."""
+
+logger = logging.getLogger(__name__)
+
+INGEST_MAX_WORKERS = int(os.getenv("INGEST_MAX_WORKERS", str(os.cpu_count() or 4)))
+
+
+class LocalNotificationSource:
+    """in-process stand-in for an SQS queue, publish() keys from anywhere in the process"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def publish(self, bucket: str, key: str) -> None:
+        self._queue.put((bucket, key))
+
+    def receive(self, wait_seconds: float) -> list[tuple[tuple[str, str], None]]:
+        """returns [((bucket, key), receipt)], blocking up to wait_seconds for the first one"""
+        try:
+            events = [(self._queue.get(timeout=wait_seconds), None)]
+        except queue.Empty:
+            return []
+
+        while True:
+            try:
+                events.append((self._queue.get_nowait(), None))
+            except queue.Empty:
+                return events
+
+    def ack(self, receipt) -> None:
+        pass
+
+
+class SQSNotificationSource:
+    """reads s3 event notifications (direct or wrapped by SNS) from an SQS queue with long polling.
+    a message is deleted only after every key in it was processed, otherwise it becomes visible again"""
+
+    def __init__(self, queue_url: str):
+        self.queue_url = queue_url
+        self.sqs_client = aws_clients.get_client('sqs')
+
+    @staticmethod
+    def _parse(body: str) -> list[tuple[str, str]]:
+        message = json.loads(body)
+        if "Message" in message and "Records" not in message:
+            message = json.loads(message["Message"])
+
+        keys = []
+        for record in message.get("Records", []):
+            if not record.get("eventName", "").startswith("ObjectCreated"):
+                continue
+            keys.append((record["s3"]["bucket"]["name"], unquote_plus(record["s3"]["object"]["key"])))
+        return keys
+
+    def receive(self, wait_seconds: float) -> list[tuple[tuple[str, str], str]]:
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=int(min(20, max(0, wait_seconds)))
+        )
+
+        events = []
+        for message in response.get("Messages", []):
+            try:
+                keys = self._parse(message["Body"])
+            except (ValueError, KeyError):
+                logger.warning(f"dropping unparseable notification {message.get('MessageId')}")
+                keys = []
+
+            if not keys:
+                # test events and non-create notifications carry nothing to ingest
+                self.ack(message["ReceiptHandle"])
+            for key in keys:
+                events.append((key, message["ReceiptHandle"]))
+        return events
+
+    def ack(self, receipt) -> None:
+        self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+
+class IngestionScheduler:
+
+    def __init__(self, handler, bucket_name: str, file_extension = ".json", source = None,
+                 max_workers = INGEST_MAX_WORKERS, listing_interval = 300.0, min_backoff = 1.0, max_backoff = 60.0):
+        """handler(key) processes one file. it runs on the worker pool and should raise on failure"""
+        self.handler = handler
+        self.bucket_name = bucket_name
+        self.file_extension = file_extension
+        self.source = source
+        self.max_workers = max_workers
+        self.listing_interval = listing_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._slots = threading.BoundedSemaphore(max_workers * 2)
+        self._lock = threading.Lock()
+        self._in_flight = {}   # key -> receipts to ack once it's done
+        self._stop = threading.Event()
+
+        self.dispatched = 0
+        self.failed = 0
+
+    def dispatch(self, key: str, receipt = None) -> bool:
+        """queues key for the worker pool, returns False if it is already in flight"""
+        with self._lock:
+            if key in self._in_flight:
+                if receipt is not None:
+                    self._in_flight[key].append(receipt)
+                return False
+            self._in_flight[key] = [receipt] if receipt is not None else []
+
+        # blocks once 2 * max_workers files are queued, so listing can't run far ahead of the workers
+        self._slots.acquire()
+        self._executor.submit(self._run, key)
+        with self._lock:
+            self.dispatched += 1
+        return True
+
+    def _run(self, key: str) -> None:
+        succeeded = False
+        try:
+            self.handler(key)
+            succeeded = True
+        except Exception as e:
+            logger.error(f"failed to ingest {key}: {e}")
+        finally:
+            with self._lock:
+                receipts = self._in_flight.pop(key, [])
+                if not succeeded:
+                    self.failed += 1
+            self._slots.release()
+
+        if succeeded and self.source is not None:
+            for receipt in receipts:
+                try:
+                    self.source.ack(receipt)
+                except ClientError as e:
+                    logger.warning(f"failed to ack notification for {key}: {e}")
+
+    def _poll_notifications(self, wait_seconds: float) -> int:
+        dispatched = 0
+        for (bucket, key), receipt in self.source.receive(wait_seconds):
+            if bucket != self.bucket_name or not s3_interactor.is_ingestible_key(key, self.file_extension):
+                if receipt is not None:
+                    self.source.ack(receipt)
+                continue
+            dispatched += self.dispatch(key, receipt)
+        return dispatched
+
+    def _list_bucket(self) -> int:
+        dispatched = 0
+        try:
+            for key in s3_interactor.iter_bucket_filenames(self.file_extension, self.bucket_name):
+                if self._stop.is_set():
+                    break
+                dispatched += self.dispatch(key)
+        except ClientError as e:
+            logger.error(f"listing {self.bucket_name} failed: {e}")
+        return dispatched
+
+    def run(self) -> None:
+        """runs until stop() is called"""
+        backoff = self.min_backoff
+        next_listing = time.monotonic()
+
+        while not self._stop.is_set():
+            found = 0
+
+            if self.source is not None:
+                found += self._poll_notifications(wait_seconds=backoff)
+
+            if time.monotonic() >= next_listing:
+                found += self._list_bucket()
+                next_listing = time.monotonic() + (self.listing_interval if self.source is not None else 0)
+
+            if found:
+                backoff = self.min_backoff
+                continue
+
+            if self.source is None:
+                logger.info(f"no files, waiting {backoff:.0f}s")
+                self._stop.wait(backoff)
+            backoff = min(self.max_backoff, backoff * 2)
+
+    def stop(self, wait = True) -> None:
+        self._stop.set()
+        self._executor.shutdown(wait=wait)
+
+
+def notification_source_from_env(variable = "INGEST_QUEUE_URL"):
+    """SQS when the queue url environment variable is set, otherwise None (listing only)"""
+    queue_url = os.getenv(variable)
+    if queue_url:
+        return SQSNotificationSource(queue_url)
+    return None
@@ -0,0 +1,146 @@
+import time
+
+import numpy as np
+
+"""compact embedding codes for a cheap first search pass.
+"binary" keeps one sign bit per dimension (128 bytes for 1024 dims) and ranks by hamming distance,
+"int8" keeps one byte per dimension with a per-dimension scale and ranks by approximate L2.
+the top k * candidate_multiplier rows of the coarse pass are then reranked with the full vectors."""
+
+QUANTIZATION_MODES = ("binary", "int8")
+
+# number of set bits in every byte value
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def binary_codes(vectors) -> np.ndarray:
+    """sign bits packed into uint64 words, so hamming distance is xor + popcount per word"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    packed = np.packbits(vectors > 0, axis=-1)
+    padding = -packed.shape[-1] % 8
+    if padding:
+        packed = np.concatenate([packed, np.zeros(packed.shape[:-1] + (padding,), dtype=np.uint8)], axis=-1)
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def hamming_distances(codes: np.ndarray, query_code: np.ndarray) -> np.ndarray:
+    xor = np.bitwise_xor(codes, query_code)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(xor).sum(axis=-1, dtype=np.int32)
+    return _POPCOUNT[xor.view(np.uint8)].sum(axis=-1, dtype=np.int32)
+
+
+class Int8Codes:
+    """symmetric per-dimension scalar quantization, x ~= codes * scale"""
+
+    def __init__(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        max_abs = np.abs(vectors).max(axis=0) if len(vectors) else np.ones(vectors.shape[1], dtype=np.float32)
+        self.scale = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+        self.codes = np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+        self.norms = np.einsum("ij,ij->i", vectors, vectors)
+
+    def approximate_distances(self, queries: np.ndarray, chunk_rows = 16384) -> np.ndarray:
+        """squared L2 for each of queries (shape (q, dim)) using exact norms and the quantized dot product.
+        numpy has no int8 matrix product, so codes are widened chunk by chunk and shared by every query"""
+        scaled = (queries * self.scale).T
+        products = np.empty((len(self.codes), len(queries)), dtype=np.float32)
+        for start in range(0, len(self.codes), chunk_rows):
+            products[start:start + chunk_rows] = self.codes[start:start + chunk_rows].astype(np.float32) @ scaled
+        return (self.norms[:, None] - 2.0 * products + np.einsum("ij,ij->i", queries, queries)[None, :]).T
+
+
+class QuantizedCodes:
+    """coarse codes for one block of vectors"""
+
+    def __init__(self, vectors, mode: str):
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"unknown quantization mode: {mode}")
+
+        self.mode = mode
+        self.count = len(vectors)
+        if mode == "binary":
+            self.codes = binary_codes(vectors)
+        else:
+            self.codes = Int8Codes(vectors)
+
+    def coarse_candidates(self, queries: np.ndarray, n: int, mask = None) -> list[np.ndarray]:
+        """offsets of the n best rows by the coarse metric, one array per query"""
+        if self.mode == "binary":
+            scores = np.stack([hamming_distances(self.codes, binary_codes(query)) for query in queries]).astype(np.float32)
+        else:
+            scores = self.codes.approximate_distances(queries)
+
+        if mask is not None:
+            scores = np.where(mask[None, :], scores, np.inf)
+
+        n = min(n, self.count)
+        candidates = []
+        for query_scores in scores:
+            best = np.argpartition(query_scores, n - 1)[:n] if n < self.count else np.arange(self.count)
+            candidates.append(best[np.isfinite(query_scores[best])])
+        return candidates
+
+    @property
+    def nbytes(self) -> int:
+        if self.mode == "binary":
+            return self.codes.nbytes
+        return self.codes.codes.nbytes
+
+
+def recall_at_k(exact: list[list], approximate: list[list], k: int) -> float:
+    """fraction of the exact top-k ids that the approximate search also returned, averaged over queries"""
+    if not exact:
+        return 1.0
+
+    total = 0.0
+    for exact_hits, approximate_hits in zip(exact, approximate):
+        truth = {row_id for row_id, _ in exact_hits[:k]}
+        found = {row_id for row_id, _ in approximate_hits[:k]}
+        total += len(truth & found) / len(truth) if truth else 1.0
+
+    return total / len(exact)
+
+
+def recall_report(search_exact, search_quantized, queries, k = 10, multipliers = (1, 2, 4, 8, 16, 32)) -> list[dict]:
+    """runs every query through exact search and through quantized search at each candidate multiplier.
+    search_exact(queries, k) and search_quantized(queries, k, multiplier) return [[(row id, distance)]] per query.
+    returns one {multiplier, recall, ms_per_query} dict per multiplier, with exact search as multiplier None"""
+    started = time.perf_counter()
+    exact = search_exact(queries, k)
+    report = [{
+        "multiplier": None,
+        "recall": 1.0,
+        "ms_per_query": (time.perf_counter() - started) * 1000 / max(1, len(queries))
+    }]
+
+    for multiplier in multipliers:
+        started = time.perf_counter()
+        approximate = search_quantized(queries, k, multiplier)
+        report.append({
+            "multiplier": multiplier,
+            "recall": recall_at_k(exact, approximate, k),
+            "ms_per_query": (time.perf_counter() - started) * 1000 / max(1, len(queries))
+        })
+
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from modules import database_interactor
+
+    parser = argparse.ArgumentParser(description="recall@k of quantized search against exact search")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100, help="number of stored embeddings to use as queries")
+    parser.add_argument("--mode", choices=QUANTIZATION_MODES, default=None)
+    parser.add_argument("--multipliers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    report = database_interactor.quantization_recall_report(args.k, args.queries, args.multipliers, args.mode)
+
+    print(f"{'multiplier':>10}  {'recall@' + str(args.k):>10}  {'ms/query':>9}")
+    for row in report:
+        multiplier = "exact" if row["multiplier"] is None else f"x{row['multiplier']}"
+        print(f"{multiplier:>10}  {row['recall']:>10.3f}  {row['ms_per_query']:>9.2f}")
@@ -1,20 +1,21 @@
-import boto3
 from botocore.exceptions import ClientError
 import os
 from dotenv import load_dotenv
 import json
 
+from modules import aws_clients
+
 load_dotenv()
 
 BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
 AUDIO_BUCKET_NAME = os.getenv("AUDIO_BUCKET")
 
-def bucket_empty() -> bool:
+def bucket_empty(bucket_name = BUCKET_NAME) -> bool:
     """returns a boolean value to check if bucket is empty"""
-    s3_client = boto3.client('s3')
+    s3_client = aws_clients.get_client('s3')
 
     try:
-        response = s3_client.list_objects_v2(Bucket=BUCKET_NAME)
+        response = s3_client.list_objects_v2(Bucket=bucket_name, MaxKeys=1)
 
         if 'Contents' not in response:
             return True
@@ -24,22 +25,27 @@ def bucket_empty() -> bool:
     except ClientError as e:
         print(f"Error occurred: {e}")
         return False  
+
+def is_ingestible_key(key: str, file_extension = ".json") -> bool:
+    """top level files of the given filetype, ignoring directories and the transcribe access check file"""
+    return "/" not in key and key.endswith(file_extension) and key != ".write_access_check_file.temp"
+
+def iter_bucket_filenames(file_extension = ".json", bucket_name = BUCKET_NAME, page_size = 1000):
+    """yields matching filenames page by page, following continuation tokens past the 1000 key cap"""
+    s3_client = aws_clients.get_client('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    for page in paginator.paginate(Bucket=bucket_name, PaginationConfig={'PageSize': page_size}):
+        for obj in page.get('Contents', []):
+            if is_ingestible_key(obj['Key'], file_extension):
+                yield obj['Key']
     
 def get_bucket_filenames(file_extension = ".json", bucket_name = BUCKET_NAME) -> list[str]:
     """returns the filenames of all files in the s3 bucket
     only returns files of given filetype and ignored directories"""
-    s3_client = boto3.client('s3')
-    filenames = []
 
     try:
-        response = s3_client.list_objects_v2(Bucket=bucket_name)
-
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                key = obj['Key']
-                if "/" not in key and key.endswith(file_extension) and key != ".write_access_check_file.temp":
-                    filenames.append(key)
-        return filenames
+        return list(iter_bucket_filenames(file_extension, bucket_name))
 
     except ClientError as e:
         print(f"Error occurred: {e}")
@@ -47,7 +53,7 @@ def get_bucket_filenames(file_extension = ".json", bucket_name = BUCKET_NAME) ->
     
 def read_pop_file(filename: str) -> str:
     """return the given file contents and deletes the file"""
-    s3_client = boto3.client('s3')
+    s3_client = aws_clients.get_client('s3')
     try:
         response = s3_client.get_object(Bucket=BUCKET_NAME, Key=filename)
 
@@ -74,7 +80,7 @@ def get_transcript_from_file_contents(json_data: str) -> str:
     
 def move_s3_file(source_key: str, destination_key: str, bucket_name = BUCKET_NAME) -> bool:
     """Moves a file within an S3 bucket from source_key to destination_key."""
-    s3_client = boto3.client('s3')
+    s3_client = aws_clients.get_client('s3')
     
     try:
         s3_client.copy_object(
@@ -92,7 +98,7 @@ def move_s3_file(source_key: str, destination_key: str, bucket_name = BUCKET_NAM
 
 # def upload_audio(file_obj, filename) -> dict[str, str]:
 #         try:
-#             s3_client = boto3.client('s3')
+#             s3_client = aws_clients.get_client('s3')
 #             s3_key = f'{filename}'
 
 #             s3_client.upload_fileobj(
@@ -0,0 +1,540 @@
+import argparse
+from contextlib import contextmanager
+from datetime import date
+import hashlib
+import json
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+from modules import database_interactor
+
+"""schema migrations and index management for the embeddings table.
+
+    python -m modules.schema_manager migrate
+    python -m modules.schema_manager create-vector-index --method hnsw --m 16 --ef-construction 64
+    python -m modules.schema_manager create-vector-index --method ivfflat --lists 1000
+    python -m modules.schema_manager create-vector-index --method hnsw --binary
+    python -m modules.schema_manager create-tenant-indexes --min-rows 50000
+    python -m modules.schema_manager tune --ef-search 100 --iterative-scan strict_order
+    python -m modules.schema_manager partition --months-ahead 3
+    python -m modules.schema_manager ensure-partitions --months-ahead 3
+    python -m modules.schema_manager reindex embeddings_embedding_hnsw_idx
+    python -m modules.schema_manager report
+
+indexes are built with CREATE INDEX CONCURRENTLY (per partition, then attached, when the table
+is partitioned) and rebuilt with REINDEX CONCURRENTLY, so reads and writes continue meanwhile."""
+
+TABLE = "embeddings"
+
+# (version, description, statements). statements run in order, each in autocommit mode
+MIGRATIONS = [
+    (1, "create embeddings table", [
+        "CREATE EXTENSION IF NOT EXISTS vector",
+        f"""
+        CREATE TABLE IF NOT EXISTS {TABLE} (
+            id SERIAL PRIMARY KEY,
+            text_segment TEXT NOT NULL,
+            embedding vector({database_interactor.EMBEDDING_DIM}),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            username TEXT NOT NULL,
+            speaker TEXT
+        )
+        """
+    ]),
+    (2, "full-text search column", [
+        f"""
+        ALTER TABLE {TABLE}
+        ADD COLUMN IF NOT EXISTS text_search tsvector
+        GENERATED ALWAYS AS (to_tsvector('english', text_segment)) STORED
+        """
+    ]),
+    (3, "full-text, timestamp, username and speaker indexes", [
+        ("embeddings_text_search_idx", "USING GIN (text_search)"),
+        # created_at only grows, so a BRIN index stays tiny and serves range scans
+        ("embeddings_created_at_brin_idx", "USING BRIN (created_at)"),
+        ("embeddings_username_created_at_idx", "(username, created_at)"),
+        ("embeddings_username_speaker_idx", "(username, speaker)")
+    ]),
+    (4, "recording each segment was transcribed from", [
+        f"ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS recording TEXT",
+        ("embeddings_recording_id_idx", "(recording, id)")
+    ])
+]
+
+
+@contextmanager
+def _connection():
+    """a dedicated autocommit connection, CREATE INDEX CONCURRENTLY can't run inside a transaction"""
+    conn = psycopg2.connect(**database_interactor.get_pool().connect_kwargs)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            yield cursor
+    finally:
+        conn.close()
+
+
+def _ensure_bookkeeping(cursor) -> None:
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS index_builds (
+        index_name TEXT NOT NULL,
+        definition TEXT NOT NULL,
+        seconds DOUBLE PRECISION NOT NULL,
+        size_bytes BIGINT,
+        built_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+def _partitions(cursor, table = TABLE) -> list[str]:
+    cursor.execute("""
+    SELECT child.relname
+    FROM pg_inherits
+    JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = %s
+    ORDER BY child.relname
+    """, (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _index_size(cursor, index_name: str) -> int:
+    """size of an index, summed over its partitions when it is a partitioned index"""
+    cursor.execute("""
+    SELECT COALESCE(SUM(pg_relation_size(inhrelid)), 0) + pg_relation_size(%s::regclass)
+    FROM pg_inherits WHERE inhparent = %s::regclass
+    """, (index_name, index_name))
+    return cursor.fetchone()[0]
+
+
+def _index_valid(cursor, index_name: str, table: str):
+    """None when table has no index called index_name, otherwise whether that index is valid"""
+    cursor.execute("""
+    SELECT idx.indisvalid
+    FROM pg_index idx
+    JOIN pg_class i ON i.oid = idx.indexrelid
+    JOIN pg_class t ON t.oid = idx.indrelid
+    WHERE i.relname = %s AND t.relname = %s
+    """, (index_name, table))
+    row = cursor.fetchone()
+    return None if row is None else row[0]
+
+
+def _drop_invalid(cursor, index_name: str, table: str, partitioned = False) -> bool:
+    """drops index_name if it is a leftover of a failed or interrupted build on table, returns whether it exists now"""
+    valid = _index_valid(cursor, index_name, table)
+    if valid is None:
+        return False
+    if valid:
+        return True
+
+    print(f"{index_name} is invalid (interrupted build), dropping it")
+    # DROP INDEX CONCURRENTLY isn't supported on partitioned indexes, dropping one also drops its partitions' indexes
+    drop = "DROP INDEX IF EXISTS {}" if partitioned else "DROP INDEX CONCURRENTLY IF EXISTS {}"
+    cursor.execute(sql.SQL(drop).format(sql.Identifier(index_name)))
+    return False
+
+
+def create_index(cursor, index_name: str, definition: str, table = TABLE) -> dict:
+    """builds an index without blocking writes and records how long it took.
+    definition is everything after the table name, e.g. "USING BRIN (created_at)".
+    on a partitioned table the parent index is created ON ONLY, each partition's index
+    is built concurrently and attached, which makes the parent index valid once all are attached.
+    an index of the same name left invalid on table by a failed build is dropped and rebuilt"""
+    partitions = _partitions(cursor, table)
+
+    if _drop_invalid(cursor, index_name, table, partitioned=bool(partitions)):
+        print(f"{index_name} already exists")
+        return {"index": index_name, "seconds": 0.0, "size_bytes": _index_size(cursor, index_name)}
+
+    started = time.perf_counter()
+
+    if partitions:
+        cursor.execute(sql.SQL("CREATE INDEX {} ON ONLY {} ").format(sql.Identifier(index_name), sql.Identifier(table)) + sql.SQL(definition))
+        for partition in partitions:
+            partition_index = f"{partition}_{index_name}"[:63]
+            _drop_invalid(cursor, partition_index, partition)
+            cursor.execute(sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ").format(
+                sql.Identifier(partition_index), sql.Identifier(partition)
+            ) + sql.SQL(definition))
+            cursor.execute(sql.SQL("ALTER INDEX {} ATTACH PARTITION {}").format(sql.Identifier(index_name), sql.Identifier(partition_index)))
+    else:
+        cursor.execute(sql.SQL("CREATE INDEX CONCURRENTLY {} ON {} ").format(sql.Identifier(index_name), sql.Identifier(table)) + sql.SQL(definition))
+
+    seconds = time.perf_counter() - started
+    size = _index_size(cursor, index_name)
+    cursor.execute(
+        "INSERT INTO index_builds (index_name, definition, seconds, size_bytes) VALUES (%s, %s, %s, %s)",
+        (index_name, definition, seconds, size)
+    )
+
+    print(f"built {index_name} in {seconds:.1f}s ({_format_bytes(size)})")
+    return {"index": index_name, "seconds": seconds, "size_bytes": size}
+
+
+def migrate() -> list[int]:
+    """applies every migration that hasn't been applied yet, returns their versions"""
+    applied = []
+
+    with _connection() as cursor:
+        _ensure_bookkeeping(cursor)
+        cursor.execute("SELECT version FROM schema_migrations")
+        done = {row[0] for row in cursor.fetchall()}
+
+        for version, description, statements in MIGRATIONS:
+            if version in done:
+                continue
+
+            print(f"applying {version}: {description}")
+            for statement in statements:
+                if isinstance(statement, tuple):
+                    create_index(cursor, *statement)
+                else:
+                    cursor.execute(statement)
+
+            cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description))
+            applied.append(version)
+
+    return applied
+
+
+def recommended_ivfflat_lists(row_count: int) -> int:
+    """pgvector's guidance: rows / 1000 up to a million rows, sqrt(rows) beyond"""
+    if row_count <= 1000000:
+        return max(1, row_count // 1000)
+    return int(row_count ** 0.5)
+
+
+def create_vector_index(method = "hnsw", m = 16, ef_construction = 64, lists = None, binary = False,
+                        opclass = None, maintenance_work_mem = "1GB", name = None) -> dict:
+    """builds an approximate nearest neighbour index on embedding.
+    binary indexes binary_quantize(embedding) with hamming distance for the quantized search path"""
+    if method not in ("hnsw", "ivfflat"):
+        raise ValueError(f"unknown index method: {method}")
+
+    if binary:
+        column = f"(binary_quantize(embedding)::bit({database_interactor.EMBEDDING_DIM}))"
+        opclass = opclass or "bit_hamming_ops"
+    else:
+        column = "embedding"
+        opclass = opclass or "vector_l2_ops"
+
+    with _connection() as cursor:
+        _ensure_bookkeeping(cursor)
+        cursor.execute("SET maintenance_work_mem = %s", (maintenance_work_mem,))
+
+        if method == "hnsw":
+            options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+        else:
+            if lists is None:
+                cursor.execute(f"SELECT COUNT(*) FROM {TABLE}")
+                lists = recommended_ivfflat_lists(cursor.fetchone()[0])
+            options = f"lists = {int(lists)}"
+
+        name = name or f"{TABLE}_{'binary_' if binary else ''}embedding_{method}_idx"
+        return create_index(cursor, name, f"USING {method} ({column} {opclass}) WITH ({options})")
+
+
+def _tenant_index_name(username: str) -> str:
+    slug = "".join(c if c.isalnum() else "_" for c in username.lower())[:30]
+    return f"{TABLE}_embedding_hnsw_{slug}_{hashlib.md5(username.encode('utf-8')).hexdigest()[:8]}_idx"
+
+
+def create_tenant_indexes(usernames = None, min_rows = 50000, m = 16, ef_construction = 64,
+                          maintenance_work_mem = "1GB") -> list[dict]:
+    """builds a partial HNSW index per user (WHERE username = ...) so that user's searches walk a graph
+    of only their rows. defaults to every user with at least min_rows rows; smaller users are served
+    by the shared index with iterative scans"""
+    built = []
+
+    with _connection() as cursor:
+        _ensure_bookkeeping(cursor)
+        cursor.execute("SET maintenance_work_mem = %s", (maintenance_work_mem,))
+
+        if usernames is None:
+            cursor.execute(f"SELECT username FROM {TABLE} GROUP BY username HAVING COUNT(*) >= %s ORDER BY username", (min_rows,))
+            usernames = [row[0] for row in cursor.fetchall()]
+
+        for username in usernames:
+            predicate = cursor.mogrify("username = %s", (username,)).decode("utf-8")
+            built.append(create_index(
+                cursor, _tenant_index_name(username),
+                f"USING hnsw (embedding vector_l2_ops) WITH (m = {int(m)}, ef_construction = {int(ef_construction)}) WHERE {predicate}"
+            ))
+
+    return built
+
+
+def tune(ef_search = None, probes = None, iterative_scan = None) -> None:
+    """sets database-wide defaults for query-time index parameters, new sessions pick them up"""
+    settings = {"hnsw.ef_search": ef_search, "ivfflat.probes": probes, "hnsw.iterative_scan": iterative_scan}
+
+    with _connection() as cursor:
+        for setting, value in settings.items():
+            if value is None:
+                continue
+            cursor.execute(sql.SQL("ALTER DATABASE {} SET {} = {}").format(
+                sql.Identifier(database_interactor.connection_settings()["database"]), sql.SQL(setting), sql.Literal(str(value))
+            ))
+            print(f"{setting} = {value}")
+
+
+def reindex(index_name: str) -> dict:
+    """rebuilds an index (and its partitions) without blocking reads or writes"""
+    with _connection() as cursor:
+        _ensure_bookkeeping(cursor)
+        cursor.execute("SELECT pg_get_indexdef(%s::regclass)", (index_name,))
+        definition = cursor.fetchone()[0]
+
+        started = time.perf_counter()
+        cursor.execute(sql.SQL("REINDEX INDEX CONCURRENTLY {}").format(sql.Identifier(index_name)))
+        seconds = time.perf_counter() - started
+
+        size = _index_size(cursor, index_name)
+        cursor.execute(
+            "INSERT INTO index_builds (index_name, definition, seconds, size_bytes) VALUES (%s, %s, %s, %s)",
+            (index_name, definition, seconds, size)
+        )
+
+    print(f"rebuilt {index_name} in {seconds:.1f}s ({_format_bytes(size)})")
+    return {"index": index_name, "seconds": seconds, "size_bytes": size}
+
+
+def _month_start(day: date, offset = 0) -> date:
+    month = day.month - 1 + offset
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def ensure_partitions(months_ahead = 3, table = TABLE, start = None) -> list[str]:
+    """creates monthly partitions from start (default: this month) through months_ahead months from now"""
+    created = []
+    today = date.today()
+    month = _month_start(start or today)
+
+    with _connection() as cursor:
+        existing = set(_partitions(cursor, table))
+        while month <= _month_start(today, months_ahead):
+            partition = f"{table}_{month:%Y_%m}"
+            if partition not in existing:
+                cursor.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(
+                    sql.Identifier(partition), sql.Identifier(table)
+                ), (month, _month_start(month, 1)))
+                created.append(partition)
+            month = _month_start(month, 1)
+
+    for partition in created:
+        print(f"created partition {partition}")
+    return created
+
+
+def _table_indexes(cursor, table = TABLE) -> list[tuple[str, str]]:
+    """(name, definition after the table name) of every index on table that isn't backing a unique constraint"""
+    cursor.execute("""
+    SELECT i.relname, pg_get_indexdef(i.oid)
+    FROM pg_index idx
+    JOIN pg_class i ON i.oid = idx.indexrelid
+    JOIN pg_class t ON t.oid = idx.indrelid
+    WHERE t.relname = %s AND NOT idx.indisunique
+    ORDER BY i.relname
+    """, (table,))
+    return [(name, "USING " + definition.split(" USING ", 1)[1]) for name, definition in cursor.fetchall()]
+
+
+def _unpartitioned_name(index_name: str) -> str:
+    return f"{index_name[:49]}_unpartitioned"
+
+
+def partition_table(months_ahead = 3, batch_size = 10000) -> None:
+    """converts embeddings into a table range-partitioned by month on created_at.
+    rows are copied into embeddings_partitioned in id order, then the tables are swapped in one
+    short transaction that also copies any rows the batches missed. the old table is kept as
+    embeddings_unpartitioned, its indexes renamed with an _unpartitioned suffix so their names are free,
+    and each of them is then rebuilt under its old name on the partitioned table"""
+    with _connection() as cursor:
+        if _partitions(cursor):
+            print(f"{TABLE} is already partitioned")
+            return
+
+        cursor.execute(f"SELECT MIN(created_at)::date FROM {TABLE}")
+        first_day = cursor.fetchone()[0] or date.today()
+
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE}_partitioned (
+            LIKE {TABLE} INCLUDING DEFAULTS INCLUDING GENERATED,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+        """)
+        cursor.execute(f"ALTER TABLE {TABLE}_partitioned ALTER COLUMN created_at SET NOT NULL")
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {TABLE}_default PARTITION OF {TABLE}_partitioned DEFAULT")
+
+    ensure_partitions(months_ahead, table=f"{TABLE}_partitioned", start=first_day)
+
+    with _connection() as cursor:
+        cursor.execute(f"SELECT column_name FROM information_schema.columns WHERE table_name = '{TABLE}' AND is_generated = 'NEVER' ORDER BY ordinal_position")
+        columns = sql.SQL(", ").join(sql.Identifier(row[0]) for row in cursor.fetchall())
+
+        copy = sql.SQL("""
+        INSERT INTO {partitioned} ({columns})
+        SELECT {columns} FROM {table} WHERE id > %s ORDER BY id LIMIT %s
+        RETURNING id
+        """).format(partitioned=sql.Identifier(f"{TABLE}_partitioned"), table=sql.Identifier(TABLE), columns=columns)
+
+        last_id = 0
+        copied = 0
+        started = time.perf_counter()
+        while True:
+            cursor.execute(copy, (last_id, batch_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+            last_id = max(ids)
+            copied += len(ids)
+            print(f"copied {copied} rows ({copied / (time.perf_counter() - started):.0f} rows/s)")
+
+        # ids come from a sequence but commit out of order, so a row with an id below last_id can still have
+        # committed after the batch that passed it. under the lock copy whatever is missing, not just ids > last_id
+        catch_up = sql.SQL("""
+        INSERT INTO {partitioned} ({columns})
+        SELECT {columns} FROM {table} e
+        WHERE NOT EXISTS (SELECT 1 FROM {partitioned} p WHERE p.id = e.id)
+        """).format(partitioned=sql.Identifier(f"{TABLE}_partitioned"), table=sql.Identifier(TABLE), columns=columns)
+
+        cursor.execute("BEGIN")
+        cursor.execute(f"LOCK TABLE {TABLE} IN EXCLUSIVE MODE")
+        cursor.execute(catch_up)
+        indexes = _table_indexes(cursor)
+        for index_name, _ in indexes:
+            cursor.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                sql.Identifier(index_name), sql.Identifier(_unpartitioned_name(index_name))
+            ))
+        cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {TABLE}_unpartitioned")
+        cursor.execute(f"ALTER TABLE {TABLE}_partitioned RENAME TO {TABLE}")
+        cursor.execute(f"ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id")
+        cursor.execute("COMMIT")
+
+        print(f"{TABLE} is now partitioned by month, the old table is {TABLE}_unpartitioned")
+
+        _ensure_bookkeeping(cursor)
+        for index_name, definition in indexes:
+            create_index(cursor, index_name, definition)
+
+
+def index_report() -> list[dict]:
+    """every index on the embeddings table with its size, scan count and last recorded build time"""
+    with _connection() as cursor:
+        _ensure_bookkeeping(cursor)
+        cursor.execute("""
+        SELECT i.relname, pg_get_indexdef(i.oid), idx.indisvalid,
+               COALESCE((SELECT SUM(pg_relation_size(inhrelid)) FROM pg_inherits WHERE inhparent = i.oid), 0) + pg_relation_size(i.oid),
+               COALESCE(stats.idx_scan, 0),
+               (SELECT seconds FROM index_builds b WHERE b.index_name = i.relname ORDER BY built_at DESC LIMIT 1)
+        FROM pg_index idx
+        JOIN pg_class i ON i.oid = idx.indexrelid
+        JOIN pg_class t ON t.oid = idx.indrelid
+        LEFT JOIN pg_stat_user_indexes stats ON stats.indexrelid = i.oid
+        WHERE t.relname = %s
+        ORDER BY i.relname
+        """, (TABLE,))
+
+        return [
+            {
+                "index": name,
+                "definition": definition,
+                "valid": valid,
+                "size_bytes": size,
+                "scans": scans,
+                "build_seconds": seconds
+            }
+            for name, definition, valid, size, scans, seconds in cursor.fetchall()
+        ]
+
+
+def _format_bytes(size) -> str:
+    size = float(size or 0)
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+
+def main(argv = None) -> None:
+    parser = argparse.ArgumentParser(description="embeddings schema and index management")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("migrate", help="apply pending migrations")
+
+    vector_index = commands.add_parser("create-vector-index", help="build an HNSW or IVFFlat index on embedding")
+    vector_index.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    vector_index.add_argument("--m", type=int, default=16)
+    vector_index.add_argument("--ef-construction", type=int, default=64)
+    vector_index.add_argument("--lists", type=int, default=None, help="ivfflat lists, defaults to pgvector's recommendation")
+    vector_index.add_argument("--binary", action="store_true", help="index binary_quantize(embedding) for quantized search")
+    vector_index.add_argument("--maintenance-work-mem", default="1GB")
+    vector_index.add_argument("--name", default=None)
+
+    tenant_indexes = commands.add_parser("create-tenant-indexes", help="build a partial HNSW index per large user")
+    tenant_indexes.add_argument("usernames", nargs="*", help="defaults to every user with at least --min-rows rows")
+    tenant_indexes.add_argument("--min-rows", type=int, default=50000)
+    tenant_indexes.add_argument("--m", type=int, default=16)
+    tenant_indexes.add_argument("--ef-construction", type=int, default=64)
+    tenant_indexes.add_argument("--maintenance-work-mem", default="1GB")
+
+    tune_parser = commands.add_parser("tune", help="set database defaults for query-time index parameters")
+    tune_parser.add_argument("--ef-search", type=int, default=None)
+    tune_parser.add_argument("--probes", type=int, default=None)
+    tune_parser.add_argument("--iterative-scan", choices=["off", "strict_order", "relaxed_order"], default=None)
+
+    reindex_parser = commands.add_parser("reindex", help="rebuild an index concurrently")
+    reindex_parser.add_argument("index")
+
+    partition = commands.add_parser("partition", help="convert embeddings to monthly range partitions")
+    partition.add_argument("--months-ahead", type=int, default=3)
+    partition.add_argument("--batch-size", type=int, default=10000)
+
+    partitions = commands.add_parser("ensure-partitions", help="create upcoming monthly partitions")
+    partitions.add_argument("--months-ahead", type=int, default=3)
+
+    report = commands.add_parser("report", help="index sizes, scans and build times")
+    report.add_argument("--json", action="store_true")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        applied = migrate()
+        print(f"applied {len(applied)} migration(s)")
+    elif args.command == "create-vector-index":
+        create_vector_index(args.method, args.m, args.ef_construction, args.lists, args.binary,
+                            maintenance_work_mem=args.maintenance_work_mem, name=args.name)
+    elif args.command == "create-tenant-indexes":
+        create_tenant_indexes(args.usernames or None, args.min_rows, args.m, args.ef_construction, args.maintenance_work_mem)
+    elif args.command == "tune":
+        tune(args.ef_search, args.probes, args.iterative_scan)
+    elif args.command == "reindex":
+        reindex(args.index)
+    elif args.command == "partition":
+        partition_table(args.months_ahead, args.batch_size)
+    elif args.command == "ensure-partitions":
+        ensure_partitions(args.months_ahead)
+    elif args.command == "report":
+        rows = index_report()
+        if args.json:
+            print(json.dumps(rows, indent=2))
+        else:
+            for row in rows:
+                build = f"{row['build_seconds']:.1f}s" if row["build_seconds"] is not None else "-"
+                print(f"{row['index']:<45} {_format_bytes(row['size_bytes']):>10} {row['scans']:>10} scans  build {build:>8}  {'' if row['valid'] else 'INVALID'}")
+                print(f"    {row['definition']}")
+
+
+if __name__ == "__main__":
+    main()
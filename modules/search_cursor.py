@@ -0,0 +1,227 @@
+import base64
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+
+import numpy as np
+
+from modules import database_interactor, tracing
+
+"""cursor paging over ranked similarity results.
+similarity_search(start, end) ranks start + k rows for every page and throws the first start away, and with an
+ANN index deep offsets also lose recall. search_page() ranks SEARCH_CURSOR_CANDIDATES rows once, keeps their
+ids in memory for SEARCH_CURSOR_TTL seconds and returns an opaque cursor; every later page only fetches its
+own rows by id. past the cached candidates, or when the cursor's entry expired, was evicted or lives in
+another worker, the next batch is ranked from the last (distance, id) returned instead of an OFFSET, so no
+rows are materialized and thrown away; the HNSW scan still walks the graph from the top and passes over
+the rows before the keyset, so such a batch gets slower the deeper it starts.
+a cursor only resumes the query and filters it was issued for."""
+
+SEARCH_CURSOR_CANDIDATES = int(os.getenv("SEARCH_CURSOR_CANDIDATES", "100"))
+SEARCH_CURSOR_TTL = float(os.getenv("SEARCH_CURSOR_TTL", "300"))
+SEARCH_CURSOR_SIZE = int(os.getenv("SEARCH_CURSOR_SIZE", "1000"))
+
+
+class _Candidates:
+
+    def __init__(self, scope: str, start: int, ranked: list[tuple[int, float]], complete: bool):
+        self.scope = scope
+        self.start = start          # position of ranked[0] in the full ranking
+        self.ranked = ranked
+        self.complete = complete    # nothing is ranked after the last candidate
+        self.created_at = time.monotonic()
+
+
+class CandidateCache:
+    """ranked candidates per cursor key, expiring after ttl seconds, least recently used evicted past max_entries"""
+
+    def __init__(self, max_entries = SEARCH_CURSOR_SIZE, ttl = SEARCH_CURSOR_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries = OrderedDict()   # key -> _Candidates, least recently used first
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key: str, scope: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry.created_at > self.ttl:
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None or entry.scope != scope:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, entry: _Candidates) -> str:
+        key = secrets.token_urlsafe(12)
+        if self.max_entries <= 0:
+            return key
+
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return key
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "entries": len(self._entries)
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> CandidateCache:
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CandidateCache()
+    return _cache
+
+
+def _scope(query_embedding, filters: dict) -> str:
+    digest = hashlib.sha256(np.asarray(query_embedding, dtype=np.float32).tobytes())
+    digest.update(repr(sorted((key, str(value)) for key, value in filters.items() if value is not None)).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def _encode(key: str, position: int, last, scope: str) -> str:
+    state = [key, position, *(last if last is not None else (None, None)), scope]
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode(cursor: str):
+    """(cache key, position, (distance, id) of the last row returned, scope), ValueError for a malformed cursor"""
+    try:
+        key, position, last_distance, last_id, scope = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        last = None if last_id is None else (float(last_distance), int(last_id))
+        return str(key), int(position), last, str(scope)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"invalid cursor: {e}")
+
+
+def _rows(rows: list[dict], detailed: bool) -> list:
+    if detailed:
+        return rows
+    return [(row["text_segment"], row["username"], row["speaker"], row["created_at"]) for row in rows]
+
+
+def _resume(query_embedding, cursor, page_size: int, filters: dict) -> tuple:
+    """(scope, position, keyset, cache key, candidates) for the requested page.
+    candidates (and the key) are None when the page isn't covered by cached candidates and has to be ranked"""
+    scope = _scope(query_embedding, filters)
+    if cursor is None:
+        return scope, 0, None, None, None
+
+    key, position, last, cursor_scope = _decode(cursor)
+    if cursor_scope != scope:
+        raise ValueError("cursor was issued for a different query or filters")
+
+    entry = get_cache().get(key, scope)
+    if entry is not None and (position - entry.start + page_size <= len(entry.ranked) or entry.complete):
+        return scope, position, last, key, entry
+    return scope, position, last, None, None
+
+
+def _batch_size(page_size: int) -> int:
+    return max(SEARCH_CURSOR_CANDIDATES, page_size)
+
+
+def _page_ids(entry: _Candidates, position: int, page_size: int) -> list[int]:
+    offset = position - entry.start
+    return [row_id for row_id, _ in entry.ranked[offset:offset + page_size]]
+
+
+def _remember(scope: str, position: int, ranked: list[tuple[int, float]], page_size: int) -> tuple[str, _Candidates]:
+    entry = _Candidates(scope, position, ranked, len(ranked) < _batch_size(page_size))
+    return get_cache().put(entry), entry
+
+
+def _next_cursor(key: str, entry: _Candidates, position: int, page_size: int, scope: str):
+    """the cursor for the page after the one at position, None when it was the last"""
+    count = len(_page_ids(entry, position, page_size))
+    end = position - entry.start + count
+    if count == 0 or (entry.complete and end >= len(entry.ranked)):
+        return None
+    return _encode(key, position + count, entry.ranked[end - 1], scope)
+
+
+class PagePlan:
+    """one search_page call split around its single database round trip, for callers that make the trip
+    themselves, e.g. async_database_interactor.search_page:
+
+        plan = PagePlan(query_embedding, cursor, page_size, filters)
+        if plan.row_ids is not None:
+            rows, next_cursor = plan.finish(rows_by_id(plan.row_ids))
+        else:
+            ranked, page = ranked_candidates(query_embedding, plan.limit, page_size, plan.after, plan.position, **filters)
+            rows, next_cursor = plan.finish(page, ranked)
+
+    ValueError for a cursor that is malformed or was issued for another query or filters"""
+
+    def __init__(self, query_embedding, cursor, page_size: int, filters: dict):
+        self.page_size = page_size
+        self._scope, self.position, self.after, self._key, self._entry = _resume(query_embedding, cursor, page_size, filters)
+
+        # ids of the page when cached candidates cover it, None when it has to be ranked
+        self.row_ids = _page_ids(self._entry, self.position, page_size) if self._entry is not None else None
+        # candidates to rank otherwise, starting after the (distance, id) keyset `after`
+        self.limit = _batch_size(page_size)
+
+    def finish(self, page: list[dict], ranked = None, detailed = False) -> tuple[list, str]:
+        """the page's rows and the next cursor, from rows_by_id's rows or ranked_candidates' (ranked, page)"""
+        key, entry = self._key, self._entry
+        if ranked is not None:
+            key, entry = _remember(self._scope, self.position, ranked, self.page_size)
+        return _rows(page, detailed), _next_cursor(key, entry, self.position, self.page_size, self._scope)
+
+
+@tracing.traced("search.page")
+def search_page(query_embedding: list[float], cursor = None, page_size = 5, username = None, speaker = None,
+                start_time = None, end_time = None, detailed = False) -> tuple[list, str]:
+    """a page of similarity_search results and the cursor for the next one, None after the last page.
+    cursor None starts from the nearest row, otherwise it must come from a call with the same query and filters,
+    ValueError if not. rows are in the same formats as similarity_search"""
+    filters = {"username": username, "speaker": speaker, "start_time": start_time, "end_time": end_time}
+    plan = PagePlan(query_embedding, cursor, page_size, filters)
+
+    if plan.row_ids is not None:
+        return plan.finish(database_interactor.rows_by_id(plan.row_ids), detailed=detailed)
+
+    ranked, page = database_interactor.ranked_candidates(query_embedding, plan.limit, page_size, plan.after, plan.position, **filters)
+    return plan.finish(page, ranked, detailed)
+
+
+tracing.register_gauges("search_cursor", lambda: _cache.stats() if _cache is not None else {})
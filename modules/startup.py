@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import time
+
+from modules import tracing
+
+"""cold start handling for the Flask services.
+warm_up() does the work the first request would otherwise wait for: postgres connections, AWS clients
+(credential resolution, endpoint and service model loading), the embedding cache's memory tier and,
+with WARMUP_EMBED_TEXT set, one bedrock call to open its TLS connection. connections and clients can't
+cross a fork, so under gunicorn the app is imported once in the master (preload_app) and every worker
+warms up in post_fork, see reply_query/gunicorn.conf.py and backend/gunicorn.conf.py. the embedding
+cache is plain memory, so it is filled once in the master before it forks and the workers share it
+copy-on-write instead of each loading its own copy.
+report_first_request(app) logs the time from process start to the first served request."""
+
+logger = logging.getLogger("startup")
+logger.setLevel(logging.INFO)
+
+# text embedded once per worker to open the bedrock connection, empty skips the call
+WARMUP_EMBED_TEXT = os.getenv("WARMUP_EMBED_TEXT", "")
+# embedding cache entries loaded from disk into memory, capped by EMBEDDING_CACHE_SIZE
+WARMUP_CACHE_ENTRIES = int(os.getenv("WARMUP_CACHE_ENTRIES", "10000"))
+
+_imported_at = time.time()
+_report = {}
+
+
+def process_started_at() -> float:
+    """PROCESS_STARTED_AT when a launcher (e.g. gunicorn.conf.py) set it, forked workers inherit it,
+    otherwise when this module was first imported"""
+    return float(os.getenv("PROCESS_STARTED_AT", _imported_at))
+
+
+def warm_database() -> None:
+    from modules import database_interactor
+
+    database_interactor.get_pool().fill()
+    if database_interactor.SEARCH_BACKEND != "pgvector":
+        database_interactor._local_index()
+
+
+def warm_embedding_cache() -> None:
+    """fills the memory tier from disk, unless it already holds entries, e.g. inherited from the master"""
+    from modules import embedding_cache
+
+    cache = embedding_cache.get_cache()
+    if cache is not None and not len(cache.memory):
+        cache.preload(WARMUP_CACHE_ENTRIES)
+
+
+def warm_bedrock_connection(text = None) -> None:
+    """one uncached embedding call, so the first request doesn't pay for the TLS handshake"""
+    from modules import text_embedding
+
+    text = WARMUP_EMBED_TEXT if text is None else text
+    if text:
+        text_embedding._invoke_embedding_model(text_embedding._bedrock_client(), text, "amazon.titan-embed-text-v2:0")
+
+
+def warm_up(steps: dict) -> dict[str, float]:
+    """runs each named step once, returns the milliseconds each took. a failing step is logged and skipped,
+    the request that needs it will retry on its own"""
+    timings = {}
+    started = time.perf_counter()
+
+    for name, step in steps.items():
+        step_started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.warning(f"warm-up step {name} failed: {e}")
+            continue
+        timings[name] = round((time.perf_counter() - step_started) * 1000, 2)
+
+    _process_report().update(
+        warmup_ms=timings,
+        warmup_seconds=time.perf_counter() - started,
+        ready_seconds=time.time() - process_started_at()
+    )
+    logger.info(json.dumps({"event": "warmup", **_report}))
+    return timings
+
+
+def _process_report() -> dict:
+    # a forked worker starts over instead of reporting its parent's numbers
+    if _report.get("pid") != os.getpid():
+        _report.clear()
+        _report["pid"] = os.getpid()
+    return _report
+
+
+def report_first_request(app) -> None:
+    """logs, once per process, how long after process start the first response went out"""
+
+    @app.after_request
+    def _first_request(response):
+        report = _process_report()
+        if "first_request_seconds" not in report:
+            report["first_request_seconds"] = time.time() - process_started_at()
+            logger.info(json.dumps({"event": "first_request", **report}))
+        return response
+
+
+def stats() -> dict:
+    return {name: value for name, value in _report.items() if name.endswith("seconds")}
+
+
+tracing.register_gauges("startup", stats)
@@ -1,18 +1,60 @@
-import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import json
+import os
+import random
+import time
 
-def embed_text(text: str, model_id = "amazon.titan-embed-text-v2:0"):
-    """generate embedings given the text"""
-    client = boto3.client(
-        'bedrock-runtime',
-        region_name='us-west-2' 
-    )
+from modules import aws_clients, embedding_cache, tracing
 
+EMBEDDING_MAX_WORKERS = int(os.getenv("EMBEDDING_MAX_WORKERS", "8"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "6"))
+EMBEDDING_BACKOFF_BASE = float(os.getenv("EMBEDDING_BACKOFF_BASE", "0.5"))
+EMBEDDING_BACKOFF_MAX = float(os.getenv("EMBEDDING_BACKOFF_MAX", "20"))
+
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "InternalServerException"
+}
+
+# models whose output size is chosen per request with "dimensions", and the size they default to.
+# they are asked for EMBEDDING_DIM values so query and stored vectors match the embedding column
+VARIABLE_DIMENSION_MODELS = {"amazon.titan-embed-text-v2:0": 1024}
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "1024"))
+
+def _bedrock_client():
+    return aws_clients.get_client('bedrock-runtime', region_name='us-west-2')
+
+def _dimensions(model_id: str, dimensions = None):
+    """the output size to request, None when it is the model's default"""
+    if model_id not in VARIABLE_DIMENSION_MODELS:
+        if dimensions is not None:
+            raise ValueError(f"{model_id} doesn't take a dimensions parameter")
+        return None
+    dimensions = EMBEDDING_DIM if dimensions is None else dimensions
+    return None if dimensions == VARIABLE_DIMENSION_MODELS[model_id] else dimensions
+
+def cache_model_id(model_id: str, dimensions = None) -> str:
+    """the embedding cache keeps vectors of one model at different sizes apart"""
+    dimensions = _dimensions(model_id, dimensions)
+    return model_id if dimensions is None else f"{model_id}#{dimensions}"
+
+def embedding_request(text: str, model_id: str, dimensions = None) -> str:
+    """the invoke_model body for text"""
     native_request = {
         "inputText": text
     }
+    dimensions = _dimensions(model_id, dimensions)
+    if dimensions is not None:
+        native_request["dimensions"] = dimensions
 
-    request = json.dumps(native_request)
+    return json.dumps(native_request)
+
+def _invoke_embedding_model(client, text: str, model_id: str, dimensions = None) -> list[float]:
+    request = embedding_request(text, model_id, dimensions)
 
     response = client.invoke_model(modelId=model_id, body=request)
 
@@ -20,3 +62,77 @@ def embed_text(text: str, model_id = "amazon.titan-embed-text-v2:0"):
     embedding = response_body["embedding"]
 
     return embedding
+
+def backoff_delay(error: Exception, attempt: int):
+    """seconds to wait before retrying a bedrock call that failed with error on attempt (0 for the first),
+    full-jitter exponential backoff. None when the error isn't throttling or retries are used up"""
+    code = error.response.get('Error', {}).get('Code') if isinstance(error, ClientError) else None
+    if code not in RETRYABLE_ERROR_CODES or attempt >= EMBEDDING_MAX_RETRIES:
+        return None
+    return random.uniform(0, min(EMBEDDING_BACKOFF_MAX, EMBEDDING_BACKOFF_BASE * (2 ** attempt)))
+
+def _invoke_with_backoff(client, text: str, model_id: str, dimensions = None) -> list[float]:
+    """retries throttled requests, see backoff_delay"""
+    attempt = 0
+    while True:
+        try:
+            return _invoke_embedding_model(client, text, model_id, dimensions)
+        except ClientError as e:
+            delay = backoff_delay(e, attempt)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+def embed_text(text: str, model_id = "amazon.titan-embed-text-v2:0", dimensions = None):
+    """generate embedings given the text.
+    dimensions picks the output size for models that support it, None is EMBEDDING_DIM"""
+    cache = embedding_cache.get_cache()
+    cache_model = cache_model_id(model_id, dimensions)
+    if cache is not None:
+        cached = cache.get(cache_model, text)
+        if cached is not None:
+            return cached
+
+    with tracing.span("embed"):
+        embedding = _invoke_embedding_model(_bedrock_client(), text, model_id, dimensions)
+
+    if cache is not None:
+        cache.put(cache_model, text, embedding)
+
+    return embedding
+
+def embed_texts(texts: list[str], model_id = "amazon.titan-embed-text-v2:0", max_workers = None, dimensions = None) -> list[list[float]]:
+    """generate embeddings for many texts concurrently.
+    requests run on a bounded thread pool and are retried with backoff when bedrock throttles,
+    results are returned in the same order as the input. dimensions as in embed_text"""
+
+    if not texts:
+        return []
+
+    cache = embedding_cache.get_cache()
+    cache_model = cache_model_id(model_id, dimensions)
+    results = cache.get_many(cache_model, texts) if cache is not None else [None] * len(texts)
+
+    # only call bedrock once per distinct text that isn't cached
+    pending = {}
+    for index, (text, result) in enumerate(zip(texts, results)):
+        if result is None:
+            pending.setdefault(embedding_cache.normalize_text(text), []).append(index)
+
+    if pending:
+        missing = [texts[indexes[0]] for indexes in pending.values()]
+        client = _bedrock_client()
+        max_workers = min(max_workers or EMBEDDING_MAX_WORKERS, len(missing))
+
+        with tracing.span("embed_batch"), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            embeddings = list(executor.map(lambda text: _invoke_with_backoff(client, text, model_id, dimensions), missing))
+
+        for indexes, embedding in zip(pending.values(), embeddings):
+            for index in indexes:
+                results[index] = embedding
+
+        if cache is not None:
+            cache.put_many(cache_model, list(zip(missing, embeddings)))
+
+    return results
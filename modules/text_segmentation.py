@@ -1,31 +1,172 @@
-import boto3
+import os
+import re
 
-def text_segmentation(full_text: str) -> list[str]:
-    """segments text into a list of strings"""
+from modules import aws_clients
 
-    if not full_text.strip():
-        return []
+# "regex" splits locally, "comprehend" uses aws comprehend's syntax tokens
+TEXT_SEGMENTATION_MODE = os.getenv("TEXT_SEGMENTATION_MODE", "regex").lower()
+
+# batch_detect_syntax limits
+COMPREHEND_MAX_DOCUMENT_BYTES = 5000
+COMPREHEND_MAX_BATCH_SIZE = 25
+
+# never end a sentence
+TITLE_ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "mt", "rev", "gen", "sgt", "capt", "lt", "col"}
+
+# end a sentence only when the next word is capitalized, e.g. "apples, pears, etc. then"
+ABBREVIATIONS = {
+    "etc", "vs", "approx", "appt", "apt", "dept", "est", "fig", "inc", "ltd", "co", "corp", "no",
+    "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec", "min", "max", "misc"
+}
+
+_SENTENCE_END = re.compile(r"([.!?]+)([\"'”’)\]]*)(\s+)")
+_LAST_WORD = re.compile(r"(\S+)$")
+_DOTTED_ACRONYM = re.compile(r"(?:[a-z]\.)+[a-z]")
+
+
+def _continues_sentence(text: str, start: int, match: re.Match) -> bool:
+    """True when the punctuation at match doesn't end a sentence"""
+    next_char = text[match.end():match.end() + 1]
+
+    if match.group(1) != ".":
+        return False
+
+    last_word = _LAST_WORD.search(text, start, match.start())
+    if last_word is None:
+        return False
+    word = last_word.group(1).lstrip("\"'“‘([").lower()
+
+    # titles ("Dr. Smith") and initials ("J. R. R. Tolkien")
+    if word in TITLE_ABBREVIATIONS or len(word) == 1 and word.isalpha():
+        return True
+
+    # dotted acronyms ("e.g.", "U.S.") and other abbreviations
+    if word in ABBREVIATIONS or _DOTTED_ACRONYM.fullmatch(word):
+        return not next_char.isupper()
+
+    return False
+
+
+def _regex_segmentation(full_text: str) -> list[str]:
+    sentences = []
+    start = 0
+
+    for match in _SENTENCE_END.finditer(full_text):
+        if match.group(1).startswith("..") and full_text[match.end():match.end() + 1].islower():
+            # trailing off... and carrying on
+            continue
+        if _continues_sentence(full_text, start, match):
+            continue
+
+        sentence = full_text[start:match.end(2)].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+
+    tail = full_text[start:].strip()
+    if tail:
+        sentences.append(tail)
+
+    return sentences
+
+
+def _split_oversized(text: str, max_bytes: int) -> list[str]:
+    """splits text on whitespace so each piece is under max_bytes when utf-8 encoded"""
+    pieces = []
+    current = ""
 
-    comprehend = boto3.client('comprehend')
+    for word in text.split():
+        candidate = f"{current} {word}" if current else word
+        if len(candidate.encode("utf-8")) <= max_bytes:
+            current = candidate
+            continue
 
-    response = comprehend.batch_detect_syntax(
-        TextList=[full_text],
-        LanguageCode='en'
-    )
+        if current:
+            pieces.append(current)
+        # a single word longer than the limit gets cut on character boundaries
+        while len(word.encode("utf-8")) > max_bytes:
+            cut = max_bytes
+            while len(word[:cut].encode("utf-8")) > max_bytes:
+                cut -= 1
+            pieces.append(word[:cut])
+            word = word[cut:]
+        current = word
 
+    if current:
+        pieces.append(current)
+
+    return pieces
+
+
+def _chunk_text(full_text: str, max_bytes = COMPREHEND_MAX_DOCUMENT_BYTES) -> list[str]:
+    """packs whole sentences into documents under comprehend's per-document size limit"""
+    chunks = []
+    current = ""
+
+    for sentence in _regex_segmentation(full_text):
+        for piece in _split_oversized(sentence, max_bytes) if len(sentence.encode("utf-8")) > max_bytes else [sentence]:
+            candidate = f"{current} {piece}" if current else piece
+            if len(candidate.encode("utf-8")) <= max_bytes:
+                current = candidate
+            else:
+                chunks.append(current)
+                current = piece
+
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+def _comprehend_segmentation(full_text: str) -> list[str]:
+    comprehend = aws_clients.get_client('comprehend')
+    chunks = _chunk_text(full_text)
     sentences = []
-    current_sentence = []
 
-    for result in response['ResultList']:
-        for token in result['SyntaxTokens']:
-            current_sentence.append(token['Text'])
-            
-            # Check if the token is a period (.) or another sentence-ending punctuation mark
-            if token['Text'] in ['.', '!', '?']:
-                sentences.append(" ".join(current_sentence))
-                current_sentence = []
+    for i in range(0, len(chunks), COMPREHEND_MAX_BATCH_SIZE):
+        batch = chunks[i:i + COMPREHEND_MAX_BATCH_SIZE]
+
+        response = comprehend.batch_detect_syntax(
+            TextList=batch,
+            LanguageCode='en'
+        )
+
+        for error in response.get('ErrorList', []):
+            # fall back to the local splitter for any document comprehend rejected
+            response['ResultList'].append({'Index': error['Index'], 'Fallback': True})
+
+        for result in sorted(response['ResultList'], key=lambda result: result['Index']):
+            document = batch[result['Index']]
+
+            if result.get('Fallback'):
+                sentences.extend(_regex_segmentation(document))
+                continue
+
+            # slice the original text by token offsets so spacing and punctuation survive
+            sentence_start = None
+            for token in result['SyntaxTokens']:
+                if sentence_start is None:
+                    sentence_start = token['BeginOffset']
+
+                if token['Text'] in ['.', '!', '?']:
+                    sentences.append(document[sentence_start:token['EndOffset']].strip())
+                    sentence_start = None
+
+            if sentence_start is not None:
+                sentences.append(document[sentence_start:].strip())
+
+    return [sentence for sentence in sentences if sentence]
+
+
+def text_segmentation(full_text: str, mode = None) -> list[str]:
+    """segments text into a list of strings"""
+
+    if not full_text or not full_text.strip():
+        return []
+
+    mode = (mode or TEXT_SEGMENTATION_MODE).lower()
 
-    if current_sentence != []:
-        sentences.append(" ".join(current_sentence))
+    if mode == "comprehend":
+        return _comprehend_segmentation(full_text)
 
-    return sentences
\ No newline at end of file
+    return _regex_segmentation(full_text)
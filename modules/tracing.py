@@ -0,0 +1,341 @@
+from contextlib import contextmanager
+import contextvars
+from functools import wraps
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+"""per-stage latency histograms, request timing logs and a prometheus text endpoint.
+
+    with tracing.span("db.similarity_search"):     # or @tracing.traced("db.similarity_search")
+        ...
+
+every span is observed in stage_duration_seconds{stage=...}. inside a request started by
+instrument_flask (or start_request) spans are also summed per request, and when the request finishes
+one JSON line with the time spent per stage is logged to the "tracing" logger. AWS calls are timed
+through botocore's before-call/after-call events, so every client created after instrument_boto3()
+shows up in aws_call_duration_seconds{service, operation} without wrapping each call.
+spans opened on worker threads (embed_texts, S3 transfers) reach the histograms but not the request log,
+the span around the whole call on the request thread covers them there."""
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_LOG_REQUESTS = os.getenv("TRACE_LOG_REQUESTS", "true").lower() in ("1", "true", "yes")
+
+# frames kept per allocation by tracemalloc, 0 leaves it off. tracing every allocation costs
+# noticeable CPU and memory, turn it on while hunting a leak
+TRACEMALLOC_FRAMES = int(os.getenv("TRACEMALLOC_FRAMES", "0"))
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+logger = logging.getLogger("tracing")
+logger.setLevel(logging.INFO)
+
+
+class Histogram:
+
+    def __init__(self, buckets = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_histograms = {}   # (metric, sorted label items) -> Histogram
+_counters = {}     # (metric, sorted label items) -> value
+_gauges = {}       # prefix -> callable returning {name: number}
+_started = time.time()
+
+
+def observe(metric: str, value: float, **labels) -> None:
+    if not TRACING_ENABLED:
+        return
+    key = (metric, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+def increment(metric: str, amount = 1, **labels) -> None:
+    if not TRACING_ENABLED or not amount:
+        return
+    key = (metric, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def register_gauges(prefix: str, stats_fn) -> None:
+    """stats_fn() -> {name: number} is read on every scrape and exported as <prefix>_<name>"""
+    _gauges[prefix] = stats_fn
+
+
+class RequestTrace:
+    """time spent per stage within one request"""
+
+    def __init__(self, name: str, **fields):
+        self.name = name
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.memory_at_start = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            total, calls = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, calls + 1)
+
+
+_current = contextvars.ContextVar("tracing_request", default=None)
+
+
+def current_request():
+    return _current.get()
+
+
+@contextmanager
+def span(stage: str):
+    """times the block as stage, errors are counted in stage_errors_total"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        increment("stage_errors_total", stage=stage, error=type(e).__name__)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        observe("stage_duration_seconds", seconds, stage=stage)
+        trace = _current.get()
+        if trace is not None:
+            trace.record(stage, seconds)
+
+
+def traced(stage: str):
+    """decorator form of span"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_request(name: str, **fields) -> tuple[RequestTrace, contextvars.Token]:
+    trace = RequestTrace(name, **fields)
+    return trace, _current.set(trace)
+
+
+def finish_request(trace: RequestTrace, token: contextvars.Token, status = None) -> dict:
+    """observes the request duration, logs the per-stage timings and returns them"""
+    try:
+        _current.reset(token)
+    except ValueError:
+        # finished from another context, e.g. a streamed response's generator
+        _current.set(None)
+    seconds = time.perf_counter() - trace.started
+    observe("http_request_duration_seconds", seconds, route=trace.name, method=trace.fields.get("method", ""), status=str(status))
+
+    with trace._lock:
+        stages = {stage: {"ms": round(total * 1000, 2), "calls": calls} for stage, (total, calls) in trace.stages.items()}
+
+    record = {
+        "event": "request",
+        "route": trace.name,
+        **trace.fields,
+        "status": status,
+        "duration_ms": round(seconds * 1000, 2),
+        "stages": stages
+    }
+    if trace.memory_at_start is not None and tracemalloc.is_tracing():
+        record["memory_delta_bytes"] = tracemalloc.get_traced_memory()[0] - trace.memory_at_start
+
+    if TRACE_LOG_REQUESTS and TRACING_ENABLED:
+        logger.info(json.dumps(record, default=str))
+    return record
+
+
+def _aws_operation(event_name: str) -> tuple[str, str]:
+    # "after-call.bedrock-runtime.InvokeModel"
+    _, service, operation = event_name.split(".", 2)
+    return service, operation
+
+
+def _before_aws_call(context = None, **kwargs) -> None:
+    if context is not None:
+        context["tracing_started"] = time.perf_counter()
+
+
+def _finish_aws_call(event_name: str, context, error = None) -> None:
+    started = (context or {}).get("tracing_started")
+    if started is None:
+        return
+
+    service, operation = _aws_operation(event_name)
+    seconds = time.perf_counter() - started
+    observe("aws_call_duration_seconds", seconds, service=service, operation=operation)
+    if error is not None:
+        increment("aws_call_errors_total", service=service, operation=operation, error=error)
+
+    trace = _current.get()
+    if trace is not None:
+        trace.record(f"aws.{service}.{operation}", seconds)
+
+
+def _after_aws_call(event_name, http_response = None, parsed = None, context = None, **kwargs) -> None:
+    parsed = parsed or {}
+    increment("aws_call_retries_total", parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0), service=_aws_operation(event_name)[0])
+    error = parsed.get("Error", {}).get("Code") if http_response is not None and http_response.status_code >= 300 else None
+    _finish_aws_call(event_name, context, error)
+
+
+def _after_aws_call_error(event_name, exception = None, context = None, **kwargs) -> None:
+    _finish_aws_call(event_name, context, type(exception).__name__)
+
+
+def instrument_boto3(session = None) -> None:
+    """times every call of the clients session creates from now on, the default boto3 session if None"""
+    if not TRACING_ENABLED:
+        return
+    if session is None:
+        import boto3
+        session = boto3._get_default_session()
+
+    events = session.events
+    events.register("before-call", _before_aws_call, unique_id="tracing-before-call")
+    events.register("after-call", _after_aws_call, unique_id="tracing-after-call")
+    events.register("after-call-error", _after_aws_call_error, unique_id="tracing-after-call-error")
+
+
+def start_tracemalloc(frames = TRACEMALLOC_FRAMES) -> bool:
+    if frames > 0 and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    return tracemalloc.is_tracing()
+
+
+def memory_snapshot(limit = 20, group_by = "lineno") -> dict:
+    """the largest live allocations by source line, empty unless tracemalloc is running"""
+    if not tracemalloc.is_tracing():
+        return {"tracing": False}
+
+    current, peak = tracemalloc.get_traced_memory()
+    statistics = tracemalloc.take_snapshot().statistics(group_by)
+    return {
+        "tracing": True,
+        "current_bytes": current,
+        "peak_bytes": peak,
+        "top": [
+            {"location": str(stat.traceback[0]), "size_bytes": stat.size, "count": stat.count}
+            for stat in statistics[:limit]
+        ]
+    }
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(items, extra = ()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*items, *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render_prometheus() -> str:
+    """every metric in the prometheus text exposition format"""
+    lines = []
+
+    with _lock:
+        histograms = sorted((key, (list(h.counts), h.sum, h.count, h.buckets)) for key, h in _histograms.items())
+        counters = sorted(_counters.items())
+
+    typed = set()
+    for (metric, labels), (counts, total, count, buckets) in histograms:
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} histogram")
+            typed.add(metric)
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{metric}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{metric}_bucket{_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{metric}_sum{_labels(labels)} {total}")
+        lines.append(f"{metric}_count{_labels(labels)} {count}")
+
+    for (metric, labels), value in counters:
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lines.append(f"{metric}{_labels(labels)} {value}")
+
+    gauges = {"process_uptime_seconds": time.time() - _started}
+    if tracemalloc.is_tracing():
+        gauges["tracemalloc_current_bytes"], gauges["tracemalloc_peak_bytes"] = tracemalloc.get_traced_memory()
+
+    for prefix, stats_fn in list(_gauges.items()):
+        try:
+            stats = stats_fn() or {}
+        except Exception as e:
+            logger.warning(f"gauges {prefix} failed: {e}")
+            continue
+        for name, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges[f"{prefix}_{name}"] = value
+
+    for name, value in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def instrument_flask(app, skip_paths = ("/metrics", "/metrics/memory")) -> None:
+    """request traces for every route of app, plus GET /metrics and GET /metrics/memory.
+    call before creating the AWS clients the app uses at import time"""
+    from flask import Response, g, jsonify, request
+
+    instrument_boto3()
+    start_tracemalloc()
+
+    @app.before_request
+    def _start_trace():
+        if request.path in skip_paths:
+            return
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        g.tracing_request = start_request(route, method=request.method)
+
+    @app.after_request
+    def _record_status(response):
+        g.tracing_status = response.status_code
+        started = g.get("tracing_request")
+        if started is not None and response.is_streamed:
+            # teardown runs as soon as the view returns, a streamed body is finished when the server closes it
+            g.tracing_request = None
+            response.call_on_close(lambda: finish_request(*started, status=response.status_code))
+        return response
+
+    @app.teardown_request
+    def _finish_trace(exception = None):
+        started = g.pop("tracing_request", None)
+        if started is not None:
+            finish_request(*started, status=500 if exception is not None else g.pop("tracing_status", None))
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+    @app.route("/metrics/memory", methods=["GET"])
+    def metrics_memory():
+        return jsonify(memory_snapshot(int(request.args.get("limit", "20"))))
@@ -1,8 +1,11 @@
-import boto3
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 from datetime import datetime
 
 import os
+import uuid
+
+from modules import aws_clients
 
 load_dotenv()
 AUDIO_BUCKET_NAME = os.getenv("AUDIO_BUCKET")
@@ -12,12 +15,13 @@ OUTPUT_BUCKET = os.getenv("S3_BUCKET_NAME")
 def instruct_transcribe_audio(filename: str, output_filename: str) -> str:
     """sends instruction to transcribe audiofile 
     then thrown transcript into transcript processing bucket"""
-    transcribe_client = boto3.client('transcribe', region_name='us-west-2')
+    transcribe_client = aws_clients.get_client('transcribe', region_name='us-west-2')
     
     print("transcribing", filename)
 
     current_time = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:21]
-    transcription_job_name = f"transcribe_{current_time}"
+    # parallel workers can start jobs within the same millisecond
+    transcription_job_name = f"transcribe_{current_time}_{uuid.uuid4().hex[:8]}"
 
     s3_uri = f"s3://{AUDIO_BUCKET_NAME}/{filename}"
     transcribe_client.start_transcription_job(
@@ -29,3 +33,31 @@ def instruct_transcribe_audio(filename: str, output_filename: str) -> str:
         OutputKey=f"{output_filename[:-4]}.json"
     )
 
+    return transcription_job_name
+
+def _job_not_found(error: ClientError) -> bool:
+    """transcribe answers GetTranscriptionJob for a missing (e.g. deleted) job with a BadRequestException"""
+    details = error.response.get('Error', {})
+    if details.get('Code') == 'NotFoundException':
+        return True
+    return details.get('Code') == 'BadRequestException' and "couldn't be found" in details.get('Message', '')
+
+def get_transcription_job_status(job_name: str) -> tuple[str, str]:
+    """returns (status, failure reason) of a transcription job, status None when there is no such job"""
+    transcribe_client = aws_clients.get_client('transcribe', region_name='us-west-2')
+
+    try:
+        job = transcribe_client.get_transcription_job(TranscriptionJobName=job_name)['TranscriptionJob']
+    except ClientError as e:
+        if not _job_not_found(e):
+            raise
+        return None, "job not found"
+
+    return job['TranscriptionJobStatus'], job.get('FailureReason')
+
+def stop_transcription_job(job_name: str) -> None:
+    """aws transcribe can't cancel a job, deleting it is the only way to withdraw a queued or running one"""
+    transcribe_client = aws_clients.get_client('transcribe', region_name='us-west-2')
+
+    transcribe_client.delete_transcription_job(TranscriptionJobName=job_name)
+
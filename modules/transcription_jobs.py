@@ -0,0 +1,94 @@
+import os
+import sqlite3
+import threading
+import time
+
+"""local table of audio files handed to aws transcribe.
+audio key -> archive key -> transcription job name -> status, kept in sqlite so a restarted
+audio processor knows which jobs are still in flight and which need to be retried."""
+
+DEFAULT_JOB_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".cache", "transcription_jobs.sqlite3")
+
+TRANSCRIPTION_JOB_TABLE_PATH = os.getenv("TRANSCRIPTION_JOB_TABLE_PATH", DEFAULT_JOB_TABLE_PATH)
+
+QUEUED = "QUEUED"             # claimed by a worker, audio not moved yet
+ARCHIVED = "ARCHIVED"         # audio moved to archive/, job not started yet
+IN_PROGRESS = "IN_PROGRESS"
+COMPLETED = "COMPLETED"
+FAILED = "FAILED"
+
+ACTIVE_STATUSES = (QUEUED, ARCHIVED, IN_PROGRESS)
+
+
+class TranscriptionJobTable:
+
+    def __init__(self, path = TRANSCRIPTION_JOB_TABLE_PATH):
+        self.path = path
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS transcription_jobs ("
+                "audio_key TEXT PRIMARY KEY, archive_key TEXT, job_name TEXT, status TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS transcription_jobs_status ON transcription_jobs (status, updated_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def claim(self, audio_key: str) -> bool:
+        """records audio_key as QUEUED, returns False if it is already being tracked and not finished"""
+        now = time.time()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO transcription_jobs (audio_key, status, created_at, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (audio_key) DO UPDATE SET status = excluded.status, archive_key = NULL, job_name = NULL, "
+                "attempts = 0, error = NULL, created_at = excluded.created_at, updated_at = excluded.updated_at "
+                "WHERE transcription_jobs.status IN (?, ?)",
+                (audio_key, QUEUED, now, now, COMPLETED, FAILED)
+            )
+            return cursor.rowcount == 1
+
+    def update(self, audio_key: str, status: str, **fields) -> None:
+        """sets status plus any of archive_key, job_name, attempts, error"""
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        sql = f"UPDATE transcription_jobs SET status = ?, updated_at = ?{', ' + assignments if fields else ''} WHERE audio_key = ?"
+        with self._connection() as conn:
+            conn.execute(sql, (status, time.time(), *fields.values(), audio_key))
+
+    def forget(self, audio_key: str) -> None:
+        with self._connection() as conn:
+            conn.execute("DELETE FROM transcription_jobs WHERE audio_key = ?", (audio_key,))
+
+    def get(self, audio_key: str):
+        return self._connection().execute("SELECT * FROM transcription_jobs WHERE audio_key = ?", (audio_key,)).fetchone()
+
+    def with_status(self, *statuses: str, updated_before = None) -> list[sqlite3.Row]:
+        placeholders = ",".join("?" * len(statuses))
+        sql = f"SELECT * FROM transcription_jobs WHERE status IN ({placeholders})"
+        params = list(statuses)
+        if updated_before is not None:
+            sql += " AND updated_at < ?"
+            params.append(updated_before)
+        return self._connection().execute(sql + " ORDER BY updated_at", params).fetchall()
+
+    def count(self, *statuses: str) -> int:
+        placeholders = ",".join("?" * len(statuses))
+        row = self._connection().execute(f"SELECT COUNT(*) FROM transcription_jobs WHERE status IN ({placeholders})", statuses).fetchone()
+        return row[0]
+
+    def summary(self) -> dict[str, int]:
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM transcription_jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
@@ -0,0 +1,179 @@
+import asyncio
+from contextlib import AsyncExitStack
+import json
+import os
+import sys
+
+import aioboto3
+from botocore.exceptions import ClientError
+from quart import Quart, request, jsonify
+from quart_cors import cors
+
+# Add the parent directory of 'reply_query' to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules import async_database_interactor, answer_cache, context_builder, embedding_cache, text_embedding
+from bedrock_request import converse_request, parse_request, request_cursor
+
+"""
+asyncio version of flask_server.py with the same /bedrock contract.
+One process keeps thousands of requests in flight: while a request waits on bedrock or postgres
+its coroutine is parked instead of holding a thread. Work that doesn't depend on the embedding
+(the user's most recent segments, the answer cache watermark) starts as soon as the request arrives.
+
+    hypercorn --workers 4 --bind 0.0.0.0:5000 async_server:app   (from reply_query/)
+"""
+
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v2:0"
+
+# newest segments of the asking user added to the prompt, 0 turns it off
+RECENT_CONTEXT_SEGMENTS = int(os.getenv("RECENT_CONTEXT_SEGMENTS", "5"))
+
+app = cors(Quart(__name__))
+
+_session = aioboto3.Session()
+_resources = AsyncExitStack()
+_clients = {}
+
+
+@app.before_serving
+async def startup():
+    _clients['bedrock'] = await _resources.enter_async_context(_session.client('bedrock-runtime', region_name='us-west-2'))
+    await async_database_interactor.get_pool()
+
+
+@app.after_serving
+async def shutdown():
+    await _resources.aclose()
+    await async_database_interactor.close_pool()
+
+
+async def embed_text(text: str, model_id = EMBEDDING_MODEL_ID) -> list[float]:
+    """text_embedding.embed_text on the async bedrock client, sharing the embedding cache and
+    retrying throttled calls with the same backoff"""
+    cache = embedding_cache.get_cache()
+    cache_model_id = text_embedding.cache_model_id(model_id)
+    if cache is not None:
+        # the second cache tier is sqlite, keep it off the event loop
+        cached = await asyncio.to_thread(cache.get, cache_model_id, text)
+        if cached is not None:
+            return cached
+
+    attempt = 0
+    while True:
+        try:
+            response = await _clients['bedrock'].invoke_model(modelId=model_id, body=text_embedding.embedding_request(text, model_id))
+            break
+        except ClientError as e:
+            delay = text_embedding.backoff_delay(e, attempt)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+    embedding = json.loads(await response['body'].read())["embedding"]
+
+    if cache is not None:
+        await asyncio.to_thread(cache.put, cache_model_id, text, embedding)
+
+    return embedding
+
+
+async def _find_matches(string_query, embedding, search_mode, filters, cursor = None) -> tuple[str, dict, str]:
+    """retrieves candidates and packs them into the prompt context,
+    returns (context, context stats, cursor for the next candidates or None)"""
+    next_cursor = None
+    if search_mode == 'hybrid':
+        candidates = await async_database_interactor.hybrid_search(string_query, embedding, k=context_builder.CONTEXT_CANDIDATES, detailed=True, **filters)
+    else:
+        candidates, next_cursor = await async_database_interactor.search_page(embedding, cursor, page_size=context_builder.CONTEXT_CANDIDATES, detailed=True, **filters)
+    windows = None
+    if context_builder.CONTEXT_EXPAND_WINDOW > 0:
+        windows = await async_database_interactor.expand_hits(
+            [candidate["id"] for candidate in candidates], context_builder.CONTEXT_EXPAND_WINDOW, context_builder.CONTEXT_MERGE_GAP
+        )
+
+    formatted_matches, stats = context_builder.build_context(embedding, candidates, windows=windows)
+    app.logger.info(f"context: {stats['context_tokens']} tokens, {stats['tokens_saved']} saved ({stats})")
+    return formatted_matches, stats, next_cursor
+
+
+async def _nothing():
+    return None
+
+
+@app.route("/", methods=["GET"])
+async def helloWorld():
+    return jsonify("Hello World")
+
+
+@app.route("/bedrock", methods=["POST"])
+async def bedrock_query():
+    try:
+        data = await request.get_json()
+        string_query, search_mode, filters = parse_request(data)
+        cursor = request_cursor(data, search_mode)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # answers are only cached for the first page of matches
+    cache = answer_cache.get_cache() if cursor is None else None
+    username = filters['username']
+
+    # neither depends on the query embedding, so both run while it is computed and searched
+    recent = asyncio.create_task(
+        async_database_interactor.recent_segments(username, RECENT_CONTEXT_SEGMENTS, filters['speaker'])
+        if RECENT_CONTEXT_SEGMENTS > 0 else _nothing()
+    )
+    watermark = asyncio.create_task(
+        async_database_interactor.ingest_watermark(username) if cache is not None else _nothing()
+    )
+
+    try:
+        embedding = await embed_text(string_query)
+
+        if cache is not None:
+            scope = cache.scope(mode=search_mode, **filters)
+            cached = cache.get(scope, embedding, await watermark)
+            if cached is not None:
+                return jsonify({**cached, 'cached': True})
+
+        try:
+            formatted_matches, context_stats, next_cursor = await _find_matches(string_query, embedding, search_mode, filters, cursor)
+        except ValueError as e:
+            # a cursor from another query or filters
+            return jsonify({"error": str(e)}), 400
+        recent_segments = await recent
+
+        response = await _clients['bedrock'].converse(**converse_request(
+            string_query, formatted_matches, context_builder.format_rows(recent_segments) if recent_segments else None
+        ))
+
+        answer = {
+            'matches': formatted_matches,
+            'response': response['output']['message']['content'][0]['text'],
+            'cursor': next_cursor
+        }
+        if cache is not None:
+            cache.put(scope, embedding, answer, await watermark)
+
+        return jsonify({**answer, 'cached': False, 'context_stats': context_stats})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        for task in (recent, watermark):
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()   # a failure nobody awaited after an early return
+
+
+@app.route("/bedrock/cache", methods=["GET"])
+async def bedrock_cache_stats():
+    cache = answer_cache.get_cache()
+    if cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **cache.stats()})
+
+
+if __name__ == "__main__":
+    app.run(port=5000)
@@ -0,0 +1,93 @@
+from datetime import datetime
+
+"""
+Request parsing and prompt construction shared by the Flask and async query servers,
+so both answer /bedrock with the same contract
+"""
+
+def search_filters(data: dict) -> dict:
+    """username, speaker, start_time and end_time from the request body, times as ISO 8601 strings.
+    username is required, searches never rank across users"""
+    filters = {
+        'username': data.get('username'),
+        'speaker': data.get('speaker'),
+        'start_time': data.get('start_time'),
+        'end_time': data.get('end_time')
+    }
+    for key in ('start_time', 'end_time'):
+        if filters[key] is not None:
+            filters[key] = datetime.fromisoformat(filters[key])
+    return filters
+
+MODEL_ID = "anthropic.claude-3-5-haiku-20241022-v1:0"
+
+INFERENCE_CONFIG = {
+    "maxTokens": 200,
+    "stopSequences": [],
+    "temperature": 1,
+    "topP": 0.999
+}
+
+def parse_request(data: dict):
+    """query, search mode and filters from a /bedrock body, raises ValueError for a bad request"""
+    string_query = data.get('query') # query needs to get transformed into a embedded text 
+    search_mode = data.get('mode', 'vector') # "vector" or "hybrid" (vector + full-text)
+    if search_mode not in ('vector', 'hybrid'):
+        raise ValueError(f"unknown search mode: {search_mode}")
+
+    username = data.get('username')
+    if not isinstance(username, str) or not username:
+        raise ValueError("username is required")
+
+    try:
+        filters = search_filters(data)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"invalid time filter: {e}")
+
+    return string_query, search_mode, filters
+
+def request_cursor(data: dict, search_mode: str):
+    """the "cursor" from a previous /bedrock answer, to continue with the next page of matches.
+    raises ValueError for a bad request"""
+    cursor = data.get('cursor')
+    if cursor is None:
+        return None
+    if not isinstance(cursor, str):
+        raise ValueError("cursor must be a string")
+    if search_mode != 'vector':
+        raise ValueError("cursor paging is only supported in vector mode")
+    return cursor
+
+def converse_request(string_query, formatted_matches, formatted_recent = None) -> dict:
+    """converse arguments for a question, its matches and optionally the user's most recent segments"""
+    query_text =  """
+
+            You are Parrot.ai, a secretary agent that helps users remember recorded information.
+            Provide the user with an answer to their question or respond as their assistant if no question was asked.
+            Don't go onto a ramble be direct whether that's responding to their question.
+            Don't mention anything about previous transcriptions or data and don't bring up anything irrelevant.
+            
+            You are not to give instructions, just respond to the user's questions based on the information provided.
+
+            Please respond in a concise and playful manner. Use lists, emojis, and other formatting to make the response more engaging.
+
+            """
+
+    context = "Question: " + string_query + "| Matches: " + formatted_matches + "| Context: " + query_text
+    if formatted_recent:
+        context = "Question: " + string_query + "| Matches: " + formatted_matches + "| Recent: " + formatted_recent + "| Context: " + query_text
+
+    return {
+        "modelId": MODEL_ID,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                        {
+                            'text': context
+                        }
+                    ]
+            }
+        ],
+        "inferenceConfig": INFERENCE_CONFIG
+    }
@@ -1,86 +1,201 @@
-import boto3
 import json
-from flask import Flask, request, jsonify
+import logging
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, stream_with_context
 from flask_cors import CORS
-from datetime import datetime
 import sys
 import os
 
 # Add the parent directory of 'reply_query' to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from modules import text_embedding, database_interactor
+from modules import aws_clients, text_embedding, database_interactor, answer_cache, context_builder, search_cursor, startup, tracing
+from bedrock_request import converse_request, parse_request, request_cursor
 
-app = Flask(__name__)
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
 
-CORS(app)
+routes = Blueprint("query", __name__)
 
 
-@app.route("/", methods=["GET"])
+@routes.route("/", methods=["GET"])
 def helloWorld():
     try:
         return jsonify("Hello World")
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route("/bedrock", methods=["POST"])
+def _find_matches(string_query, embedding, search_mode, filters, cursor = None) -> tuple[str, dict, str]:
+    """retrieves candidates and packs them into the prompt context,
+    returns (context, context stats, cursor for the next candidates or None)"""
+    next_cursor = None
+    if search_mode == 'hybrid':
+        candidates = database_interactor.hybrid_search(string_query, embedding, k=context_builder.CONTEXT_CANDIDATES, detailed=True, **filters)
+    else:
+        candidates, next_cursor = search_cursor.search_page(embedding, cursor, page_size=context_builder.CONTEXT_CANDIDATES, detailed=True, **filters)
+    # the neighbours of every hit in one query, the builder decides which of them fit
+    windows = None
+    if context_builder.CONTEXT_EXPAND_WINDOW > 0:
+        windows = database_interactor.expand_hits(
+            [candidate["id"] for candidate in candidates], context_builder.CONTEXT_EXPAND_WINDOW, context_builder.CONTEXT_MERGE_GAP
+        )
+
+    with tracing.span("context.build"):
+        formatted_matches, stats = context_builder.build_context(embedding, candidates, windows=windows)
+    current_app.logger.info(f"context: {stats['context_tokens']} tokens, {stats['tokens_saved']} saved ({stats})")
+    return formatted_matches, stats, next_cursor
+
+@routes.route("/bedrock", methods=["POST"])
 def bedrock_query() -> dict:
     try:
-        data = request.json
-        string_query = data.get('query') # query needs to get transformed into a embedded text 
+        try:
+            string_query, search_mode, filters = parse_request(request.json)
+            cursor = request_cursor(request.json, search_mode)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
         embedding = text_embedding.embed_text(string_query) # transform for embed
-        matches = database_interactor.similarity_search(embedding)
-        client = boto3.client('bedrock-runtime', region_name='us-west-2')  
-        query_text =  """
-
-            You are Parrot.ai, a secretary agent that helps users remember recorded information.
-            Provide the user with an answer to their question or respond as their assistant if no question was asked.
-            Don't go onto a ramble be direct whether that's responding to their question.
-            Don't mention anything about previous transcriptions or data and don't bring up anything irrelevant.
-            
-            You are not to give instructions, just respond to the user's questions based on the information provided.
-
-            Please respond in a concise and playful manner. Use lists, emojis, and other formatting to make the response more engaging.
-
-            """
-
-        formatted_matches = ' | '.join(' '.join(str(item) if not isinstance(item, datetime) else item.strftime('%Y-%m-%d %H:%M:%S') for item in tup) for tup in matches)
-
-        
-        context = "Question: " + string_query + "| Matches: " + formatted_matches + "| Context: " + query_text
-        
-        payload = {
-            "modelId": "anthropic.claude-3-5-haiku-20241022-v1:0",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                            {
-                                'text': context
-                            }
-                        ]
-                }
-            ],
-            "inferenceConfig": {
-                "maxTokens": 200,
-                "stopSequences": [],
-                "temperature": 1,
-                "topP": 0.999
-            }
-        }
 
-        response = client.converse(
-            modelId=payload['modelId'],
-            messages=payload['messages'],
-            inferenceConfig=payload['inferenceConfig']
-        )
+        # near-duplicate questions from the same user reuse the answer until that user's data changes.
+        # answers are only cached for the first page of matches
+        cache = answer_cache.get_cache() if cursor is None else None
+        if cache is not None:
+            scope = cache.scope(mode=search_mode, **filters)
+            cached = cache.get(scope, embedding)
+            if cached is not None:
+                return jsonify({**cached, 'cached': True})
+            watermark = cache.watermark(scope)
+
+        try:
+            formatted_matches, context_stats, next_cursor = _find_matches(string_query, embedding, search_mode, filters, cursor)
+        except ValueError as e:
+            # a cursor from another query or filters
+            return jsonify({"error": str(e)}), 400
 
-        return jsonify({
+        client = aws_clients.get_client('bedrock-runtime', region_name='us-west-2')
+        with tracing.span("llm.converse"):
+            response = client.converse(**converse_request(string_query, formatted_matches))
+
+        answer = {
             'matches': formatted_matches,
-            'response': response['output']['message']['content'][0]['text']
-            })
+            'response': response['output']['message']['content'][0]['text'],
+            'cursor': next_cursor   # send back as "cursor" to answer from the next matches
+            }
+        if cache is not None:
+            cache.put(scope, embedding, answer, watermark)
+
+        return jsonify({**answer, 'cached': False, 'context_stats': context_stats})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@routes.route("/bedrock/stream", methods=["POST"])
+def bedrock_stream():
+    """
+    Same request body as /bedrock, answered as server-sent events:
+    "matches" with the retrieved context first, then a "delta" per chunk of generated text,
+    then "done" with the full response (or "error"). Closing the connection stops generation.
+    """
+    try:
+        string_query, search_mode, filters = parse_request(request.json)
+        cursor = request_cursor(request.json, search_mode)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        stream = None
+        try:
+            embedding = text_embedding.embed_text(string_query)
+
+            cache = answer_cache.get_cache() if cursor is None else None
+            if cache is not None:
+                scope = cache.scope(mode=search_mode, **filters)
+                cached = cache.get(scope, embedding)
+                if cached is not None:
+                    yield _sse('matches', {'matches': cached['matches'], 'cursor': cached.get('cursor')})
+                    yield _sse('delta', {'text': cached['response']})
+                    yield _sse('done', {'response': cached['response'], 'cached': True})
+                    return
+                watermark = cache.watermark(scope)
+
+            formatted_matches, context_stats, next_cursor = _find_matches(string_query, embedding, search_mode, filters, cursor)
+            # the client can render the sources while the model is still thinking
+            yield _sse('matches', {'matches': formatted_matches, 'context_stats': context_stats, 'cursor': next_cursor})
+
+            client = aws_clients.get_client('bedrock-runtime', region_name='us-west-2')
+            with tracing.span("llm.converse_stream"):
+                stream = client.converse_stream(**converse_request(string_query, formatted_matches))['stream']
+
+            chunks = []
+            usage = None
+            # includes the time the client takes to read what was sent
+            with tracing.span("llm.stream"):
+                for event in stream:
+                    if 'contentBlockDelta' in event:
+                        text = event['contentBlockDelta']['delta'].get('text', '')
+                        if text:
+                            chunks.append(text)
+                            yield _sse('delta', {'text': text})
+                    elif 'metadata' in event:
+                        usage = event['metadata'].get('usage')
+
+            response_text = ''.join(chunks)
+            if cache is not None:
+                cache.put(scope, embedding, {'matches': formatted_matches, 'response': response_text, 'cursor': next_cursor}, watermark)
+
+            yield _sse('done', {'response': response_text, 'usage': usage, 'cached': False})
+        except GeneratorExit:
+            # client went away, the finally block stops the model
+            raise
+        except Exception as e:
+            yield _sse('error', {'error': str(e)})
+        finally:
+            if stream is not None:
+                # closes the HTTP connection to bedrock, ending generation for a disconnected client
+                stream.close()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@routes.route("/bedrock/cache", methods=["GET"])
+def bedrock_cache_stats():
+    cache = answer_cache.get_cache()
+    if cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **cache.stats()})
+
+def preload() -> dict[str, float]:
+    """fills what forked workers can share, once in the gunicorn master before it forks"""
+    return startup.warm_up({"embedding_cache": startup.warm_embedding_cache})
+
+def warm_up() -> dict[str, float]:
+    """opens what the first /bedrock request would otherwise wait for, once per (forked) process"""
+    return startup.warm_up({
+        "database": startup.warm_database,
+        "bedrock_client": lambda: aws_clients.get_client('bedrock-runtime', region_name='us-west-2'),
+        "embedding_cache": startup.warm_embedding_cache,
+        "answer_cache": answer_cache.get_cache,
+        "bedrock_connection": startup.warm_bedrock_connection
+    })
+
+def create_app() -> Flask:
+    """the app factory, cheap to call: no connections or AWS clients are made until warm_up() or a request.
+    gunicorn (gunicorn.conf.py) imports it and runs preload() once before forking, and warm_up() in every worker"""
+    app = Flask(__name__)
+    CORS(app)
+    # per-stage timings for every request, /metrics and /metrics/memory
+    tracing.instrument_flask(app)
+    startup.report_first_request(app)
+    app.register_blueprint(routes)
+    return app
+
+app = create_app()
+
 if __name__ == "__main__":
+    warm_up()
     app.run(port=5000, debug=True)
\ No newline at end of file
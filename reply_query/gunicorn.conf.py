@@ -0,0 +1,42 @@
+import multiprocessing
+import os
+import time
+
+# start of the deploy as the workers will report it, set before the app is imported
+os.environ.setdefault("PROCESS_STARTED_AT", str(time.time()))
+
+"""
+gunicorn settings for the query server, run from reply_query/:
+
+    gunicorn -c gunicorn.conf.py
+
+The app is imported once in the master (preload_app) so every worker shares the imported modules
+copy-on-write and starts serving without importing anything. The embedding cache's memory tier is
+filled there too, in when_ready, so the workers share one copy of it. Sockets can't cross fork, so each
+worker opens its own postgres connections and AWS clients in post_fork, before it accepts a request.
+"""
+
+wsgi_app = "flask_server:app"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", str(multiprocessing.cpu_count() * 2 + 1)))
+# requests mostly wait on bedrock and postgres, threads keep a worker busy meanwhile
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# /bedrock/stream holds a request open for the whole generation
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+keepalive = 5
+preload_app = True
+
+
+def post_fork(server, worker):
+    import flask_server
+
+    flask_server.warm_up()
+
+
+def when_ready(server):
+    # runs in the master before the first worker is forked
+    import flask_server
+
+    flask_server.preload()
+    server.log.info(f"master ready in {time.time() - float(os.environ['PROCESS_STARTED_AT']):.2f}s")
@@ -1,3 +1,4 @@
+import logging
 import os
 import sys
 
@@ -7,22 +8,34 @@ import modules.text_embedding as te
 import modules.text_segmentation as ts
 import modules.database_interactor as db
 import modules.s3_interactor as s3
-import time
+from modules.ingest_scheduler import IngestionScheduler, notification_source_from_env
 
-def _process_file_contents(file_contents: dict) -> None:
+# every segment is uploaded under this user
+USERNAME = os.getenv("PROCESSOR_USERNAME", "test_user")
+
+def _process_file_contents(file_contents: dict, recording = None) -> None:
+    """embeds and uploads a transcript, recording defaults to its transcription job name"""
     transcript = s3.get_transcript_from_file_contents(file_contents)
     sentences = ts.text_segmentation(transcript)
 
+    sentences = [sentence for sentence in sentences if sentence.strip()]
+    embeddings = te.embed_texts(sentences)
+
     upload_contents = []
-    for sentence in sentences:
+    for sentence, embedded_text in zip(sentences, embeddings):
         print(sentence)
-        if not sentence.strip():
-            continue
-    
-        embedded_text = te.embed_text(sentence)
-        upload_contents.append((sentence, embedded_text, "test_user", "speaker"))
+        upload_contents.append((sentence, embedded_text, USERNAME, "speaker"))
+
+    db.batch_upload_embeddings(upload_contents, recording=recording or file_contents.get("jobName"))
 
-    db.batch_upload_embeddings(upload_contents)
+
+def _process_file(filename: str) -> None:
+    file_contents = s3.read_pop_file(filename)
+    if file_contents is None:
+        # already picked up by another worker or process
+        return
+
+    _process_file_contents(file_contents, recording=filename)
 
 
 # #test bd interactor search my timestamp
@@ -30,14 +43,17 @@ def _process_file_contents(file_contents: dict) -> None:
 # for row in db.timestamp_search(datetime.now() - timedelta(hours=2), 2, 2):
 #     print(row)
 
-while True:
-    if s3.bucket_empty():
-        print("no files, waiting")
-        time.sleep(5)
-    
-    for filename in s3.get_bucket_filenames():
-        file_contents = s3.read_pop_file(filename)
-        _process_file_contents(file_contents)
-
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
 
+    scheduler = IngestionScheduler(
+        _process_file,
+        bucket_name=s3.BUCKET_NAME,
+        file_extension=".json",
+        source=notification_source_from_env()
+    )
 
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        scheduler.stop()